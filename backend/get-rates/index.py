@@ -1,72 +1,1132 @@
+import atexit
+import base64
+import hashlib
+import hmac
 import json
-import urllib.request
-import urllib.error
-from typing import Dict, Any
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Трассировка: доля вызовов, для которых пишутся замеры участков (event request_timing),
+# и заголовок Server-Timing у трассированных ответов (тогда X-Trace: 1 трассирует вызов всегда)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING') == '1'
+
+CACHE_TTL = float(os.environ.get('RATES_CACHE_TTL', '60'))
+STALE_WHILE_REVALIDATE = float(os.environ.get('RATES_STALE_WHILE_REVALIDATE', '300'))
+STALE_IF_ERROR = float(os.environ.get('RATES_STALE_IF_ERROR', '3600'))
+FETCH_DEADLINE = float(os.environ.get('RATES_FETCH_DEADLINE', '5'))
+PROVIDER_TIMEOUT = float(os.environ.get('RATES_PROVIDER_TIMEOUT', '4'))
+HEDGE_DELAY = float(os.environ.get('RATES_HEDGE_DELAY', '1'))
+AGGREGATION_WINDOW = float(os.environ.get('RATES_AGGREGATION_WINDOW', '0.25'))
+MAX_DEVIATION = float(os.environ.get('RATES_MAX_DEVIATION', '0.05'))
+BREAKER_FAILURES = int(os.environ.get('RATES_BREAKER_FAILURES', '3'))
+BREAKER_RESET = float(os.environ.get('RATES_BREAKER_RESET', '30'))
+FIXTURE_PATH = os.environ.get(
+    'RATES_FIXTURE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'rates.json')
+)
+
+# Адреса провайдеров переопределяются для нагрузочных тестов с локальной заглушкой
+COINGECKO_URL = os.environ.get('RATES_COINGECKO_URL', 'https://api.coingecko.com/api/v3/simple/price')
+CRYPTOCOMPARE_URL = os.environ.get('RATES_CRYPTOCOMPARE_URL', 'https://min-api.cryptocompare.com/data/pricemulti')
+EXCHANGERATE_URL = os.environ.get('RATES_EXCHANGERATE_URL', 'https://api.exchangerate-api.com/v4/latest/RUB')
+CBR_URL = os.environ.get('RATES_CBR_URL', 'https://www.cbr-xml-daily.ru/daily_json.js')
+
+CRYPTO_ASSETS = ['BTC', 'ETH', 'USDT', 'TRX', 'XRP', 'TON', 'USDC']
+FIAT_ASSETS = ['USD', 'EUR', 'KZT', 'UAH']
+
+# Базовый актив -> инструменты (сети и платежные методы), котируемые по его курсу
+INSTRUMENTS: Dict[str, List[str]] = {
+    'BTC': ['BTC'],
+    'ETH': ['ETH', 'ETH-ARB', 'ETH-BEP20'],
+    'USDT': ['USDT', 'USDT-TRC20', 'USDT-BEP20', 'USDT-ERC20', 'USDT-ARB', 'USDT-TON', 'USDT-MATIC'],
+    'TRX': ['TRX'],
+    'XRP': ['XRP'],
+    'TON': ['TON'],
+    'USDC': ['USDC', 'USDC-ERC20', 'USDC-SOL', 'USDC-MATIC'],
+    'USD': ['USD-REVOLUT', 'USD-WISE', 'USD-CARD'],
+    'EUR': ['EUR-CARD', 'EUR-REVOLUT', 'EUR-WISE', 'EUR-PAYSERA', 'EUR-SEPA'],
+    'KZT': ['KZT-KASPI', 'KZT-HALYK', 'KZT-JUSAN', 'KZT-ALTYN', 'KZT-FREEDOM'],
+    'UAH': ['UAH-MONO', 'UAH-PRIVAT', 'UAH-ABANK', 'UAH-PUMB', 'UAH-IZI', 'UAH-SENSE', 'UAH-TRANSFER'],
+    'RUB': ['RUB-SBP', 'RUB-TINKOFF', 'RUB-VTB', 'RUB-PSB', 'RUB-SBER', 'RUB-ALFA', 'RUB-RAIF',
+            'RUB-POST', 'RUB-MTS', 'RUB-GPB']
+}
+
+# Необязательный спред инструмента к курсу базового актива (0.01 = +1%), задается в RATES_SPREADS
+INSTRUMENT_SPREADS: Dict[str, float] = json.loads(os.environ.get('RATES_SPREADS', '{}'))
+
+FIXED_QUOTES = {'RUB': 1}
+
+# Маржа обменника, закладываемая в кросс-курсы матрицы (0.02 = клиент получает на 2% меньше)
+CROSS_MARGIN = float(os.environ.get('RATES_CROSS_MARGIN', '0'))
+
+# Котировки для create_order: подпись общим с partner-track ключом, срок жизни и предельный возраст курсов
+QUOTE_SIGNING_KEY = os.environ.get('QUOTE_SIGNING_KEY', '')
+QUOTE_TTL = int(os.environ.get('QUOTE_TTL', '60'))
+QUOTE_MAX_RATES_AGE = float(os.environ.get('QUOTE_MAX_RATES_AGE', '120'))
+
+# История курсов: снимки и свечи пишутся в БД, только если задан DATABASE_URL
+DSN = os.environ.get('DATABASE_URL')
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE: psycopg2 импортируется лениво при первом соединении
+TRANSACTION_STATUS_IDLE = 0
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '2'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_METRICS_INTERVAL = float(os.environ.get('DB_POOL_METRICS_INTERVAL', '60'))
+
+HISTORY_BATCH_SIZE = int(os.environ.get('RATES_HISTORY_BATCH_SIZE', '5'))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get('RATES_HISTORY_FLUSH_INTERVAL', '300'))
+HISTORY_SNAPSHOT_DAYS = int(os.environ.get('RATES_HISTORY_SNAPSHOT_DAYS', '90'))
+HISTORY_MINUTE_DAYS = int(os.environ.get('RATES_HISTORY_MINUTE_DAYS', '30'))
+HISTORY_MAX_CANDLES = int(os.environ.get('RATES_HISTORY_MAX_CANDLES', '1000'))
+# Уровни свечей: длительность в секундах. 1h и 1d хранятся бессрочно, 1m - HISTORY_MINUTE_DAYS
+HISTORY_TIERS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+# Хранилище снимка, которое наполняет обновлятель (refresher.py или вызов по таймеру):
+# file - JSON-файл RATES_SNAPSHOT_PATH, postgres - строка rate_latest. С хранилищем запросы
+# только читают снимок, не чаще раза в RATES_STORE_POLL секунд; без него курсы
+# запрашиваются у провайдеров в самой функции
+SNAPSHOT_STORE = os.environ.get('RATES_SNAPSHOT_STORE', '')
+SNAPSHOT_PATH = os.environ.get('RATES_SNAPSHOT_PATH', '/tmp/rates-snapshot.json')
+STORE_POLL = float(os.environ.get('RATES_STORE_POLL', '5'))
+REFRESH_INTERVAL = float(os.environ.get('RATES_REFRESH_INTERVAL', '30'))
+REFRESH_JITTER = float(os.environ.get('RATES_REFRESH_JITTER', '5'))
+# Сколько секунд один вызов по таймеру обновляет снимок; таймаут функции должен быть больше
+TIMER_WINDOW = float(os.environ.get('RATES_TIMER_WINDOW', '50'))
+
+# Сколько последних версий снимка помнит контейнер для дельт since=<версия>;
+# тела короче RATES_COMPRESS_MIN_BYTES отдаются без сжатия
+DELTA_HISTORY = int(os.environ.get('RATES_DELTA_HISTORY', '10'))
+COMPRESS_MIN_BYTES = int(os.environ.get('RATES_COMPRESS_MIN_BYTES', '1024'))
+
+INSERT_SNAPSHOTS_SQL = """
+    INSERT INTO rate_snapshots (fetched_at, instruments_version, rates)
+    VALUES %s
+    ON CONFLICT (fetched_at) DO NOTHING
+"""
+
+# Свеча дополняется независимо от порядка записи: open/close берутся по open_at/close_at
+UPSERT_CANDLES_SQL = """
+    INSERT INTO rate_candles (instrument, tier, bucket, open, high, low, close, open_at, close_at, samples)
+    VALUES %s
+    ON CONFLICT (instrument, tier, bucket) DO UPDATE
+    SET open = CASE WHEN EXCLUDED.open_at < rate_candles.open_at THEN EXCLUDED.open ELSE rate_candles.open END,
+        high = GREATEST(rate_candles.high, EXCLUDED.high),
+        low = LEAST(rate_candles.low, EXCLUDED.low),
+        close = CASE WHEN EXCLUDED.close_at > rate_candles.close_at THEN EXCLUDED.close ELSE rate_candles.close END,
+        open_at = LEAST(rate_candles.open_at, EXCLUDED.open_at),
+        close_at = GREATEST(rate_candles.close_at, EXCLUDED.close_at),
+        samples = rate_candles.samples + EXCLUDED.samples
+"""
+
+SELECT_CANDLES_SQL = """
+    SELECT EXTRACT(EPOCH FROM bucket)::BIGINT, open, high, low, close, samples
+    FROM rate_candles
+    WHERE instrument = %s AND tier = %s AND bucket >= to_timestamp(%s) AND bucket < to_timestamp(%s)
+    ORDER BY bucket
+    LIMIT %s
+"""
+
+PUBLISH_SNAPSHOT_SQL = """
+    INSERT INTO rate_latest (id, fetched_at, snapshot)
+    VALUES (1, to_timestamp(%s), %s)
+    ON CONFLICT (id) DO UPDATE
+    SET fetched_at = EXCLUDED.fetched_at, snapshot = EXCLUDED.snapshot, updated_at = CURRENT_TIMESTAMP
+    WHERE rate_latest.fetched_at < EXCLUDED.fetched_at
+"""
+
+# Плоские массивы таблицы, чтобы курсы всех инструментов собирались одним проходом
+INSTRUMENT_CODES = [code for codes in INSTRUMENTS.values() for code in codes]
+INSTRUMENT_BASES = [base for base, codes in INSTRUMENTS.items() for _ in codes]
+# Класс активов инструмента; рублевые методы котируются фиксированно и от провайдеров не зависят
+INSTRUMENT_CLASSES = {
+    code: 'crypto' if base in CRYPTO_ASSETS else 'fiat'
+    for base, codes in INSTRUMENTS.items() if base not in FIXED_QUOTES
+    for code in codes
+}
+INSTRUMENT_MULTIPLIERS = [1 + INSTRUMENT_SPREADS.get(code, 0) for code in INSTRUMENT_CODES]
+INSTRUMENTS_VERSION = hashlib.sha1(
+    json.dumps([INSTRUMENTS, INSTRUMENT_SPREADS], sort_keys=True).encode()
+).hexdigest()[:12]
+
+# Снимок курсов переживает вызовы, пока контейнер функции остается теплым
+_snapshot: Optional[Dict[str, Any]] = None
+_refresh_lock = threading.Lock()
+_store_checked_at = 0.0
+_executor = None
+_brotli = None
+# Курсы последних снимков по версиям - основа ответов since=<версия>
+_recent_rates: Dict[str, Dict[str, float]] = {}
 
 
 def handler(event: dict, context) -> dict:
     '''Получает актуальные курсы криптовалют и фиатных валют'''
     
-    method = event.get('httpMethod', 'GET')
+    if is_timer_event(event):
+        if not SNAPSHOT_STORE:
+            return error_response('RATES_SNAPSHOT_STORE is not configured', 503)
+        cycles = run_refresher(until=time.monotonic() + TIMER_WINDOW)
+        return success_response({'cycles': cycles})
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+    request = Request(event)
     
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+    if request.method == 'OPTIONS':
+        return PREFLIGHT
+    
+    if request.method != 'GET':
+        return error_response('Method not allowed', 405)
+    
+    return traced(request, request.params.get('mode') or 'rates', lambda: get_rates(request, context))
+
+
+def get_rates(request: 'Request', context) -> dict:
+    '''Курсы, кросс-курсы или котировка по параметрам запроса'''
+    
+    params = request.params
     
     try:
-        crypto_rates = fetch_crypto_rates()
-        fiat_rates = fetch_fiat_rates()
+        if params.get('mode') == 'history':
+            return get_rate_history(params)
         
-        rates = {**crypto_rates, **fiat_rates}
+        snapshot = get_rates_snapshot()
+        age = max(0.0, time.time() - snapshot['fetched_at'])
+        
+        if params.get('mode') == 'quote':
+            if not QUOTE_SIGNING_KEY:
+                return error_response('Quotes are disabled', 503)
+            source, target = params.get('from'), params.get('to')
+            # Курсы класса, не обновившегося в последнем опросе, перенесены из прошлых снимков
+            stale_classes = {INSTRUMENT_CLASSES.get(source), INSTRUMENT_CLASSES.get(target)} & set(snapshot['missing'])
+            if stale_classes or time.time() - oldest_fetched_at(snapshot) >= QUOTE_MAX_RATES_AGE:
+                return error_response('Rates are stale, quote unavailable', 503)
+            
+            if source not in snapshot['rates'] or target not in snapshot['rates']:
+                return error_response('Unknown instruments', 400)
+            
+            try:
+                amount = float(params.get('amount') or 0)
+            except ValueError:
+                amount = 0
+            if not (amount > 0 and math.isfinite(amount)):
+                return error_response('Invalid amount', 400)
+            
+            payload = {
+                'success': True,
+                'quote': build_quote(snapshot, source, target, amount)
+            }
+        elif params.get('mode') == 'matrix':
+            matrix = get_cross_matrix(snapshot)
+            sources = parse_codes(params.get('from')) or INSTRUMENT_CODES
+            targets = parse_codes(params.get('to')) or INSTRUMENT_CODES
+            
+            unknown = [code for code in sources + targets if code not in matrix]
+            if unknown:
+                return error_response(f"Unknown instruments: {', '.join(unknown)}", 400)
+            
+            payload = {
+                'success': True,
+                'margin': CROSS_MARGIN,
+                'matrix': {
+                    source: {target: matrix[source][target] for target in targets}
+                    for source in sources
+                }
+            }
+        else:
+            return snapshot_response(request, snapshot, age)
         
         return {
             'statusCode': 200,
             'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Cache-Control': 'public, max-age=60'
+                **JSON_HEADERS,
+                'Cache-Control': 'no-store' if 'quote' in payload else cache_control_header(age)
             },
-            'body': json.dumps({
-                'success': True,
-                'rates': rates,
+            'body': encode_body({
+                **payload,
+                'age': int(age),
+                'stale': age >= CACHE_TTL,
+                'missing': snapshot['missing'],
+                'providers': snapshot['providers'],
                 'timestamp': context.request_time_epoch if hasattr(context, 'request_time_epoch') else None
             })
         }
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'success': False,
-                'error': str(e)
-            })
+        return error_response(str(e), 500)
+
+
+def snapshot_response(request: 'Request', snapshot: Dict[str, Any], age: float) -> dict:
+    '''
+    Курсы снимка для опроса клиентами: полные, format=compact или since=<версия> -
+    только изменившиеся с той версии инструменты (если версия уже вытеснена из
+    последних DELTA_HISTORY снимков, отдаются полные курсы). Тело зависит только от
+    снимка и параметров, поэтому собирается и сжимается один раз на снимок, а
+    If-None-Match с текущим ETag получает 304 без сборки тела. Возраст снимка
+    передается заголовком Age.
+    '''
+    
+    params = request.params
+    stale = age >= CACHE_TTL
+    since = params.get('since')
+    
+    if since is not None and since in _recent_rates:
+        variant = f'd{since}'
+    elif params.get('format') == 'compact':
+        variant = 'c' if params.get('instruments_version') == INSTRUMENTS_VERSION else 'ci'
+    else:
+        since = None
+        variant = 'r'
+    if stale:
+        variant += 's'
+    
+    etag = f'"{snapshot["version"]}.{INSTRUMENTS_VERSION}.{variant}"'
+    headers = {
+        **JSON_HEADERS,
+        'Cache-Control': cache_control_header(age),
+        'Age': str(int(age)),
+        'Vary': 'Accept-Encoding',
+        'Access-Control-Expose-Headers': 'ETag, Age'
+    }
+    
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return {'statusCode': 304, 'headers': {**headers, 'ETag': etag}, 'body': ''}
+    
+    bodies = snapshot['bodies']
+    body = bodies.get(variant)
+    if body is None:
+        payload = {'success': True}
+        if since is not None:
+            previous = _recent_rates[since]
+            current = snapshot['rates']
+            payload['since'] = since
+            payload['changed'] = {code: rate for code, rate in current.items() if previous.get(code) != rate}
+            payload['removed'] = [code for code in previous if code not in current]
+        elif variant.startswith('c'):
+            # Компактная форма: только базовые курсы; таблицу инструментов клиент кэширует
+            # по версии и получает заново, лишь когда переданная версия устарела
+            payload['base_rates'] = snapshot['quotes']
+            payload['instruments_version'] = INSTRUMENTS_VERSION
+            if variant.startswith('ci'):
+                payload['instruments'] = INSTRUMENTS
+                payload['spreads'] = INSTRUMENT_SPREADS
+        else:
+            payload['rates'] = snapshot['rates']
+        
+        body = bodies[variant] = encode_body({
+            **payload,
+            'version': snapshot['version'],
+            'fetched_at': snapshot['fetched_at'],
+            'stale': stale,
+            'missing': snapshot['missing'],
+            'providers': snapshot['providers']
+        })
+    
+    encoding = choose_encoding(request.headers.get('accept-encoding', ''), len(body))
+    if encoding is None:
+        return {'statusCode': 200, 'headers': {**headers, 'ETag': etag}, 'body': body}
+    
+    compressed = bodies.get((variant, encoding))
+    if compressed is None:
+        compressed = bodies[(variant, encoding)] = compress_body(body, encoding)
+    
+    return {
+        'statusCode': 200,
+        'headers': {**headers, 'ETag': f'{etag[:-1]}.{encoding}"', 'Content-Encoding': encoding},
+        'body': compressed,
+        'isBase64Encoded': True
+    }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    '''If-None-Match совпадает с ETag ответа в любом из его сжатий'''
+    
+    if not if_none_match:
+        return False
+    prefix = etag[:-1] + '.'
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag or (tag.startswith(prefix) and tag[len(prefix):-1] in ('gzip', 'br')):
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding: str, size: int) -> Optional[str]:
+    if size < COMPRESS_MIN_BYTES or not accept_encoding:
+        return None
+    
+    accepted = set()
+    for item in accept_encoding.lower().split(','):
+        name, _, quality = item.partition(';')
+        quality = quality.strip()
+        try:
+            if quality.startswith('q=') and float(quality[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip())
+    
+    if 'br' in accepted and get_brotli() is not None:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_body(body: str, encoding: str) -> str:
+    '''Сжатое тело в base64 для ответа с isBase64Encoded'''
+    
+    data = body.encode()
+    if encoding == 'br':
+        data = get_brotli().compress(data)
+    else:
+        import gzip
+        data = gzip.compress(data, mtime=0)
+    return base64.b64encode(data).decode()
+
+
+def get_brotli():
+    '''Модуль brotli, если установлен; импортируется при первом сжатии, а не на холодном старте'''
+    
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli or None
+
+
+def remember_snapshot(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    '''Версия и кэш тел нового снимка; курсы последних DELTA_HISTORY версий хранятся для дельт'''
+    
+    snapshot['version'] = format(int(snapshot['fetched_at'] * 1000), 'x')
+    snapshot['bodies'] = {}
+    _recent_rates[snapshot['version']] = snapshot['rates']
+    while len(_recent_rates) > DELTA_HISTORY:
+        _recent_rates.pop(next(iter(_recent_rates)))
+    return snapshot
+
+
+def get_rates_snapshot() -> Dict[str, Any]:
+    '''Возвращает снимок курсов из хранилища обновлятеля или из кэша контейнера, обновляя его по TTL'''
+    
+    if SNAPSHOT_STORE:
+        return read_stored_snapshot()
+    
+    snapshot = _snapshot
+    
+    if snapshot is not None:
+        age = time.time() - snapshot['fetched_at']
+        
+        if age < CACHE_TTL and not snapshot['missing']:
+            return snapshot
+        
+        if age < CACHE_TTL + STALE_WHILE_REVALIDATE:
+            start_background_refresh()
+            return snapshot
+    
+    try:
+        return refresh_snapshot()
+    except Exception:
+        if snapshot is not None and time.time() - oldest_fetched_at(snapshot) < STALE_IF_ERROR:
+            return snapshot
+        raise
+
+
+def refresh_snapshot() -> Dict[str, Any]:
+    '''Синхронно обновляет снимок; параллельные вызовы ждут одного запроса к провайдерам'''
+    
+    with _refresh_lock:
+        current = _snapshot
+        if (current is not None and not current['missing']
+                and time.time() - current['fetched_at'] < CACHE_TTL):
+            return current
+        return _fetch_snapshot()
+
+
+def start_background_refresh() -> None:
+    '''Запускает фоновое обновление снимка, если оно еще не идет'''
+    
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    
+    def run():
+        try:
+            _fetch_snapshot()
+        except Exception as e:
+            print(json.dumps({'event': 'rates_refresh_failed', 'error': str(e)}))
+        finally:
+            _refresh_lock.release()
+    
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _fetch_snapshot() -> Dict[str, Any]:
+    '''Запрашивает курсы у провайдеров и публикует новый снимок; вызывать под _refresh_lock'''
+    
+    global _snapshot
+    
+    results, errors = fetch_all_rates()
+    previous = _snapshot
+    
+    # Без единого ответа снимок не пересобирается: старые курсы с новым fetched_at
+    # выглядели бы свежими, а так вызывающий отдаст прошлый снимок по STALE_IF_ERROR
+    if not results:
+        raise RuntimeError('All rate providers failed: ' + '; '.join(
+            f'{asset_class}/{name}: {error}' for (asset_class, name), error in errors.items()
+        ))
+    
+    now = time.time()
+    
+    # Класс активов без ответа в пределах дедлайна берем из последнего удачного снимка
+    # вместе со временем, когда его курсы были получены, пока они не старше STALE_IF_ERROR
+    sources = {}
+    providers = {}
+    class_fetched_at = {}
+    for asset_class in PROVIDERS:
+        if asset_class in results:
+            sources[asset_class], providers[asset_class] = results[asset_class]
+            class_fetched_at[asset_class] = now
+        elif previous is not None and asset_class in previous['sources']:
+            carried_at = previous.get('class_fetched_at', {}).get(asset_class, previous['fetched_at'])
+            if now - carried_at < STALE_IF_ERROR:
+                sources[asset_class] = previous['sources'][asset_class]
+                providers[asset_class] = previous['providers'][asset_class]
+                class_fetched_at[asset_class] = carried_at
+    
+    quotes = dict(FIXED_QUOTES)
+    for asset_class in PROVIDERS:
+        quotes.update(sources.get(asset_class, {}))
+    
+    _snapshot = remember_snapshot({
+        'rates': expand_rates(quotes),
+        'quotes': quotes,
+        'sources': sources,
+        'providers': providers,
+        'missing': sorted(asset_class for asset_class in PROVIDERS if asset_class not in results),
+        'fetched_at': now,
+        'class_fetched_at': class_fetched_at
+    })
+    if _history is not None:
+        _history.record(_snapshot)
+    return _snapshot
+
+
+def oldest_fetched_at(snapshot: Dict[str, Any]) -> float:
+    '''Когда получены самые старые курсы снимка: перенесенные классы старше его fetched_at'''
+    return min(snapshot.get('class_fetched_at', {}).values(), default=snapshot['fetched_at'])
+
+
+def read_stored_snapshot() -> Dict[str, Any]:
+    '''
+    Снимок из хранилища обновлятеля. Хранилище проверяется не чаще раза в STORE_POLL
+    секунд, остальные вызовы отдают снимок из памяти контейнера без ввода-вывода.
+    '''
+    
+    global _snapshot, _store_checked_at
+    
+    if _snapshot is None or time.monotonic() - _store_checked_at >= STORE_POLL:
+        with _refresh_lock:
+            if _snapshot is None or time.monotonic() - _store_checked_at >= STORE_POLL:
+                try:
+                    loaded = load_snapshot(_snapshot['fetched_at'] if _snapshot is not None else 0.0)
+                    if loaded is not None:
+                        _snapshot = loaded
+                except Exception as e:
+                    print(json.dumps({'event': 'rates_store_read_failed', 'error': str(e)}))
+                _store_checked_at = time.monotonic()
+    
+    snapshot = _snapshot
+    if snapshot is None:
+        raise RuntimeError('No rates snapshot published yet')
+    if time.time() - oldest_fetched_at(snapshot) >= STALE_IF_ERROR:
+        raise RuntimeError('Rates snapshot is too old, refresher is not running')
+    return snapshot
+
+
+def load_snapshot(newer_than: float) -> Optional[Dict[str, Any]]:
+    '''Снимок из хранилища, если он новее newer_than; курсы инструментов считаются по таблице этой функции'''
+    
+    if SNAPSHOT_STORE == 'file':
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                stored = loads(f.read())
+        except FileNotFoundError:
+            return None
+    else:
+        conn = get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT snapshot FROM rate_latest WHERE id = 1 AND fetched_at > to_timestamp(%s)",
+                (newer_than,)
+            )
+            row = cur.fetchone()
+        finally:
+            cur.close()
+            release_connection(conn)
+        if row is None:
+            return None
+        stored = row[0] if isinstance(row[0], dict) else loads(row[0])
+    
+    if stored['fetched_at'] <= newer_than:
+        return None
+    return remember_snapshot({**stored, 'rates': expand_rates(stored['quotes'])})
+
+
+def publish_snapshot(snapshot: Dict[str, Any]) -> None:
+    '''Записывает снимок в хранилище: файл заменяется атомарно, строка rate_latest - только более новым снимком'''
+    
+    stored = {
+        key: snapshot[key]
+        for key in ('quotes', 'sources', 'providers', 'missing', 'fetched_at', 'class_fetched_at')
+    }
+    
+    if SNAPSHOT_STORE == 'file':
+        tmp_path = f'{SNAPSHOT_PATH}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(dumps(stored))
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        return
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(PUBLISH_SNAPSHOT_SQL, (snapshot['fetched_at'], dumps(stored)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def refresh_store() -> Dict[str, Any]:
+    '''Один цикл обновлятеля: курсы у провайдеров и публикация снимка в хранилище'''
+    
+    global _snapshot
+    
+    with _refresh_lock:
+        if _snapshot is None:
+            # Классы активов без ответа провайдеров берутся из последнего опубликованного снимка
+            try:
+                _snapshot = load_snapshot(0.0)
+            except Exception:
+                pass
+        snapshot = _fetch_snapshot()
+    
+    publish_snapshot(snapshot)
+    return snapshot
+
+
+def run_refresher(interval: float = REFRESH_INTERVAL, jitter: float = REFRESH_JITTER, until: Optional[float] = None) -> int:
+    '''
+    Обновляет снимок в хранилище каждые interval ± jitter секунд до момента until
+    по time.monotonic() (без него - бесконечно). Разброс не дает нескольким
+    обновлятелям синхронно ходить к провайдерам. Возвращает число удачных циклов.
+    '''
+    
+    import random
+    
+    cycles = 0
+    while True:
+        started = time.monotonic()
+        try:
+            snapshot = refresh_store()
+            cycles += 1
+            print(json.dumps({'event': 'rates_published', 'missing': snapshot['missing'], 'providers': snapshot['providers']}))
+        except Exception as e:
+            print(json.dumps({'event': 'rates_refresh_failed', 'error': str(e)}))
+        
+        delay = max(0.0, interval + random.uniform(-jitter, jitter) - (time.monotonic() - started))
+        if until is not None and time.monotonic() + delay >= until:
+            return cycles
+        time.sleep(delay)
+
+
+def is_timer_event(event: dict) -> bool:
+    # Триггер-таймер Yandex Cloud Functions вызывает функцию с messages вместо HTTP-полей
+    return 'httpMethod' not in event and any(
+        message.get('event_metadata', {}).get('event_type', '').endswith('TimerMessage')
+        for message in event.get('messages') or []
+    )
+
+
+def get_cross_matrix(snapshot: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    '''
+    Матрица кросс-курсов снимка: matrix[строка][столбец] - сколько единиц
+    инструмента-столбца дают за единицу инструмента-строки с учетом маржи
+    (matrix['BTC']['RUB-SBP'] - рублей за биткоин). Считается один раз на снимок.
+    '''
+    
+    matrix = snapshot.get('matrix')
+    if matrix is None:
+        codes = list(snapshot['rates'])
+        values = [snapshot['rates'][code] for code in codes]
+        inverse = [1 / value for value in values]
+        keep = 1 - CROSS_MARGIN
+        
+        # Внешнее произведение вектора курсов на вектор обратных курсов
+        matrix = {
+            source: dict(zip(codes, [value * keep * inv for inv in inverse]))
+            for source, value in zip(codes, values)
         }
+        for code in codes:
+            matrix[code][code] = 1
+        snapshot['matrix'] = matrix
+    
+    return matrix
+
+
+def build_quote(snapshot: Dict[str, Any], source: str, target: str, amount: float) -> Dict[str, Any]:
+    '''
+    Фиксирует кросс-курс снимка для пары и суммы. partner-track проверяет
+    подпись локально и берет суммы заявки из котировки, а не из запроса клиента.
+    '''
+    
+    rate = get_cross_matrix(snapshot)[source][target]
+    to_amount = round(amount * rate, 8)
+    issued_at = int(time.time())
+    quote = {
+        'from': source,
+        'to': target,
+        'from_amount': amount,
+        'to_amount': to_amount,
+        'rate': rate,
+        # Маржа в рублях - ровно та, что заложена в курс котировки: стоимость отданного минус полученного
+        'margin_profit': max(0.0, round(amount * snapshot['rates'][source] - to_amount * snapshot['rates'][target], 2)),
+        'iat': issued_at,
+        'exp': issued_at + QUOTE_TTL,
+        'nonce': os.urandom(8).hex()
+    }
+    return {**quote, 'token': sign_quote(quote)}
+
+
+def sign_quote(quote: Dict[str, Any]) -> str:
+    '''Токен вида base64url(json).base64url(hmac-sha256)'''
+    
+    payload = base64.urlsafe_b64encode(
+        json.dumps(quote, separators=(',', ':'), sort_keys=True).encode()
+    ).rstrip(b'=')
+    signature = hmac.new(QUOTE_SIGNING_KEY.encode(), payload, hashlib.sha256).digest()
+    return f"{payload.decode()}.{base64.urlsafe_b64encode(signature).rstrip(b'=').decode()}"
+
+
+def parse_codes(value: Optional[str]) -> List[str]:
+    return [code.strip() for code in value.split(',') if code.strip()] if value else []
+
+
+def cache_control_header(age: float) -> str:
+    '''Формирует Cache-Control с учетом возраста снимка'''
+    
+    max_age = max(0, int(CACHE_TTL - age))
+    return (
+        f'public, max-age={max_age}, '
+        f'stale-while-revalidate={int(STALE_WHILE_REVALIDATE)}, '
+        f'stale-if-error={int(STALE_IF_ERROR)}'
+    )
+
+
+def get_rate_history(params: dict) -> dict:
+    '''
+    Свечи инструмента из уровня interval (1m, 1h, 1d) за [start, end) в unix-секундах.
+    Без start отдаются последние limit свечей до end; при полном ответе next_start
+    продолжает выборку.
+    '''
+    
+    if _history is None:
+        return error_response('Rate history is disabled', 503)
+    
+    instrument = params.get('instrument')
+    if instrument not in INSTRUMENT_CODES:
+        return error_response('Unknown instrument', 400)
+    
+    tier = params.get('interval', '1h')
+    if tier not in HISTORY_TIERS:
+        return error_response(f"Interval must be one of: {', '.join(HISTORY_TIERS)}", 400)
+    seconds = HISTORY_TIERS[tier]
+    
+    try:
+        limit = min(int(params.get('limit') or HISTORY_MAX_CANDLES), HISTORY_MAX_CANDLES)
+        end = float(params.get('end') or time.time())
+        start = float(params.get('start') or end - limit * seconds)
+    except ValueError:
+        return error_response('Invalid start, end or limit', 400)
+    if limit <= 0 or not (math.isfinite(start) and math.isfinite(end)):
+        return error_response('Invalid start, end or limit', 400)
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(SELECT_CANDLES_SQL, (instrument, tier, start, end, limit))
+        candles = [list(row) for row in cur.fetchall()]
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    return {
+        'statusCode': 200,
+        'headers': {**JSON_HEADERS, 'Cache-Control': f'public, max-age={int(min(CACHE_TTL, seconds))}'},
+        'body': encode_body({
+            'success': True,
+            'instrument': instrument,
+            'interval': tier,
+            'columns': ['time', 'open', 'high', 'low', 'close', 'samples'],
+            'candles': candles,
+            'next_start': candles[-1][0] + seconds if len(candles) == limit else None
+        })
+    }
+
+
+class RateHistory:
+    '''
+    Пакетная запись истории курсов. Снимки копятся в контейнере до HISTORY_BATCH_SIZE
+    штук или HISTORY_FLUSH_INTERVAL секунд и пишутся одной транзакцией в фоновом
+    потоке: строка rate_snapshots на снимок и по строке rate_candles на инструмент
+    и уровень - свечи пачки сводятся в памяти до записи. Несброшенные снимки
+    теряются при аварийной остановке контейнера: история служит графикам и
+    аудиту, цены заказов закреплены подписанными котировками.
+    '''
+    
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {'recorded': 0, 'flushed': 0, 'flushes': 0, 'flush_errors': 0}
+        self._items = []
+        self._oldest_at = 0.0
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+    
+    def record(self, snapshot: Dict[str, Any]) -> None:
+        rates = snapshot['rates']
+        with self._lock:
+            if not self._items:
+                self._oldest_at = time.monotonic()
+            self._items.append((snapshot['fetched_at'], [rates.get(code) for code in INSTRUMENT_CODES]))
+            self.stats['recorded'] += 1
+            due = len(self._items) >= self.batch_size or time.monotonic() - self._oldest_at >= self.flush_interval
+        
+        if due:
+            threading.Thread(target=self.flush, daemon=True, name='rates-history').start()
+    
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._items = self._items, []
+            if not batch:
+                return 0
+            
+            prune = time.monotonic() - self._pruned_at >= 3600
+            try:
+                write_history(batch, prune)
+            except Exception as e:
+                with self._lock:
+                    self.stats['flush_errors'] += 1
+                    # Пачка возвращается в буфер, но не больше десяти пачек, чтобы память оставалась ограниченной
+                    self._items = (batch + self._items)[-self.batch_size * 10:]
+                print(json.dumps({'event': 'rates_history_flush_failed', 'pending': len(self._items), 'error': str(e)}))
+                return 0
+            
+            if prune:
+                self._pruned_at = time.monotonic()
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['flushed'] += len(batch)
+            return len(batch)
+
+
+def build_candles(batch: List[Tuple[float, List[Optional[float]]]]) -> List[tuple]:
+    '''Сводит снимки пачки (идут по времени) в свечи всех уровней'''
+    
+    candles = {}
+    for fetched_at, rates in batch:
+        for code, rate in zip(INSTRUMENT_CODES, rates):
+            if rate is None:
+                continue
+            for tier, seconds in HISTORY_TIERS.items():
+                key = (code, tier, fetched_at // seconds * seconds)
+                candle = candles.get(key)
+                if candle is None:
+                    candles[key] = [rate, rate, rate, rate, fetched_at, fetched_at, 1]
+                else:
+                    candle[1] = max(candle[1], rate)
+                    candle[2] = min(candle[2], rate)
+                    candle[3] = rate
+                    candle[5] = fetched_at
+                    candle[6] += 1
+    
+    return [(*key, *candle) for key, candle in candles.items()]
+
+
+def write_history(batch: List[Tuple[float, List[Optional[float]]]], prune: bool) -> None:
+    from psycopg2.extras import execute_values
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            "INSERT INTO rate_instrument_sets (version, codes) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING",
+            (INSTRUMENTS_VERSION, INSTRUMENT_CODES)
+        )
+        execute_values(
+            cur, INSERT_SNAPSHOTS_SQL,
+            [(fetched_at, INSTRUMENTS_VERSION, rates) for fetched_at, rates in batch],
+            template='(to_timestamp(%s), %s, %s)'
+        )
+        execute_values(
+            cur, UPSERT_CANDLES_SQL, build_candles(batch),
+            template='(%s, %s, to_timestamp(%s), %s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s), %s)',
+            page_size=500
+        )
+        
+        if prune:
+            cur.execute(
+                "DELETE FROM rate_snapshots WHERE fetched_at < now() - make_interval(days => %s)",
+                (HISTORY_SNAPSHOT_DAYS,)
+            )
+            cur.execute(
+                "DELETE FROM rate_candles WHERE tier = '1m' AND bucket < now() - make_interval(days => %s)",
+                (HISTORY_MINUTE_DAYS,)
+            )
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+class CircuitBreaker:
+    '''Отключает провайдера после серии ошибок и пропускает пробный запрос после паузы'''
+    
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Полуоткрытое состояние: пропускаем один пробный запрос, следующий ждет новой паузы
+                self.opened_at = time.monotonic()
+                return True
+            return False
+    
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class RateProvider:
+    '''Источник котировок базовых активов в рублях за единицу'''
+    
+    def __init__(self, name: str, fetch: Callable[[float], Dict[str, float]]):
+        self.name = name
+        self.fetch = fetch
+        self.breaker = CircuitBreaker()
+    
+    def quote(self, timeout: float) -> Dict[str, float]:
+        try:
+            quotes = self.fetch(timeout)
+            if not quotes:
+                raise ValueError('empty response')
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        
+        self.breaker.record_success()
+        return quotes
+
+
+def fetch_all_rates() -> Tuple[Dict[str, Tuple[Dict[str, float], List[str]]], Dict[Tuple[str, str], str]]:
+    '''
+    Опрашивает провайдеров всех классов активов в пределах общего дедлайна.
+    Сначала запрашивается основной провайдер класса; резервные подключаются,
+    если он ответил ошибкой или не ответил за RATES_HEDGE_DELAY. После первого
+    успешного ответа класс ждет остальных не дольше RATES_AGGREGATION_WINDOW,
+    затем котировки сводятся медианой. Ошибки возвращаются по парам (класс, провайдер).
+    '''
+    
+    from concurrent.futures import FIRST_COMPLETED, Future, wait
+    
+    executor = get_executor()
+    trace = getattr(_local, 'trace', None)
+    started = time.monotonic()
+    deadline = started + FETCH_DEADLINE
+    hedge_at = started + HEDGE_DELAY
+    
+    plans = {asset_class: list(providers) for asset_class, providers in PROVIDERS.items()}
+    futures: Dict[Future, Tuple[str, RateProvider]] = {}
+    launched = {asset_class: 0 for asset_class in plans}
+    first_success: Dict[str, float] = {}
+    
+    def launch(asset_class: str, count: int) -> None:
+        # allow() у полуоткрытого автомата расходует единственный пробный запрос,
+        # поэтому спрашиваем его только у провайдера, который действительно запускается
+        plan = plans[asset_class]
+        while count > 0 and launched[asset_class] < len(plan):
+            provider = plan[launched[asset_class]]
+            launched[asset_class] += 1
+            if provider.breaker.allow():
+                futures[executor.submit(quote_in_trace, trace, provider, PROVIDER_TIMEOUT)] = (asset_class, provider)
+                count -= 1
+    
+    for asset_class, plan in plans.items():
+        launch(asset_class, len(plan) if HEDGE_DELAY <= 0 else 1)
+    
+    while True:
+        now = time.monotonic()
+        settled = True
+        
+        for asset_class, plan in plans.items():
+            class_futures = [f for f, (c, _) in futures.items() if c == asset_class]
+            succeeded = any(f.done() and f.exception() is None for f in class_futures)
+            running = any(not f.done() for f in class_futures)
+            
+            if succeeded:
+                first_success.setdefault(asset_class, now)
+                if running and now - first_success[asset_class] < AGGREGATION_WINDOW:
+                    settled = False
+                continue
+            
+            if launched[asset_class] < len(plan) and (not running or now >= hedge_at):
+                launch(asset_class, len(plan))
+                running = True
+            
+            if running:
+                settled = False
+        
+        if settled or now >= deadline:
+            break
+        
+        wakeups = [deadline]
+        if now < hedge_at:
+            wakeups.append(hedge_at)
+        wakeups.extend(t + AGGREGATION_WINDOW for t in first_success.values() if t + AGGREGATION_WINDOW > now)
+        running_futures = [f for f in futures if not f.done()]
+        wait(running_futures, timeout=max(0.0, min(wakeups) - now), return_when=FIRST_COMPLETED)
+    
+    collected: Dict[str, List[Tuple[str, Dict[str, float]]]] = {asset_class: [] for asset_class in plans}
+    errors: Dict[Tuple[str, str], str] = {}
+    
+    for future, (asset_class, provider) in futures.items():
+        if not future.done():
+            errors[asset_class, provider.name] = f'no answer after {time.monotonic() - started:.2f}s'
+        elif future.exception() is not None:
+            errors[asset_class, provider.name] = str(future.exception())
+        else:
+            collected[asset_class].append((provider.name, future.result()))
+    
+    for asset_class in plans:
+        if not any(c == asset_class for c, _ in futures.values()):
+            errors[asset_class, '*'] = 'all providers are circuit-broken'
+    
+    results = {
+        asset_class: (aggregate_quotes([quotes for _, quotes in answers]), [name for name, _ in answers])
+        for asset_class, answers in collected.items()
+        if answers
+    }
+    
+    if errors:
+        print(json.dumps({
+            'event': 'rates_provider_errors',
+            'errors': {f'{asset_class}/{name}': error for (asset_class, name), error in errors.items()}
+        }))
+    
+    return results, errors
+
+
+def quote_in_trace(trace: Optional['Trace'], provider: RateProvider, timeout: float) -> Dict[str, float]:
+    # Запросы к провайдерам идут в потоках пула: замеры относятся к трассировке вызова, запустившего обновление
+    _local.trace = trace
+    try:
+        return provider.quote(timeout)
+    finally:
+        _local.trace = None
+
+
+def aggregate_quotes(answers: List[Dict[str, float]]) -> Dict[str, float]:
+    '''Сводит котировки нескольких провайдеров медианой, отбрасывая выбросы'''
+    
+    assets = dict.fromkeys(asset for quotes in answers for asset in quotes)
+    aggregated = {}
+    
+    for asset in assets:
+        values = [quotes[asset] for quotes in answers if quotes.get(asset)]
+        if not values:
+            continue
+        
+        center = median(values)
+        inliers = [v for v in values if abs(v - center) <= center * MAX_DEVIATION]
+        aggregated[asset] = median(inliers) if inliers else center
+    
+    return aggregated
+
+
+def median(values: List[float]) -> float:
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def get_executor():
+    '''
+    Пул потоков для запросов к провайдерам. Создается при первом обновлении, а не
+    при импорте: concurrent.futures тянет logging и заметно удлиняет холодный старт.
+    Вызывается только под _refresh_lock.
+    '''
+    
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='rates')
+    return _executor
+
+
+def fetch_json(url: str, timeout: float) -> Any:
+    # urllib.request (с http.client, email и ssl) - самый тяжелый импорт функции,
+    # а нужен только при обновлении снимка
+    import urllib.request
+    
+    req = urllib.request.Request(url)
+    req.add_header('Accept', 'application/json')
+    
+    with Span('upstream', url.split('?', 1)[0]):
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            body = response.read()
+    return loads(body)
 
 
-def fetch_crypto_rates() -> Dict[str, float]:
-    '''Получает курсы криптовалют к RUB через CoinGecko API'''
+def fetch_coingecko(timeout: float) -> Dict[str, float]:
+    '''Курсы криптовалют к RUB через CoinGecko API'''
     
     crypto_ids = {
         'bitcoin': 'BTC',
@@ -79,94 +1139,452 @@ def fetch_crypto_rates() -> Dict[str, float]:
     }
     
     ids_param = ','.join(crypto_ids.keys())
-    url = f'https://api.coingecko.com/api/v3/simple/price?ids={ids_param}&vs_currencies=rub'
+    data = fetch_json(f'{COINGECKO_URL}?ids={ids_param}&vs_currencies=rub', timeout)
     
-    req = urllib.request.Request(url)
-    req.add_header('Accept', 'application/json')
+    return {
+        symbol: data[coin_id]['rub']
+        for coin_id, symbol in crypto_ids.items()
+        if coin_id in data and 'rub' in data[coin_id]
+    }
+
+
+def fetch_cryptocompare(timeout: float) -> Dict[str, float]:
+    '''Курсы криптовалют к RUB через CryptoCompare API'''
+    
+    symbols = ','.join(CRYPTO_ASSETS)
+    data = fetch_json(f'{CRYPTOCOMPARE_URL}?fsyms={symbols}&tsyms=RUB', timeout)
+    
+    return {
+        symbol: data[symbol]['RUB']
+        for symbol in CRYPTO_ASSETS
+        if symbol in data and 'RUB' in data[symbol]
+    }
+
+
+def fetch_exchangerate_api(timeout: float) -> Dict[str, float]:
+    '''Курсы фиатных валют к RUB через exchangerate-api'''
+    
+    rates_data = fetch_json(EXCHANGERATE_URL, timeout).get('rates', {})
+    
+    return {
+        currency: 1 / rates_data[currency]
+        for currency in FIAT_ASSETS
+        if rates_data.get(currency)
+    }
+
+
+def fetch_cbr(timeout: float) -> Dict[str, float]:
+    '''Официальные курсы ЦБ РФ через зеркало cbr-xml-daily'''
+    
+    valute = fetch_json(CBR_URL, timeout).get('Valute', {})
+    
+    return {
+        currency: valute[currency]['Value'] / valute[currency]['Nominal']
+        for currency in FIAT_ASSETS
+        if currency in valute
+    }
+
+
+_fixture_cache: Dict[str, Any] = {'mtime': None, 'data': {}}
+
+
+def fetch_fixture(asset_class: str) -> Callable[[float], Dict[str, float]]:
+    '''Провайдер из локального JSON-файла для офлайн-режима и тестов'''
+    
+    def fetch(timeout: float) -> Dict[str, float]:
+        mtime = os.path.getmtime(FIXTURE_PATH)
+        if _fixture_cache['mtime'] != mtime:
+            with open(FIXTURE_PATH) as f:
+                _fixture_cache['data'] = json.load(f)
+            _fixture_cache['mtime'] = mtime
+        return dict(_fixture_cache['data'].get(asset_class, {}))
     
-    with urllib.request.urlopen(req, timeout=10) as response:
-        data = json.loads(response.read().decode())
+    return fetch
+
+
+def expand_rates(quotes: Dict[str, float]) -> Dict[str, float]:
+    '''Разворачивает курсы базовых активов в курсы всех инструментов таблицы INSTRUMENTS'''
     
-    rates = {}
-    for coin_id, symbol in crypto_ids.items():
-        if coin_id in data and 'rub' in data[coin_id]:
-            rate = data[coin_id]['rub']
-            rates[symbol] = rate
+    return {
+        code: quotes[base] if multiplier == 1 else quotes[base] * multiplier
+        for code, base, multiplier in zip(INSTRUMENT_CODES, INSTRUMENT_BASES, INSTRUMENT_MULTIPLIERS)
+        if base in quotes
+    }
+
+
+PROVIDER_FETCHERS: Dict[str, Dict[str, Callable[[float], Dict[str, float]]]] = {
+    'crypto': {
+        'coingecko': fetch_coingecko,
+        'cryptocompare': fetch_cryptocompare,
+        'file': fetch_fixture('crypto')
+    },
+    'fiat': {
+        'exchangerate': fetch_exchangerate_api,
+        'cbr': fetch_cbr,
+        'file': fetch_fixture('fiat')
+    }
+}
+
+
+def build_providers(asset_class: str, default: str) -> List[RateProvider]:
+    '''Собирает цепочку провайдеров класса из RATES_<CLASS>_PROVIDERS в порядке приоритета'''
+    
+    names = os.environ.get(f'RATES_{asset_class.upper()}_PROVIDERS', default)
+    fetchers = PROVIDER_FETCHERS[asset_class]
+    return [RateProvider(name, fetchers[name]) for name in (n.strip() for n in names.split(',')) if name]
+
+
+PROVIDERS: Dict[str, List[RateProvider]] = {
+    'crypto': build_providers('crypto', 'coingecko,cryptocompare'),
+    'fiat': build_providers('fiat', 'exchangerate,cbr')
+}
+
+
+class ConnectionPool:
+    '''
+    Пул соединений с БД, переживающий вызовы в теплом контейнере.
+    Соединение возвращается в пул без открытой транзакции и без сессионного
+    состояния, поэтому пул совместим с PgBouncer в режиме transaction.
+    '''
+    
+    def __init__(self, dsn: str, max_size: int, idle_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'discarded': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._metrics_logged_at = time.monotonic()
+    
+    def getconn(self, timeout: float = POOL_ACQUIRE_TIMEOUT):
+        started = time.monotonic()
+        
+        while True:
+            conn, idle_for = self._checkout(started, timeout)
+            
+            if conn is None:
+                try:
+                    import psycopg2
+                    with Span('db_connect'):
+                        conn = psycopg2.connect(self.dsn, cursor_factory=timed_cursor_class())
+                except Exception:
+                    self._forget()
+                    raise
+                return conn
             
-            if symbol == 'USDT':
-                rates['USDT-TRC20'] = rate
-                rates['USDT-BEP20'] = rate
-                rates['USDT-ERC20'] = rate
-                rates['USDT-ARB'] = rate
-                rates['USDT-TON'] = rate
-                rates['USDT-MATIC'] = rate
-            elif symbol == 'ETH':
-                rates['ETH-ARB'] = rate
-                rates['ETH-BEP20'] = rate
-            elif symbol == 'USDC':
-                rates['USDC-ERC20'] = rate
-                rates['USDC-SOL'] = rate
-                rates['USDC-MATIC'] = rate
+            if idle_for < self.healthcheck_after or self._is_healthy(conn):
+                return conn
+            
+            self._discard(conn)
+    
+    def putconn(self, conn) -> None:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        
+        self._maybe_log_metrics()
+    
+    def _checkout(self, started: float, timeout: float):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self.stats['hits'] += 1
+                    return conn, now - released_at
+                
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.stats['misses'] += 1
+                    return None, 0.0
+                
+                remaining = timeout - (now - started)
+                if remaining <= 0:
+                    raise TimeoutError(f'No free database connection after {timeout}s')
+                
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+                self.stats['wait_time'] += time.monotonic() - now
+    
+    def _evict_idle(self, now: float) -> None:
+        # Самые старые соединения лежат в начале списка
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self.stats['discarded'] += 1
+            conn.close()
+    
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.stats['discarded'] += 1
+        self._forget()
+    
+    def _forget(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    def _maybe_log_metrics(self) -> None:
+        now = time.monotonic()
+        if now - self._metrics_logged_at < POOL_METRICS_INTERVAL:
+            return
+        self._metrics_logged_at = now
+        with self._cond:
+            print(json.dumps({'event': 'db_pool_metrics', 'size': self._size, 'idle': len(self._idle), **self.stats}))
+
+
+_pool = ConnectionPool(DSN, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_HEALTHCHECK_AFTER)
+
+
+def get_connection():
+    '''Берет соединение из пула контейнера'''
+    with Span('db_acquire'):
+        return _pool.getconn()
+
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул, откатывая незавершенную транзакцию'''
+    _pool.putconn(conn)
+
+
+_timed_cursor = None
+
+
+def timed_cursor_class():
+    '''Класс курсора соединений пула: каждый запрос - отдельный участок sql в трассировке вызова'''
     
-    return rates
+    global _timed_cursor
+    if _timed_cursor is None:
+        import psycopg2.extensions
+        
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                with Span('sql', query):
+                    return super().execute(query, vars)
+            
+            def executemany(self, query, vars_list):
+                with Span('sql', query):
+                    return super().executemany(query, vars_list)
+        
+        _timed_cursor = TimedCursor
+    return _timed_cursor
+
 
+_history = RateHistory(HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL) if DSN else None
+if _history is not None:
+    atexit.register(_history.flush)
 
-def fetch_fiat_rates() -> Dict[str, float]:
-    '''Получает курсы фиатных валют к RUB через exchangerate-api'''
+
+# Общий слой запросов и ответов. Функции деплоятся по отдельности, поэтому
+# блок одинаково скопирован в каждую index.py и меняется во всех сразу
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+class Request:
+    '''Событие вызова: заголовки в нижнем регистре, тело разбирается один раз и только по требованию'''
     
-    url = 'https://api.exchangerate-api.com/v4/latest/RUB'
+    __slots__ = ('event', 'method', 'params', 'headers', '_body')
     
-    req = urllib.request.Request(url)
-    req.add_header('Accept', 'application/json')
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        self._body = None
     
-    with urllib.request.urlopen(req, timeout=10) as response:
-        data = json.loads(response.read().decode())
-    
-    rates_data = data.get('rates', {})
-    
-    fiat_rates = {}
-    
-    if 'USD' in rates_data:
-        usd_rate = 1 / rates_data['USD']
-        fiat_rates['USD-REVOLUT'] = usd_rate
-        fiat_rates['USD-WISE'] = usd_rate
-        fiat_rates['USD-CARD'] = usd_rate
-    
-    if 'EUR' in rates_data:
-        eur_rate = 1 / rates_data['EUR']
-        fiat_rates['EUR-CARD'] = eur_rate
-        fiat_rates['EUR-REVOLUT'] = eur_rate
-        fiat_rates['EUR-WISE'] = eur_rate
-        fiat_rates['EUR-PAYSERA'] = eur_rate
-        fiat_rates['EUR-SEPA'] = eur_rate
-    
-    if 'KZT' in rates_data:
-        kzt_rate = 1 / rates_data['KZT']
-        fiat_rates['KZT-KASPI'] = kzt_rate
-        fiat_rates['KZT-HALYK'] = kzt_rate
-        fiat_rates['KZT-JUSAN'] = kzt_rate
-        fiat_rates['KZT-ALTYN'] = kzt_rate
-        fiat_rates['KZT-FREEDOM'] = kzt_rate
-    
-    if 'UAH' in rates_data:
-        uah_rate = 1 / rates_data['UAH']
-        fiat_rates['UAH-MONO'] = uah_rate
-        fiat_rates['UAH-PRIVAT'] = uah_rate
-        fiat_rates['UAH-ABANK'] = uah_rate
-        fiat_rates['UAH-PUMB'] = uah_rate
-        fiat_rates['UAH-IZI'] = uah_rate
-        fiat_rates['UAH-SENSE'] = uah_rate
-        fiat_rates['UAH-TRANSFER'] = uah_rate
-    
-    fiat_rates['RUB-SBP'] = 1
-    fiat_rates['RUB-TINKOFF'] = 1
-    fiat_rates['RUB-VTB'] = 1
-    fiat_rates['RUB-PSB'] = 1
-    fiat_rates['RUB-SBER'] = 1
-    fiat_rates['RUB-ALFA'] = 1
-    fiat_rates['RUB-RAIF'] = 1
-    fiat_rates['RUB-POST'] = 1
-    fiat_rates['RUB-MTS'] = 1
-    fiat_rates['RUB-GPB'] = 1
-    
-    return fiat_rates
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            with Span('json_decode'):
+                self._body = loads(self.event.get('body') or '{}')
+        return self._body
+    
+    @property
+    def action(self) -> Optional[str]:
+        return (self.params if self.method == 'GET' else self.body).get('action')
+
+
+_local = threading.local()
+
+
+class Trace:
+    '''Замеры одного вызова: (участок, мс, подробность) в порядке завершения'''
+    
+    __slots__ = ('action', 'started', 'spans')
+    
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = []
+    
+    def finish(self, status: int) -> float:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        print(json.dumps({
+            'event': 'request_timing',
+            'action': self.action,
+            'status': status,
+            'total_ms': round(total_ms, 2),
+            'spans': [
+                {'name': name, 'ms': round(ms, 2), **({'detail': span_detail(detail)} if detail is not None else {})}
+                for name, ms, detail in self.spans
+            ]
+        }))
+        return total_ms
+    
+    def server_timing(self, total_ms: float) -> str:
+        totals = {}
+        for name, ms, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + ms
+        return ', '.join([f'{name};dur={ms:.1f}' for name, ms in totals.items()] + [f'total;dur={total_ms:.1f}'])
+
+
+class Span:
+    '''Замер участка текущего вызова; вне трассированного вызова стоит одно обращение к thread-local'''
+    
+    __slots__ = ('name', 'detail', 'trace', 'started')
+    
+    def __init__(self, name: str, detail=None):
+        self.name = name
+        self.detail = detail
+        self.trace = getattr(_local, 'trace', None)
+    
+    def __enter__(self):
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.spans.append((self.name, (time.perf_counter() - self.started) * 1000, self.detail))
+
+
+def span_detail(detail) -> str:
+    # Текст SQL сжимается до начала запроса; значения execute_values после VALUES в лог не попадают
+    if isinstance(detail, bytes):
+        detail = detail.decode(errors='replace')
+    return ' '.join(str(detail).split()).split(' VALUES ', 1)[0][:120]
+
+
+def traced(request: 'Request', action: Optional[str], call: Callable[[], dict]) -> dict:
+    '''Выполняет действие, для выборки вызовов (TRACE_SAMPLE_RATE) записывая замеры его участков'''
+    
+    forced = TRACE_SERVER_TIMING and request.headers.get('x-trace') == '1'
+    if not forced and int.from_bytes(os.urandom(2), 'big') >= TRACE_SAMPLE_RATE * 65536:
+        return call()
+    
+    trace = _local.trace = Trace(action or 'default')
+    try:
+        response = call()
+    except Exception:
+        trace.finish(500)
+        raise
+    finally:
+        _local.trace = None
+    
+    total_ms = trace.finish(response['statusCode'])
+    if not TRACE_SERVER_TIMING:
+        return response
+    return {
+        **response,
+        'headers': {**response['headers'], 'Server-Timing': trace.server_timing(total_ms), 'Timing-Allow-Origin': '*'}
+    }
+
+
+def dispatch(event: dict, routes: dict, preflight: dict) -> dict:
+    '''Маршрут по методу и action; исключение действия превращается в ответ 500'''
+    
+    if event.get('httpMethod') == 'OPTIONS':
+        return preflight
+    
+    request = Request(event)
+    actions = routes.get(request.method)
+    if actions is None:
+        return error_response('Method not allowed', 405)
+    
+    try:
+        name = request.action
+        action = actions.get(name)
+        if action is None:
+            return error_response('Invalid action', 400)
+        return traced(request, name, lambda: action(request))
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+def preflight_response(methods: str, headers: str = 'Content-Type') -> dict:
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': headers,
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': ''
+    }
+
+
+def json_default(value):
+    # date/datetime и Decimal распознаются по методам, чтобы не импортировать их модули ради isinstance
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'as_integer_ratio'):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(data) -> str:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    loads = orjson.loads
+else:
+    def dumps(data) -> str:
+        return json.dumps(data, default=json_default, ensure_ascii=False)
+    
+    loads = json.loads
+
+
+def encode_body(data: dict) -> str:
+    with Span('json_encode'):
+        return dumps(data)
+
+
+def success_response(data: dict) -> dict:
+    return {'statusCode': 200, 'headers': JSON_HEADERS, 'body': encode_body({'success': True, **data})}
+
+
+def error_response(message: str, status_code: int = 400) -> dict:
+    return {'statusCode': status_code, 'headers': JSON_HEADERS, 'body': encode_body({'success': False, 'error': message})}
+
+
+PREFLIGHT = preflight_response('GET, OPTIONS', 'Content-Type, If-None-Match')
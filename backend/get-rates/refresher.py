@@ -0,0 +1,41 @@
+'''
+Долгоживущий обновлятель курсов для get-rates.
+
+Опрашивает провайдеров с заданным периодом и разбросом и публикует снимок в
+хранилище RATES_SNAPSHOT_STORE (file или postgres), откуда его читают вызовы
+функции. Замена триггеру-таймеру там, где есть постоянно работающий процесс:
+
+    RATES_SNAPSHOT_STORE=postgres DATABASE_URL=postgresql://... python backend/get-rates/refresher.py
+    RATES_SNAPSHOT_STORE=file RATES_SNAPSHOT_PATH=/var/run/rates.json \
+        python backend/get-rates/refresher.py --interval 15 --jitter 3
+'''
+
+import argparse
+import sys
+
+import index
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interval', type=float, default=index.REFRESH_INTERVAL)
+    parser.add_argument('--jitter', type=float, default=index.REFRESH_JITTER)
+    parser.add_argument('--once', action='store_true', help='опубликовать один снимок и выйти')
+    args = parser.parse_args()
+    
+    if index.SNAPSHOT_STORE not in ('file', 'postgres'):
+        parser.error('RATES_SNAPSHOT_STORE must be file or postgres')
+    
+    if args.once:
+        index.refresh_store()
+        return 0
+    
+    try:
+        index.run_refresher(args.interval, args.jitter)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
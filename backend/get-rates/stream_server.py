@@ -0,0 +1,272 @@
+'''
+Поток курсов по Server-Sent Events для страниц обмена вместо опроса get-rates.
+
+Процесс раз в STREAM_POLL секунд берет снимок через get_rates_snapshot() из
+index.py (из хранилища обновлятеля или от провайдеров, как сама функция) и,
+когда версия снимка меняется, один раз кодирует событие с изменившимися
+инструментами и раздает его всем подключенным клиентам.
+
+Протокол (GET /stream, EventSource):
+    event: snapshot - все курсы; первым событием и после пропуска дельт
+    event: delta    - {since, version, changed, removed} относительно предыдущей версии
+    id: <версия>    - браузер пришлет ее в Last-Event-ID при переподключении
+    : ping          - каждые STREAM_HEARTBEAT секунд, чтобы прокси не рвали соединение
+
+Неотправленные данные каждого клиента ограничены STREAM_BUFFER_LIMIT байт сверх
+буфера сокета. Пока клиент не успевает читать, события ему пропускаются, а после
+разгрузки буфера уходит один актуальный снимок вместо пропущенных дельт; клиент,
+отстающий дольше STREAM_WRITE_TIMEOUT секунд, отключается. GET /healthz отдает
+счетчики сервера.
+
+    RATES_SNAPSHOT_STORE=postgres DATABASE_URL=postgresql://... python backend/get-rates/stream_server.py --port 8090
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+
+import index
+
+STREAM_POLL = float(os.environ.get('STREAM_POLL', '1'))
+STREAM_BUFFER_LIMIT = int(os.environ.get('STREAM_BUFFER_LIMIT', '65536'))
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', '15'))
+STREAM_WRITE_TIMEOUT = float(os.environ.get('STREAM_WRITE_TIMEOUT', '10'))
+STREAM_MAX_CLIENTS = int(os.environ.get('STREAM_MAX_CLIENTS', '20000'))
+STREAM_METRICS_INTERVAL = float(os.environ.get('STREAM_METRICS_INTERVAL', '60'))
+STREAM_RETRY_MS = int(os.environ.get('STREAM_RETRY_MS', '3000'))
+
+STREAM_HEADERS = (
+    'HTTP/1.1 200 OK\r\n'
+    'Content-Type: text/event-stream\r\n'
+    'Cache-Control: no-store\r\n'
+    'Connection: keep-alive\r\n'
+    'Access-Control-Allow-Origin: *\r\n'
+    'X-Accel-Buffering: no\r\n'
+    '\r\n'
+    f'retry: {STREAM_RETRY_MS}\n\n'
+).encode()
+PING = b': ping\n\n'
+
+
+def encode_event(name: str, version: str, data: dict) -> bytes:
+    return f'event: {name}\nid: {version}\ndata: {index.dumps(data)}\n\n'.encode()
+
+
+def plain_response(status: str, body: dict) -> bytes:
+    payload = json.dumps(body).encode()
+    return (
+        f'HTTP/1.1 {status}\r\n'
+        'Content-Type: application/json\r\n'
+        'Access-Control-Allow-Origin: *\r\n'
+        f'Content-Length: {len(payload)}\r\n'
+        'Connection: close\r\n'
+        '\r\n'
+    ).encode() + payload
+
+
+class Client:
+    '''Подключенный клиент: транспорт и момент, с которого он не успевает читать'''
+    
+    __slots__ = ('transport', 'lagging_since')
+    
+    def __init__(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.lagging_since = None
+
+
+class Broadcaster:
+    '''
+    Последний снимок, его закодированное полное событие и подключенные клиенты.
+    Событие пишется в транспорты всех клиентов прямо из цикла рассылки, без
+    очереди и пробуждения задачи на клиента: чтение сокета клиента нужно только
+    для того, чтобы заметить отключение.
+    '''
+    
+    def __init__(self):
+        self.clients = set()
+        self.snapshot = None
+        self.full_event = b''
+        self.stats = {'connected': 0, 'rejected': 0, 'broadcasts': 0, 'lagging': 0, 'resyncs': 0, 'slow_disconnects': 0}
+    
+    def publish(self, snapshot: dict) -> None:
+        previous = self.snapshot
+        rates = snapshot['rates']
+        meta = {'fetched_at': snapshot['fetched_at'], 'missing': snapshot['missing']}
+        
+        self.snapshot = snapshot
+        self.full_event = encode_event('snapshot', snapshot['version'], {'version': snapshot['version'], 'rates': rates, **meta})
+        if previous is None:
+            return
+        
+        changed = {code: rate for code, rate in rates.items() if previous['rates'].get(code) != rate}
+        removed = [code for code in previous['rates'] if code not in rates]
+        if not changed and not removed:
+            return
+        
+        self.stats['broadcasts'] += 1
+        self.fan_out(encode_event('delta', snapshot['version'], {
+            'since': previous['version'],
+            'version': snapshot['version'],
+            'changed': changed,
+            'removed': removed,
+            **meta
+        }))
+    
+    def fan_out(self, event: bytes) -> None:
+        now = time.monotonic()
+        for client in list(self.clients):
+            self.send(client, event, now)
+    
+    def send(self, client: Client, event: bytes, now: float) -> None:
+        transport = client.transport
+        
+        if transport.get_write_buffer_size() > STREAM_BUFFER_LIMIT:
+            # Клиент не успевает читать: события ему пропускаются, а когда буфер
+            # разгрузится, уйдет актуальный снимок целиком вместо пропущенных дельт
+            if client.lagging_since is None:
+                client.lagging_since = now
+                self.stats['lagging'] += 1
+            elif now - client.lagging_since > STREAM_WRITE_TIMEOUT:
+                self.stats['slow_disconnects'] += 1
+                self.clients.discard(client)
+                transport.abort()
+            return
+        
+        if client.lagging_since is not None:
+            client.lagging_since = None
+            self.stats['resyncs'] += 1
+            event = self.full_event
+        transport.write(event)
+    
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        
+        lines = request.decode('latin-1').split('\r\n')
+        method, _, target = lines[0].partition(' ')
+        path = target.split(' ', 1)[0].split('?', 1)[0]
+        headers = {
+            name.strip().lower(): value.strip()
+            for name, _, value in (line.partition(':') for line in lines[1:] if line)
+        }
+        
+        if method != 'GET' or path not in ('/stream', '/healthz'):
+            writer.write(plain_response('404 Not Found', {'success': False, 'error': 'Not found'}))
+        elif path == '/healthz':
+            writer.write(plain_response('200 OK', {
+                'success': True,
+                'clients': len(self.clients),
+                'version': self.snapshot['version'] if self.snapshot else None,
+                **self.stats
+            }))
+        elif len(self.clients) >= STREAM_MAX_CLIENTS or self.snapshot is None:
+            self.stats['rejected'] += 1
+            writer.write(plain_response('503 Service Unavailable', {'success': False, 'error': 'Stream is not available'}))
+        else:
+            await self.stream(headers, reader, writer)
+            return
+        
+        try:
+            await asyncio.wait_for(writer.drain(), STREAM_WRITE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        writer.close()
+    
+    async def stream(self, headers: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        client = Client(writer.transport)
+        writer.write(STREAM_HEADERS)
+        if headers.get('last-event-id') != self.snapshot['version']:
+            writer.write(self.full_event)
+        
+        self.clients.add(client)
+        self.stats['connected'] += 1
+        
+        try:
+            # Клиент SSE ничего не присылает: чтение заканчивается, когда он отключается
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, asyncio.CancelledError):
+            # CancelledError - остановка сервера с подключенными клиентами
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+    
+    async def heartbeat(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.fan_out(PING)
+    
+    async def poll_snapshots(self, interval: float) -> None:
+        loop = asyncio.get_running_loop()
+        metrics_logged_at = time.monotonic()
+        
+        while True:
+            try:
+                # Обновление снимка может ходить к провайдерам или в БД: не в цикле событий
+                snapshot = await loop.run_in_executor(None, index.get_rates_snapshot)
+                if self.snapshot is None or snapshot['version'] != self.snapshot['version']:
+                    self.publish(snapshot)
+            except Exception as e:
+                print(json.dumps({'event': 'stream_snapshot_failed', 'error': str(e)}))
+            
+            if time.monotonic() - metrics_logged_at >= STREAM_METRICS_INTERVAL:
+                metrics_logged_at = time.monotonic()
+                print(json.dumps({'event': 'stream_metrics', 'clients': len(self.clients), **self.stats}))
+            
+            await asyncio.sleep(interval)
+
+
+async def serve(host: str, port: int, poll: float) -> None:
+    broadcaster = Broadcaster()
+    server = await asyncio.start_server(broadcaster.serve_client, host, port, backlog=4096)
+    tasks = [
+        asyncio.create_task(broadcaster.poll_snapshots(poll)),
+        asyncio.create_task(broadcaster.heartbeat(STREAM_HEARTBEAT))
+    ]
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    
+    print(json.dumps({'event': 'stream_started', 'address': [str(a) for a in server.sockets[0].getsockname()[:2]]}), flush=True)
+    async with server:
+        await stop.wait()
+    for task in tasks:
+        task.cancel()
+
+
+def raise_file_limit() -> None:
+    '''Каждый клиент - открытый сокет: поднимаем мягкий лимит дескрипторов до жесткого'''
+    
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('STREAM_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('STREAM_PORT', '8090')))
+    parser.add_argument('--poll', type=float, default=STREAM_POLL, help='период проверки снимка, секунд')
+    args = parser.parse_args()
+    
+    raise_file_limit()
+    asyncio.run(serve(args.host, args.port, args.poll))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,48 +1,54 @@
+import base64
+import binascii
+import hashlib
+import hmac
 import json
 import os
-import psycopg2
-import hashlib
-import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Трассировка: доля вызовов, для которых пишутся замеры участков (event request_timing),
+# и заголовок Server-Timing у трассированных ответов (тогда X-Trace: 1 трассирует вызов всегда)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING') == '1'
 
 DSN = os.environ.get('DATABASE_URL')
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE: psycopg2 импортируется лениво при первом соединении
+TRANSACTION_STATUS_IDLE = 0
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_METRICS_INTERVAL = float(os.environ.get('DB_POOL_METRICS_INTERVAL', '60'))
+
+# Параметры scrypt для новых хэшей; хэши со старыми параметрами пересчитываются при входе
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_KDF_WORKERS = int(os.environ.get('PASSWORD_KDF_WORKERS', '2'))
+PASSWORD_CACHE_SIZE = int(os.environ.get('PASSWORD_CACHE_SIZE', '1000'))
+PASSWORD_CACHE_TTL = float(os.environ.get('PASSWORD_CACHE_TTL', '300'))
+
+# Ключи подписи токенов "kid:секрет,kid:секрет": первым подписываются новые токены,
+# остальные принимаются до истечения выданных ими токенов
+AUTH_TOKEN_KEYS = {
+    kid.strip(): secret.strip().encode()
+    for kid, _, secret in (item.partition(':') for item in os.environ.get('AUTH_TOKEN_KEYS', '').split(','))
+    if kid.strip() and secret.strip()
+}
+AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', str(7 * 86400)))
 
 
 def handler(event: dict, context) -> dict:
     '''Регистрация и авторизация партнеров'''
-    
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    if method != 'POST':
-        return error_response('Method not allowed', 405)
-    
-    try:
-        body = json.loads(event.get('body', '{}'))
-        action = body.get('action')
-        
-        if action == 'register':
-            return register_partner(body)
-        elif action == 'login':
-            return login_partner(body)
-        elif action == 'change_password':
-            return change_password(body)
-        else:
-            return error_response('Invalid action', 400)
-            
-    except Exception as e:
-        return error_response(str(e), 500)
+    return dispatch(event, ROUTES, PREFLIGHT)
 
 
 def register_partner(data: dict) -> dict:
@@ -57,10 +63,10 @@ def register_partner(data: dict) -> dict:
     if len(password) < 6:
         return error_response('Пароль должен содержать минимум 6 символов', 400)
     
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    password_hash = hash_password(password)
     partner_code = generate_partner_code()
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
@@ -81,13 +87,14 @@ def register_partner(data: dict) -> dict:
         partner_id, partner_code = cur.fetchone()
         conn.commit()
         
-        token = generate_token(partner_id)
+        token, expires_at = generate_token(partner_id)
         
         return success_response({
             'partner_id': partner_id,
             'email': email,
             'partner_code': partner_code,
-            'token': token
+            'token': token,
+            'token_expires_at': expires_at
         })
         
     except Exception as e:
@@ -95,11 +102,14 @@ def register_partner(data: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
 def login_partner(data: dict) -> dict:
-    '''Авторизация партнера'''
+    '''
+    Авторизация партнера. KDF считается без соединения из пула: хэш читается,
+    соединение возвращается, и только для перехэширования старого хэша берется снова.
+    '''
     
     email = data.get('email', '').strip().lower()
     password = data.get('password', '')
@@ -107,111 +117,721 @@ def login_partner(data: dict) -> dict:
     if not email or not password:
         return error_response('Email и пароль обязательны', 400)
     
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-    
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
-            "SELECT id, email, partner_code, balance, commission_rate FROM partners WHERE email = %s AND password_hash = %s",
-            (email, password_hash)
+            "SELECT id, email, partner_code, balance, commission_rate, password_hash FROM partners WHERE email = %s",
+            (email,)
         )
         
         result = cur.fetchone()
-        if not result:
-            return error_response('Неверный email или пароль', 401)
-        
-        partner_id, email, partner_code, balance, commission_rate = result
-        
-        token = generate_token(partner_id)
-        
-        return success_response({
-            'partner_id': partner_id,
-            'email': email,
-            'partner_code': partner_code,
-            'balance': float(balance),
-            'commission_rate': float(commission_rate),
-            'token': token
-        })
         
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+    
+    # Для неизвестного email KDF все равно считается, чтобы время ответа не выдавало наличие аккаунта
+    valid, needs_rehash = verify_password(password, result[5] if result else dummy_password_hash())
+    if not result or not valid:
+        return error_response('Неверный email или пароль', 401)
+    
+    partner_id, email, partner_code, balance, commission_rate, password_hash = result
+    
+    if needs_rehash:
+        rehashed = hash_password(password)
+        conn = get_connection()
+        cur = conn.cursor()
+        
+        try:
+            # Условие на старый хэш не дает затереть пароль, смененный за время KDF
+            cur.execute(
+                "UPDATE partners SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                (rehashed, partner_id, password_hash)
+            )
+            conn.commit()
+            
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            cur.close()
+            release_connection(conn)
+    
+    token, expires_at = generate_token(partner_id)
+    
+    return success_response({
+        'partner_id': partner_id,
+        'email': email,
+        'partner_code': partner_code,
+        'balance': balance,
+        'commission_rate': commission_rate,
+        'token': token,
+        'token_expires_at': expires_at
+    })
 
 
-def change_password(data: dict) -> dict:
-    '''Смена пароля партнера'''
+def change_password(data: dict, headers: dict) -> dict:
+    '''
+    Смена пароля партнера; партнер определяется по токену. Оба KDF считаются без
+    соединения из пула, а новый хэш записывается условным UPDATE по прочитанному
+    старому, поэтому строка блокируется только на время самой записи. Прочие
+    токены партнера отзываются, в ответе возвращается новый.
+    '''
     
-    partner_id = data.get('partner_id')
     old_password = data.get('old_password', '')
     new_password = data.get('new_password', '')
     
-    if not partner_id or not old_password or not new_password:
+    if not old_password or not new_password:
         return error_response('Все поля обязательны', 400)
     
     if len(new_password) < 6:
         return error_response('Новый пароль должен содержать минимум 6 символов', 400)
     
-    old_password_hash = hashlib.sha256(old_password.encode()).hexdigest()
-    new_password_hash = hashlib.sha256(new_password.encode()).hexdigest()
+    claims = verify_token(bearer_token(headers))
+    if claims is None:
+        return error_response('Требуется авторизация', 401)
+    partner_id = claims['sub']
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
-            "SELECT id FROM partners WHERE id = %s AND password_hash = %s",
-            (partner_id, old_password_hash)
+            """SELECT 1 FROM revoked_tokens
+               WHERE jti = %s
+                  OR (partner_id = %s AND issued_before > to_timestamp(%s)::timestamp)
+               LIMIT 1""",
+            (claims['jti'], partner_id, claims.get('iat', 0))
+        )
+        revoked = cur.fetchone() is not None
+        
+        cur.execute("SELECT password_hash FROM partners WHERE id = %s", (partner_id,))
+        result = cur.fetchone()
+        
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    if revoked:
+        return error_response('Требуется авторизация', 401)
+    
+    if not result or not verify_password(old_password, result[0])[0]:
+        return error_response('Неверный текущий пароль', 403)
+    
+    new_hash = hash_password(new_password)
+    token, expires_at = generate_token(partner_id)
+    issued_at = expires_at - AUTH_TOKEN_TTL
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            """UPDATE partners SET password_hash = %s, updated_at = CURRENT_TIMESTAMP
+               WHERE id = %s AND password_hash = %s
+               RETURNING id""",
+            (new_hash, partner_id, result[0])
         )
         
         if not cur.fetchone():
-            return error_response('Неверный текущий пароль', 401)
+            # Пароль сменили параллельно, пока считался KDF: проверка старого пароля устарела
+            conn.rollback()
+            return error_response('Пароль был изменен, повторите попытку', 409)
         
+        # Остальные сессии выходят: отзываются все токены партнера, выпущенные
+        # раньше нового, который возвращается в ответе вместо текущего
         cur.execute(
-            "UPDATE partners SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (new_password_hash, partner_id)
+            """INSERT INTO revoked_tokens (jti, partner_id, expires_at, issued_before)
+               VALUES (%s, %s, to_timestamp(%s)::timestamp, to_timestamp(%s)::timestamp)""",
+            (os.urandom(8).hex(), partner_id, expires_at, issued_at)
         )
         
         conn.commit()
         
-        return success_response({'message': 'Пароль успешно изменен'})
+        return success_response({
+            'message': 'Пароль успешно изменен',
+            'token': token,
+            'token_expires_at': expires_at
+        })
         
     except Exception as e:
         conn.rollback()
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+
+def logout_partner(headers: dict) -> dict:
+    '''Выход: токен попадает в список отозванных до истечения своего срока'''
+    
+    claims = verify_token(bearer_token(headers))
+    if claims is None:
+        return error_response('Требуется авторизация', 401)
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            """INSERT INTO revoked_tokens (jti, partner_id, expires_at)
+               VALUES (%s, %s, to_timestamp(%s)::timestamp)
+               ON CONFLICT (jti) DO NOTHING""",
+            (claims['jti'], claims['sub'], claims['exp'])
+        )
+        conn.commit()
+        
+        return success_response({'message': 'Выход выполнен'})
+        
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cur.close()
+        release_connection(conn)
 
 
 def generate_partner_code() -> str:
     '''Генерация уникального кода партнера'''
-    return 'BC' + secrets.token_hex(6).upper()
+    return 'BC' + os.urandom(6).hex().upper()
 
 
-def generate_token(partner_id: int) -> str:
-    '''Генерация токена для авторизации'''
-    return hashlib.sha256(f"{partner_id}:{secrets.token_hex(32)}".encode()).hexdigest()
+def generate_token(partner_id: int) -> Tuple[str, int]:
+    '''
+    Токен вида v1.kid.payload.sig: payload - base64url JSON с id партнера (sub),
+    временем выпуска (iat), сроком (exp) и идентификатором для отзыва (jti),
+    sig - HMAC-SHA256 ключом kid. Проверяется в partner-dashboard без обращения к БД.
+    '''
+    
+    kid, key = next(iter(_signing_keys().items()))
+    issued_at = int(time.time())
+    expires_at = issued_at + AUTH_TOKEN_TTL
+    payload = _b64url(json.dumps(
+        {'sub': partner_id, 'iat': issued_at, 'exp': expires_at, 'jti': os.urandom(8).hex()},
+        separators=(',', ':')
+    ).encode())
+    signing_input = f'v1.{kid}.{payload}'
+    signature = _b64url(hmac.new(key, signing_input.encode(), hashlib.sha256).digest())
+    return f'{signing_input}.{signature}', expires_at
 
 
-def success_response(data: dict) -> dict:
+def verify_token(token: Optional[str]) -> Optional[dict]:
+    '''Проверяет подпись и срок токена; отзыв проверяет вызывающий'''
+    
+    parts = token.split('.') if token else []
+    if len(parts) != 4 or parts[0] != 'v1':
+        return None
+    
+    _, kid, payload, signature = parts
+    key = _signing_keys().get(kid)
+    if key is None:
+        return None
+    
+    expected = _b64url(hmac.new(key, f'v1.{kid}.{payload}'.encode(), hashlib.sha256).digest())
+    if not hmac.compare_digest(expected.encode(), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+
+def bearer_token(headers: dict) -> Optional[str]:
+    value = headers.get('Authorization') or headers.get('authorization') or ''
+    return value[7:].strip() if value.startswith('Bearer ') else None
+
+
+def _signing_keys() -> dict:
+    global _ephemeral_keys
+    if AUTH_TOKEN_KEYS:
+        return AUTH_TOKEN_KEYS
+    
+    # Без настроенных ключей токены подписываются случайным ключом контейнера
+    # и не принимаются другими функциями
+    if _ephemeral_keys is None:
+        _ephemeral_keys = {'local': os.urandom(32)}
+        print(json.dumps({'event': 'auth_token_keys_missing'}))
+    return _ephemeral_keys
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def hash_password(password: str) -> str:
+    '''Хэш пароля в формате scrypt$n$r$p$соль$хэш с текущими параметрами'''
+    
+    salt = os.urandom(16)
+    derived = _run_kdf(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return '$'.join([
+        'scrypt', str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P),
+        _b64encode(salt), _b64encode(derived)
+    ])
+
+
+def verify_password(password: str, stored: str) -> Tuple[bool, bool]:
+    '''
+    Проверяет пароль по сохраненному хэшу. Возвращает (совпал, нужен_пересчет):
+    пересчет нужен для старых sha256-хэшей и хэшей с устаревшими параметрами.
+    '''
+    
+    cache_key = hmac.new(_cache_key, f'{stored}\0{password}'.encode(), hashlib.sha256).digest()
+    if _verified.get(cache_key):
+        return True, False
+    
+    if len(stored) == 64 and '$' not in stored:
+        valid = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        return valid, valid
+    
+    try:
+        scheme, n, r, p, salt, expected = stored.split('$')
+        params = (int(n), int(r), int(p))
+        salt, expected = _b64decode(salt), _b64decode(expected)
+    except (ValueError, binascii.Error):
+        return False, False
+    if scheme != 'scrypt':
+        return False, False
+    
+    valid = hmac.compare_digest(_run_kdf(password, salt, *params), expected)
+    outdated = params != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    if valid and not outdated:
+        _verified.put(cache_key, True)
+    return valid, valid and outdated
+
+
+def dummy_password_hash() -> str:
+    '''Хэш случайного пароля для выравнивания времени ответа; считается один раз на контейнер'''
+    
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(os.urandom(16).hex())
+    return _dummy_hash
+
+
+def _run_kdf(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # scrypt отпускает GIL; ограниченный пул держит не больше PASSWORD_KDF_WORKERS
+    # вычислений по 128*n*r байт памяти, остальные вызовы в контейнере продолжают работу
+    with Span('kdf'):
+        return get_kdf_executor().submit(
+            hashlib.scrypt, password.encode(), salt=salt, n=n, r=r, p=p,
+            maxmem=256 * n * r * p, dklen=32
+        ).result()
+
+
+def get_kdf_executor():
+    '''Пул для scrypt создается при первом хэшировании: импорт concurrent.futures не нужен для OPTIONS и ошибок валидации'''
+    
+    global _kdf_executor
+    if _kdf_executor is None:
+        with _kdf_executor_lock:
+            if _kdf_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _kdf_executor = ThreadPoolExecutor(max_workers=PASSWORD_KDF_WORKERS, thread_name_prefix='kdf')
+    return _kdf_executor
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+class VerificationCache:
+    '''
+    LRU недавних успешных проверок пароля. Ключ - HMAC пары (хэш, пароль) на
+    случайном ключе процесса, поэтому в памяти нет ни паролей, ни их хэшей,
+    а смена пароля меняет ключ и сразу делает старую запись бесполезной.
+    '''
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: bytes) -> Optional[bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def put(self, key: bytes, value: bool) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_kdf_executor = None
+_kdf_executor_lock = threading.Lock()
+_cache_key = os.urandom(32)
+_verified = VerificationCache(PASSWORD_CACHE_SIZE, PASSWORD_CACHE_TTL)
+_dummy_hash: Optional[str] = None
+_ephemeral_keys: Optional[dict] = None
+
+
+class ConnectionPool:
+    '''
+    Пул соединений с БД, переживающий вызовы в теплом контейнере.
+    Соединение возвращается в пул без открытой транзакции и без сессионного
+    состояния, поэтому пул совместим с PgBouncer в режиме transaction.
+    '''
+    
+    def __init__(self, dsn: str, max_size: int, idle_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'discarded': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._metrics_logged_at = time.monotonic()
+    
+    def getconn(self, timeout: float = POOL_ACQUIRE_TIMEOUT):
+        started = time.monotonic()
+        
+        while True:
+            conn, idle_for = self._checkout(started, timeout)
+            
+            if conn is None:
+                try:
+                    import psycopg2
+                    with Span('db_connect'):
+                        conn = psycopg2.connect(self.dsn, cursor_factory=timed_cursor_class())
+                except Exception:
+                    self._forget()
+                    raise
+                return conn
+            
+            if idle_for < self.healthcheck_after or self._is_healthy(conn):
+                return conn
+            
+            self._discard(conn)
+    
+    def putconn(self, conn) -> None:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        
+        self._maybe_log_metrics()
+    
+    def _checkout(self, started: float, timeout: float):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self.stats['hits'] += 1
+                    return conn, now - released_at
+                
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.stats['misses'] += 1
+                    return None, 0.0
+                
+                remaining = timeout - (now - started)
+                if remaining <= 0:
+                    raise TimeoutError(f'No free database connection after {timeout}s')
+                
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+                self.stats['wait_time'] += time.monotonic() - now
+    
+    def _evict_idle(self, now: float) -> None:
+        # Самые старые соединения лежат в начале списка
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self.stats['discarded'] += 1
+            conn.close()
+    
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.stats['discarded'] += 1
+        self._forget()
+    
+    def _forget(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    def _maybe_log_metrics(self) -> None:
+        now = time.monotonic()
+        if now - self._metrics_logged_at < POOL_METRICS_INTERVAL:
+            return
+        self._metrics_logged_at = now
+        with self._cond:
+            print(json.dumps({'event': 'db_pool_metrics', 'size': self._size, 'idle': len(self._idle), **self.stats}))
+
+
+_pool = ConnectionPool(DSN, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_HEALTHCHECK_AFTER)
+
+
+def get_connection():
+    '''Берет соединение из пула контейнера'''
+    with Span('db_acquire'):
+        return _pool.getconn()
+
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул, откатывая незавершенную транзакцию'''
+    _pool.putconn(conn)
+
+
+_timed_cursor = None
+
+
+def timed_cursor_class():
+    '''Класс курсора соединений пула: каждый запрос - отдельный участок sql в трассировке вызова'''
+    
+    global _timed_cursor
+    if _timed_cursor is None:
+        import psycopg2.extensions
+        
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                with Span('sql', query):
+                    return super().execute(query, vars)
+            
+            def executemany(self, query, vars_list):
+                with Span('sql', query):
+                    return super().executemany(query, vars_list)
+        
+        _timed_cursor = TimedCursor
+    return _timed_cursor
+
+
+# Общий слой запросов и ответов. Функции деплоятся по отдельности, поэтому
+# блок одинаково скопирован в каждую index.py и меняется во всех сразу
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+class Request:
+    '''Событие вызова: заголовки в нижнем регистре, тело разбирается один раз и только по требованию'''
+    
+    __slots__ = ('event', 'method', 'params', 'headers', '_body')
+    
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        self._body = None
+    
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            with Span('json_decode'):
+                self._body = loads(self.event.get('body') or '{}')
+        return self._body
+    
+    @property
+    def action(self) -> Optional[str]:
+        return (self.params if self.method == 'GET' else self.body).get('action')
+
+
+_local = threading.local()
+
+
+class Trace:
+    '''Замеры одного вызова: (участок, мс, подробность) в порядке завершения'''
+    
+    __slots__ = ('action', 'started', 'spans')
+    
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = []
+    
+    def finish(self, status: int) -> float:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        print(json.dumps({
+            'event': 'request_timing',
+            'action': self.action,
+            'status': status,
+            'total_ms': round(total_ms, 2),
+            'spans': [
+                {'name': name, 'ms': round(ms, 2), **({'detail': span_detail(detail)} if detail is not None else {})}
+                for name, ms, detail in self.spans
+            ]
+        }))
+        return total_ms
+    
+    def server_timing(self, total_ms: float) -> str:
+        totals = {}
+        for name, ms, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + ms
+        return ', '.join([f'{name};dur={ms:.1f}' for name, ms in totals.items()] + [f'total;dur={total_ms:.1f}'])
+
+
+class Span:
+    '''Замер участка текущего вызова; вне трассированного вызова стоит одно обращение к thread-local'''
+    
+    __slots__ = ('name', 'detail', 'trace', 'started')
+    
+    def __init__(self, name: str, detail=None):
+        self.name = name
+        self.detail = detail
+        self.trace = getattr(_local, 'trace', None)
+    
+    def __enter__(self):
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.spans.append((self.name, (time.perf_counter() - self.started) * 1000, self.detail))
+
+
+def span_detail(detail) -> str:
+    # Текст SQL сжимается до начала запроса; значения execute_values после VALUES в лог не попадают
+    if isinstance(detail, bytes):
+        detail = detail.decode(errors='replace')
+    return ' '.join(str(detail).split()).split(' VALUES ', 1)[0][:120]
+
+
+def traced(request: 'Request', action: Optional[str], call: Callable[[], dict]) -> dict:
+    '''Выполняет действие, для выборки вызовов (TRACE_SAMPLE_RATE) записывая замеры его участков'''
+    
+    forced = TRACE_SERVER_TIMING and request.headers.get('x-trace') == '1'
+    if not forced and int.from_bytes(os.urandom(2), 'big') >= TRACE_SAMPLE_RATE * 65536:
+        return call()
+    
+    trace = _local.trace = Trace(action or 'default')
+    try:
+        response = call()
+    except Exception:
+        trace.finish(500)
+        raise
+    finally:
+        _local.trace = None
+    
+    total_ms = trace.finish(response['statusCode'])
+    if not TRACE_SERVER_TIMING:
+        return response
+    return {
+        **response,
+        'headers': {**response['headers'], 'Server-Timing': trace.server_timing(total_ms), 'Timing-Allow-Origin': '*'}
+    }
+
+
+def dispatch(event: dict, routes: dict, preflight: dict) -> dict:
+    '''Маршрут по методу и action; исключение действия превращается в ответ 500'''
+    
+    if event.get('httpMethod') == 'OPTIONS':
+        return preflight
+    
+    request = Request(event)
+    actions = routes.get(request.method)
+    if actions is None:
+        return error_response('Method not allowed', 405)
+    
+    try:
+        name = request.action
+        action = actions.get(name)
+        if action is None:
+            return error_response('Invalid action', 400)
+        return traced(request, name, lambda: action(request))
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+def preflight_response(methods: str, headers: str = 'Content-Type') -> dict:
     return {
         'statusCode': 200,
         'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': headers,
+            'Access-Control-Max-Age': '86400'
         },
-        'body': json.dumps({'success': True, **data})
+        'body': ''
     }
 
 
+def json_default(value):
+    # date/datetime и Decimal распознаются по методам, чтобы не импортировать их модули ради isinstance
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'as_integer_ratio'):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(data) -> str:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    loads = orjson.loads
+else:
+    def dumps(data) -> str:
+        return json.dumps(data, default=json_default, ensure_ascii=False)
+    
+    loads = json.loads
+
+
+def encode_body(data: dict) -> str:
+    with Span('json_encode'):
+        return dumps(data)
+
+
+def success_response(data: dict) -> dict:
+    return {'statusCode': 200, 'headers': JSON_HEADERS, 'body': encode_body({'success': True, **data})}
+
+
 def error_response(message: str, status_code: int = 400) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'success': False, 'error': message})
+    return {'statusCode': status_code, 'headers': JSON_HEADERS, 'body': encode_body({'success': False, 'error': message})}
+
+
+PREFLIGHT = preflight_response('POST, OPTIONS', 'Content-Type, Authorization')
+
+ROUTES = {
+    'POST': {
+        'register': lambda request: register_partner(request.body),
+        'login': lambda request: login_partner(request.body),
+        'change_password': lambda request: change_password(request.body, request.headers),
+        'logout': lambda request: logout_partner(request.headers)
     }
+}
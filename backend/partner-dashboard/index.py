@@ -1,200 +1,420 @@
+import base64
+import csv
+import hashlib
+import hmac
+import io
 import json
 import os
-import psycopg2
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    from datetime import datetime
+
+# Трассировка: доля вызовов, для которых пишутся замеры участков (event request_timing),
+# и заголовок Server-Timing у трассированных ответов (тогда X-Trace: 1 трассирует вызов всегда)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING') == '1'
 
 DSN = os.environ.get('DATABASE_URL')
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE: psycopg2 импортируется лениво при первом соединении
+TRANSACTION_STATUS_IDLE = 0
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_METRICS_INTERVAL = float(os.environ.get('DB_POOL_METRICS_INTERVAL', '60'))
+
+# Кэш держит только id, код и ставку комиссии - их функции не меняют, а кэш у каждого
+# контейнера свой, поэтому сброса нет: правки в БД доходят до контейнеров за PARTNER_CACHE_TTL
+PARTNER_CACHE_SIZE = int(os.environ.get('PARTNER_CACHE_SIZE', '10000'))
+PARTNER_CACHE_TTL = float(os.environ.get('PARTNER_CACHE_TTL', '300'))
+PARTNER_NEGATIVE_CACHE_SIZE = int(os.environ.get('PARTNER_NEGATIVE_CACHE_SIZE', '50000'))
+PARTNER_NEGATIVE_TTL = float(os.environ.get('PARTNER_NEGATIVE_TTL', '60'))
+
+TIMESERIES_MAX_DAYS = int(os.environ.get('TIMESERIES_MAX_DAYS', '1095'))
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '100'))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '500'))
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '1000'))
+EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', '50000'))
+
+COMPLETE_ORDERS_MAX_BATCH = int(os.environ.get('COMPLETE_ORDERS_MAX_BATCH', '1000'))
+
+# Ключи подписи токенов partner-auth ("kid:секрет,kid:секрет"); принимается любой из них
+AUTH_TOKEN_KEYS = {
+    kid.strip(): secret.strip().encode()
+    for kid, _, secret in (item.partition(':') for item in os.environ.get('AUTH_TOKEN_KEYS', '').split(','))
+    if kid.strip() and secret.strip()
+}
+AUTH_REVOCATION_REFRESH = float(os.environ.get('AUTH_REVOCATION_REFRESH', '30'))
+# Переходный режим для старых клиентов без токена: partner_id из параметров запроса
+AUTH_ALLOW_PARTNER_ID_PARAM = os.environ.get('AUTH_ALLOW_PARTNER_ID_PARAM') == '1'
+# Служебные действия принимаются только с этим секретом в заголовке X-Operator-Secret;
+# без настроенного секрета они недоступны
+OPERATOR_SECRET = os.environ.get('OPERATOR_SECRET', '')
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
 
 
 def handler(event: dict, context) -> dict:
     '''Личный кабинет партнера - статистика, начисления, выплаты'''
-    
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    try:
-        if method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
-            action = params.get('action')
-            partner_id = params.get('partner_id')
-            
-            if not partner_id:
-                return error_response('Partner ID required', 400)
-            
-            if action == 'stats':
-                return get_partner_stats(int(partner_id))
-            elif action == 'earnings':
-                return get_partner_earnings(int(partner_id))
-            elif action == 'payouts':
-                return get_partner_payouts(int(partner_id))
-            else:
-                return error_response('Invalid action', 400)
-        
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'request_payout':
-                return request_payout(body)
-            elif action == 'complete_order':
-                return complete_order(body)
-            else:
-                return error_response('Invalid action', 400)
-        
-        else:
-            return error_response('Method not allowed', 405)
-            
-    except Exception as e:
-        return error_response(str(e), 500)
+    return dispatch(event, ROUTES, PREFLIGHT)
 
 
 def get_partner_stats(partner_id: int) -> dict:
     '''Получение общей статистики партнера'''
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
-            "SELECT balance, commission_rate, partner_code FROM partners WHERE id = %s",
+            """SELECT p.balance, p.commission_rate, p.partner_code,
+                      COALESCE(s.total_clicks, 0), COALESCE(s.completed_orders, 0),
+                      COALESCE(s.total_volume, 0), COALESCE(s.total_earned, 0), COALESCE(s.total_paid, 0)
+               FROM partners p
+               LEFT JOIN partner_stats s ON s.partner_id = p.id
+               WHERE p.id = %s""",
             (partner_id,)
         )
         result = cur.fetchone()
         if not result:
             return error_response('Partner not found', 404)
         
-        balance, commission_rate, partner_code = result
-        
-        cur.execute(
-            "SELECT COUNT(*) FROM partner_clicks WHERE partner_id = %s",
-            (partner_id,)
-        )
-        total_clicks = cur.fetchone()[0]
-        
-        cur.execute(
-            "SELECT COUNT(*), COALESCE(SUM(to_amount), 0) FROM exchange_orders WHERE partner_id = %s AND status = 'completed'",
-            (partner_id,)
-        )
-        completed_orders, total_volume = cur.fetchone()
-        
-        cur.execute(
-            "SELECT COALESCE(SUM(amount), 0) FROM partner_earnings WHERE partner_id = %s",
-            (partner_id,)
-        )
-        total_earned = cur.fetchone()[0]
-        
-        cur.execute(
-            "SELECT COALESCE(SUM(amount), 0) FROM partner_payouts WHERE partner_id = %s AND status = 'completed'",
-            (partner_id,)
-        )
-        total_paid = cur.fetchone()[0]
+        (balance, commission_rate, partner_code, total_clicks, completed_orders,
+         total_volume, total_earned, total_paid) = result
         
         return success_response({
             'partner_code': partner_code,
-            'balance': float(balance),
-            'commission_rate': float(commission_rate),
+            'balance': balance,
+            'commission_rate': commission_rate,
             'total_clicks': total_clicks,
             'completed_orders': completed_orders,
-            'total_volume': float(total_volume),
-            'total_earned': float(total_earned),
-            'total_paid': float(total_paid)
+            'total_volume': total_volume,
+            'total_earned': total_earned,
+            'total_paid': total_paid
         })
         
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+
+def get_partner_earnings(partner_id: int, params: dict) -> dict:
+    '''Получение списка начислений партнера постранично, от новых к старым'''
+    
+    try:
+        earnings, next_cursor = fetch_history_page('earnings', partner_id, params)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    
+    return success_response({'earnings': earnings, 'next_cursor': next_cursor})
+
+
+def get_partner_payouts(partner_id: int, params: dict) -> dict:
+    '''Получение списка выплат партнера постранично, от новых к старым'''
+    
+    try:
+        payouts, next_cursor = fetch_history_page('payouts', partner_id, params)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    
+    return success_response({'payouts': payouts, 'next_cursor': next_cursor})
+
+
+EARNING_FIELDS = ('id', 'amount', 'commission_rate', 'order_amount', 'order_direction', 'earned_at', 'order_number')
+PAYOUT_FIELDS = ('id', 'amount', 'payment_method', 'status', 'created_at', 'processed_at')
+
+
+# Decimal и datetime остаются как есть: их сериализует dumps
+def earning_row(row: tuple) -> dict:
+    return dict(zip(EARNING_FIELDS, row))
+
+
+def payout_row(row: tuple) -> dict:
+    return dict(zip(PAYOUT_FIELDS, row))
+
+
+# Истории сортируются по (время, id) по убыванию; курсор - пара последней отданной строки
+HISTORY_QUERIES = {
+    'earnings': {
+        'sql': """SELECT
+                      pe.id, pe.amount, pe.commission_rate, pe.order_amount,
+                      pe.order_direction, pe.earned_at, eo.order_number
+                  FROM partner_earnings pe
+                  JOIN exchange_orders eo ON pe.order_id = eo.id
+                  WHERE pe.partner_id = %(partner_id)s {keyset}
+                  ORDER BY pe.earned_at DESC, pe.id DESC
+                  LIMIT %(limit)s""",
+        'keyset': 'AND (pe.earned_at, pe.id) < (%(cursor_at)s, %(cursor_id)s)',
+        'time_column': 5,
+        'format_row': earning_row
+    },
+    'payouts': {
+        'sql': """SELECT id, amount, payment_method, status, created_at, processed_at
+                  FROM partner_payouts
+                  WHERE partner_id = %(partner_id)s {keyset}
+                  ORDER BY created_at DESC, id DESC
+                  LIMIT %(limit)s""",
+        'keyset': 'AND (created_at, id) < (%(cursor_at)s, %(cursor_id)s)',
+        'time_column': 4,
+        'format_row': payout_row
+    }
+}
+
+
+# Оба варианта запросов истории (первая страница и продолжение) собираются один раз при импорте
+for _query in HISTORY_QUERIES.values():
+    _query['first_page_sql'] = _query['sql'].format(keyset='')
+    _query['next_page_sql'] = _query['sql'].format(keyset=_query['keyset'])
+
+
+def encode_cursor(row: tuple, time_column: int) -> str:
+    raw = f"{row[time_column].isoformat()}|{row[0]}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple['datetime', int]:
+    from datetime import datetime
+    
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        cursor_at, cursor_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(cursor_at), int(cursor_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
 
 
-def get_partner_earnings(partner_id: int) -> dict:
-    '''Получение списка начислений партнера'''
+def history_query(kind: str, partner_id: int, cursor: Optional[str], limit: int) -> Tuple[str, dict]:
+    query = HISTORY_QUERIES[kind]
+    query_params = {'partner_id': partner_id, 'limit': limit}
     
-    conn = psycopg2.connect(DSN)
+    if not cursor:
+        return query['first_page_sql'], query_params
+    
+    query_params['cursor_at'], query_params['cursor_id'] = decode_cursor(cursor)
+    return query['next_page_sql'], query_params
+
+
+def fetch_history_page(kind: str, partner_id: int, params: dict) -> Tuple[list, Optional[str]]:
+    '''Страница истории по keyset-курсору; лишняя строка в выборке показывает, есть ли продолжение'''
+    
+    try:
+        limit = int(params.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit')
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    
+    sql, query_params = history_query(kind, partner_id, params.get('cursor'), limit + 1)
+    query = HISTORY_QUERIES[kind]
+    
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute(
-            """SELECT 
-                   pe.id, pe.amount, pe.commission_rate, pe.order_amount, 
-                   pe.order_direction, pe.earned_at, eo.order_number
-               FROM partner_earnings pe
-               JOIN exchange_orders eo ON pe.order_id = eo.id
-               WHERE pe.partner_id = %s
-               ORDER BY pe.earned_at DESC
-               LIMIT 100""",
-            (partner_id,)
-        )
-        
-        earnings = []
-        for row in cur.fetchall():
-            earnings.append({
-                'id': row[0],
-                'amount': float(row[1]),
-                'commission_rate': float(row[2]),
-                'order_amount': float(row[3]),
-                'order_direction': row[4],
-                'earned_at': row[5].isoformat() if row[5] else None,
-                'order_number': row[6]
-            })
-        
-        return success_response({'earnings': earnings})
+        cur.execute(sql, query_params)
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    next_cursor = encode_cursor(rows[limit - 1], query['time_column']) if len(rows) > limit else None
+    return [query['format_row'](row) for row in rows[:limit]], next_cursor
+
+
+def iter_history_export(kind: str, partner_id: int, cursor: Optional[str], limit: int, fmt: str):
+    '''
+    Выгрузка истории кусками по EXPORT_CHUNK_ROWS строк через серверный курсор,
+    так что память не зависит от длины истории. Отдает (текст, курсор последней строки, число строк).
+    '''
+    
+    sql, query_params = history_query(kind, partner_id, cursor, limit)
+    query = HISTORY_QUERIES[kind]
+    
+    conn = get_connection()
+    cur = conn.cursor(name=f'export_{kind}')
+    cur.itersize = EXPORT_CHUNK_ROWS
+    
+    try:
+        cur.execute(sql, query_params)
+        header_written = False
         
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            
+            items = [query['format_row'](row) for row in rows]
+            
+            with Span('export_encode', fmt):
+                if fmt == 'ndjson':
+                    text = ''.join(dumps(item) + '\n' for item in items)
+                else:
+                    buffer = io.StringIO()
+                    writer = csv.DictWriter(buffer, fieldnames=list(items[0]))
+                    if not header_written:
+                        writer.writeheader()
+                        header_written = True
+                    writer.writerows(
+                        {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in item.items()}
+                        for item in items
+                    )
+                    text = buffer.getvalue()
+            
+            yield text, encode_cursor(rows[-1], query['time_column']), len(rows)
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def get_partner_payouts(partner_id: int) -> dict:
-    '''Получение списка выплат партнера'''
+def export_partner_history(partner_id: int, params: dict) -> dict:
+    '''
+    Выгрузка начислений или выплат в CSV/NDJSON. Ответ функции собирается целиком,
+    поэтому за вызов отдается не больше EXPORT_MAX_ROWS строк, продолжение - по X-Next-Cursor.
+    '''
+    
+    kind = params.get('kind', 'earnings')
+    fmt = params.get('format', 'csv')
+    
+    if kind not in HISTORY_QUERIES:
+        return error_response('kind must be earnings or payouts', 400)
+    if fmt not in EXPORT_CONTENT_TYPES:
+        return error_response('format must be csv or ndjson', 400)
+    
+    chunks = []
+    exported = 0
+    last_cursor = None
+    
+    try:
+        with closing(iter_history_export(kind, partner_id, params.get('cursor'), EXPORT_MAX_ROWS, fmt)) as export:
+            for text, last_cursor, count in export:
+                chunks.append(text)
+                exported += count
+    except ValueError as e:
+        return error_response(str(e), 400)
+    
+    next_cursor = last_cursor if exported >= EXPORT_MAX_ROWS else ''
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': EXPORT_CONTENT_TYPES[fmt],
+            'Content-Disposition': f'attachment; filename="{kind}.{fmt}"',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Next-Cursor',
+            'X-Next-Cursor': next_cursor
+        },
+        'body': ''.join(chunks)
+    }
+
+
+def get_partner_timeseries(partner_id: int, params: dict) -> dict:
+    '''
+    Клики, заказы, объем и начисления партнера по периодам из почасовых агрегатов.
+    granularity: hour, day или month; group_by: pair (направление обмена) или city.
+    Заказы не привязаны к городу, поэтому при группировке по городу идут общим рядом.
+    '''
+    
+    granularity = params.get('granularity', 'day')
+    group_by = params.get('group_by', '')
+    
+    try:
+        days = int(params.get('days', 90))
+    except ValueError:
+        return error_response('Invalid days', 400)
+    days = max(1, min(days, TIMESERIES_MAX_DAYS))
+    
+    if granularity not in ('hour', 'day', 'month'):
+        return error_response('granularity must be hour, day or month', 400)
+    if group_by not in ('', 'pair', 'city'):
+        return error_response('group_by must be pair or city', 400)
+    
+    click_keys = {
+        '': "''",
+        'pair': "from_currency || ' → ' || to_currency",
+        'city': 'city'
+    }[group_by]
+    order_keys = "from_currency || ' → ' || to_currency" if group_by == 'pair' else "''"
     
-    conn = psycopg2.connect(DSN)
+    query_params = {'partner_id': partner_id, 'granularity': granularity, 'days': days}
+    
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
-            """SELECT id, amount, payment_method, status, created_at, processed_at
-               FROM partner_payouts
-               WHERE partner_id = %s
-               ORDER BY created_at DESC
-               LIMIT 100""",
-            (partner_id,)
+            f"""SELECT date_trunc(%(granularity)s, bucket) AS period, {click_keys} AS series, SUM(clicks)
+                FROM partner_clicks_hourly
+                WHERE partner_id = %(partner_id)s
+                  AND bucket >= date_trunc(%(granularity)s, LOCALTIMESTAMP - make_interval(days => %(days)s))
+                GROUP BY 1, 2
+                ORDER BY 1, 2""",
+            query_params
         )
+        clicks = [
+            {'period': row[0], 'series': row[1], 'clicks': int(row[2])}
+            for row in cur.fetchall()
+        ]
         
-        payouts = []
-        for row in cur.fetchall():
-            payouts.append({
-                'id': row[0],
-                'amount': float(row[1]),
-                'payment_method': row[2],
-                'status': row[3],
-                'created_at': row[4].isoformat() if row[4] else None,
-                'processed_at': row[5].isoformat() if row[5] else None
-            })
+        cur.execute(
+            f"""SELECT date_trunc(%(granularity)s, bucket) AS period, {order_keys} AS series,
+                       SUM(orders), SUM(volume), SUM(earnings)
+                FROM partner_orders_hourly
+                WHERE partner_id = %(partner_id)s
+                  AND bucket >= date_trunc(%(granularity)s, LOCALTIMESTAMP - make_interval(days => %(days)s))
+                GROUP BY 1, 2
+                ORDER BY 1, 2""",
+            query_params
+        )
+        orders = [
+            {
+                'period': row[0],
+                'series': row[1],
+                'orders': int(row[2]),
+                'volume': row[3],
+                'earnings': row[4]
+            }
+            for row in cur.fetchall()
+        ]
         
-        return success_response({'payouts': payouts})
+        return success_response({
+            'granularity': granularity,
+            'group_by': group_by or None,
+            'days': days,
+            'clicks': clicks,
+            'orders': orders
+        })
         
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def request_payout(data: dict) -> dict:
-    '''Запрос на выплату средств'''
+def request_payout(data: dict, headers: dict) -> dict:
+    '''
+    Запрос на выплату средств. Сначала заявка занимает ключ идемпотентности, и
+    повтор с тем же ключом возвращает уже созданную заявку, даже если первая
+    списала весь баланс. Затем баланс списывается одним условным UPDATE, который
+    блокирует только строку партнера, поэтому параллельные заявки не уводят баланс
+    в минус и не сериализуют выплаты других партнеров.
+    '''
     
     partner_id = data.get('partner_id')
     amount = data.get('amount')
     payment_method = data.get('payment_method')
     payment_details = data.get('payment_details')
+    idempotency_key = data.get('idempotency_key') or headers.get('idempotency-key')
     
     if not all([partner_id, amount, payment_method, payment_details]):
         return error_response('Missing required fields', 400)
@@ -202,37 +422,61 @@ def request_payout(data: dict) -> dict:
     if float(amount) < 1000:
         return error_response('Минимальная сумма выплаты 1000 руб', 400)
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT balance FROM partners WHERE id = %s", (partner_id,))
-        result = cur.fetchone()
-        if not result:
-            return error_response('Partner not found', 404)
-        
-        balance = float(result[0])
-        if balance < float(amount):
-            return error_response('Недостаточно средств', 400)
-        
+        # Заявка вставляется из строки партнера: для неизвестного партнера строк нет,
+        # а параллельный повтор с тем же ключом ждет на уникальном индексе исхода первой
         cur.execute(
-            """INSERT INTO partner_payouts (partner_id, amount, payment_method, payment_details, status)
-               VALUES (%s, %s, %s, %s, 'pending')
+            """INSERT INTO partner_payouts
+                   (partner_id, amount, payment_method, payment_details, status, idempotency_key)
+               SELECT id, %s, %s, %s, 'pending', %s FROM partners WHERE id = %s
+               ON CONFLICT (partner_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
                RETURNING id""",
-            (partner_id, amount, payment_method, payment_details)
+            (amount, payment_method, payment_details, idempotency_key, partner_id)
         )
         
-        payout_id = cur.fetchone()[0]
+        result = cur.fetchone()
+        
+        if not result:
+            existing = None
+            if idempotency_key:
+                cur.execute(
+                    "SELECT id, amount FROM partner_payouts WHERE partner_id = %s AND idempotency_key = %s",
+                    (partner_id, idempotency_key)
+                )
+                existing = cur.fetchone()
+            conn.rollback()
+            
+            if not existing:
+                return error_response('Partner not found', 404)
+            
+            payout_id, existing_amount = existing
+            if float(existing_amount) != float(amount):
+                return error_response('Ключ идемпотентности уже использован для другой суммы', 409)
+            
+            return success_response({
+                'payout_id': payout_id,
+                'duplicate': True,
+                'message': 'Заявка на выплату создана'
+            })
         
         cur.execute(
-            "UPDATE partners SET balance = balance - %s WHERE id = %s",
-            (amount, partner_id)
+            "UPDATE partners SET balance = balance - %s WHERE id = %s AND balance >= %s RETURNING id",
+            (amount, partner_id, amount)
         )
         
+        if not cur.fetchone():
+            # Откат снимает и заявку, и занятый ею ключ
+            conn.rollback()
+            return error_response('Недостаточно средств', 400)
+        
         conn.commit()
         
         return success_response({
-            'payout_id': payout_id,
+            'payout_id': result[0],
+            'duplicate': False,
             'message': 'Заявка на выплату создана'
         })
         
@@ -241,7 +485,7 @@ def request_payout(data: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
 def complete_order(data: dict) -> dict:
@@ -252,7 +496,7 @@ def complete_order(data: dict) -> dict:
     if not order_id:
         return error_response('Order ID required', 400)
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
@@ -270,11 +514,7 @@ def complete_order(data: dict) -> dict:
         partner_id, from_currency, to_currency, from_amount, to_amount, margin_profit = result
         
         if partner_id:
-            cur.execute(
-                "SELECT commission_rate FROM partners WHERE id = %s",
-                (partner_id,)
-            )
-            commission_rate = float(cur.fetchone()[0])
+            commission_rate = find_partner_by_id(cur, partner_id)['commission_rate']
             
             earning_amount = float(margin_profit) * (commission_rate / 100)
             
@@ -290,6 +530,28 @@ def complete_order(data: dict) -> dict:
                 "UPDATE partners SET balance = balance + %s WHERE id = %s",
                 (earning_amount, partner_id)
             )
+            
+            cur.execute(
+                """INSERT INTO partner_stats (partner_id, completed_orders, total_volume, total_earned)
+                   VALUES (%s, 1, %s, ROUND(%s::numeric, 2))
+                   ON CONFLICT (partner_id) DO UPDATE
+                   SET completed_orders = partner_stats.completed_orders + EXCLUDED.completed_orders,
+                       total_volume = partner_stats.total_volume + EXCLUDED.total_volume,
+                       total_earned = partner_stats.total_earned + EXCLUDED.total_earned,
+                       updated_at = CURRENT_TIMESTAMP""",
+                (partner_id, to_amount, earning_amount)
+            )
+            
+            cur.execute(
+                """INSERT INTO partner_orders_hourly
+                       (partner_id, bucket, from_currency, to_currency, orders, volume, earnings)
+                   VALUES (%s, date_trunc('hour', LOCALTIMESTAMP), %s, %s, 1, %s, ROUND(%s::numeric, 2))
+                   ON CONFLICT (partner_id, bucket, from_currency, to_currency) DO UPDATE
+                   SET orders = partner_orders_hourly.orders + EXCLUDED.orders,
+                       volume = partner_orders_hourly.volume + EXCLUDED.volume,
+                       earnings = partner_orders_hourly.earnings + EXCLUDED.earnings""",
+                (partner_id, from_currency, to_currency, to_amount, earning_amount)
+            )
         
         cur.execute(
             "UPDATE exchange_orders SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE id = %s",
@@ -308,26 +570,794 @@ def complete_order(data: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def success_response(data: dict) -> dict:
+def complete_orders(data: dict) -> dict:
+    '''
+    Пакетное завершение заказов одной транзакцией: заказы, начисления, балансы,
+    partner_stats и почасовые агрегаты обновляются set-based запросами
+    независимо от размера пачки. Возвращает результат по каждому заказу.
+    '''
+    
+    order_ids = data.get('order_ids')
+    
+    if not isinstance(order_ids, list) or not order_ids:
+        return error_response('order_ids must be a non-empty list', 400)
+    
+    if len(order_ids) > COMPLETE_ORDERS_MAX_BATCH:
+        return error_response(f'Batch is limited to {COMPLETE_ORDERS_MAX_BATCH} orders', 400)
+    
+    try:
+        order_ids = sorted({int(order_id) for order_id in order_ids})
+    except (TypeError, ValueError):
+        return error_response('order_ids must contain integers', 400)
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Строки партнеров блокируем в порядке id, чтобы параллельные пачки не ловили взаимоблокировки
+        cur.execute(
+            """SELECT p.id FROM partners p
+               WHERE p.id IN (
+                   SELECT partner_id FROM exchange_orders
+                   WHERE id = ANY(%s) AND status = 'pending' AND partner_id IS NOT NULL
+               )
+               ORDER BY p.id
+               FOR UPDATE""",
+            (order_ids,)
+        )
+        
+        cur.execute(
+            """WITH completed AS (
+                   UPDATE exchange_orders
+                   SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                   WHERE id = ANY(%(order_ids)s) AND status = 'pending'
+                   RETURNING id, partner_id, from_currency, to_currency, to_amount, margin_profit, completed_at
+               ), earned AS (
+                   INSERT INTO partner_earnings
+                       (partner_id, order_id, amount, commission_rate, order_amount, order_direction)
+                   SELECT c.partner_id, c.id, ROUND(c.margin_profit * p.commission_rate / 100, 2),
+                          p.commission_rate, c.to_amount, c.from_currency || ' → ' || c.to_currency
+                   FROM completed c
+                   JOIN partners p ON p.id = c.partner_id
+                   RETURNING partner_id, order_id, amount
+               ), per_partner AS (
+                   SELECT e.partner_id, COUNT(*) AS orders, SUM(c.to_amount) AS volume, SUM(e.amount) AS earned
+                   FROM earned e
+                   JOIN completed c ON c.id = e.order_id
+                   GROUP BY e.partner_id
+               ), balances AS (
+                   UPDATE partners p
+                   SET balance = p.balance + pp.earned
+                   FROM per_partner pp
+                   WHERE p.id = pp.partner_id
+               ), stats AS (
+                   INSERT INTO partner_stats (partner_id, completed_orders, total_volume, total_earned)
+                   SELECT partner_id, orders, volume, earned FROM per_partner ORDER BY partner_id
+                   ON CONFLICT (partner_id) DO UPDATE
+                   SET completed_orders = partner_stats.completed_orders + EXCLUDED.completed_orders,
+                       total_volume = partner_stats.total_volume + EXCLUDED.total_volume,
+                       total_earned = partner_stats.total_earned + EXCLUDED.total_earned,
+                       updated_at = CURRENT_TIMESTAMP
+               ), hourly AS (
+                   INSERT INTO partner_orders_hourly
+                       (partner_id, bucket, from_currency, to_currency, orders, volume, earnings)
+                   SELECT e.partner_id, date_trunc('hour', c.completed_at), c.from_currency, c.to_currency,
+                          COUNT(*), SUM(c.to_amount), SUM(e.amount)
+                   FROM earned e
+                   JOIN completed c ON c.id = e.order_id
+                   GROUP BY 1, 2, 3, 4
+                   ORDER BY 1, 2, 3, 4
+                   ON CONFLICT (partner_id, bucket, from_currency, to_currency) DO UPDATE
+                   SET orders = partner_orders_hourly.orders + EXCLUDED.orders,
+                       volume = partner_orders_hourly.volume + EXCLUDED.volume,
+                       earnings = partner_orders_hourly.earnings + EXCLUDED.earnings
+               )
+               SELECT requested.id, c.id IS NOT NULL, e.amount
+               FROM unnest(%(order_ids)s::integer[]) AS requested(id)
+               LEFT JOIN completed c ON c.id = requested.id
+               LEFT JOIN earned e ON e.order_id = requested.id
+               ORDER BY requested.id""",
+            {'order_ids': order_ids}
+        )
+        
+        results = [
+            {
+                'order_id': order_id,
+                'status': 'completed' if completed else 'not_found_or_completed',
+                'earning_amount': earning_amount or 0
+            }
+            for order_id, completed, earning_amount in cur.fetchall()
+        ]
+        
+        conn.commit()
+        
+        return success_response({
+            'completed': sum(1 for item in results if item['status'] == 'completed'),
+            'total_earnings': sum(item['earning_amount'] for item in results),
+            'results': results
+        })
+        
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def reconcile_stats(data: dict) -> dict:
+    '''
+    Пересчет partner_stats из исходных таблиц с отчетом о расхождениях.
+    Без fix только сообщает о дрейфе, с fix=true перезаписывает счетчики.
+    '''
+    
+    partner_id = data.get('partner_id')
+    fix = bool(data.get('fix'))
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Блокировка ждет транзакции, уже обновившие счетчики, и задерживает новые до конца сверки,
+        # поэтому инкременты не теряются и не учитываются дважды
+        cur.execute("LOCK TABLE partner_stats IN SHARE ROW EXCLUSIVE MODE")
+        
+        cur.execute(
+            """WITH actual AS (
+                   SELECT
+                       p.id AS partner_id,
+                       COALESCE(c.total_clicks, 0) AS total_clicks,
+                       COALESCE(o.completed_orders, 0) AS completed_orders,
+                       COALESCE(o.total_volume, 0) AS total_volume,
+                       COALESCE(e.total_earned, 0) AS total_earned,
+                       COALESCE(pp.total_paid, 0) AS total_paid
+                   FROM partners p
+                   LEFT JOIN (
+                       SELECT partner_id, COUNT(*) AS total_clicks FROM partner_clicks GROUP BY partner_id
+                   ) c ON c.partner_id = p.id
+                   LEFT JOIN (
+                       SELECT partner_id, COUNT(*) AS completed_orders, SUM(to_amount) AS total_volume
+                       FROM exchange_orders WHERE status = 'completed' GROUP BY partner_id
+                   ) o ON o.partner_id = p.id
+                   LEFT JOIN (
+                       SELECT partner_id, SUM(amount) AS total_earned FROM partner_earnings GROUP BY partner_id
+                   ) e ON e.partner_id = p.id
+                   LEFT JOIN (
+                       SELECT partner_id, SUM(amount) AS total_paid
+                       FROM partner_payouts WHERE status = 'completed' GROUP BY partner_id
+                   ) pp ON pp.partner_id = p.id
+                   WHERE %(partner_id)s::integer IS NULL OR p.id = %(partner_id)s::integer
+               )
+               SELECT
+                   a.partner_id,
+                   a.total_clicks, a.completed_orders, a.total_volume, a.total_earned, a.total_paid,
+                   s.total_clicks, s.completed_orders, s.total_volume, s.total_earned, s.total_paid
+               FROM actual a
+               LEFT JOIN partner_stats s ON s.partner_id = a.partner_id
+               WHERE (a.total_clicks, a.completed_orders, a.total_volume, a.total_earned, a.total_paid)
+                     IS DISTINCT FROM
+                     (s.total_clicks, s.completed_orders, s.total_volume, s.total_earned, s.total_paid)
+               ORDER BY a.partner_id""",
+            {'partner_id': partner_id}
+        )
+        
+        fields = ['total_clicks', 'completed_orders', 'total_volume', 'total_earned', 'total_paid']
+        drift = []
+        for row in cur.fetchall():
+            actual = dict(zip(fields, row[1:6]))
+            stored = dict(zip(fields, row[6:11]))
+            drift.append({
+                'partner_id': row[0],
+                'actual': actual,
+                'stored': stored if row[6] is not None else None
+            })
+        
+        if fix and drift:
+            from psycopg2.extras import execute_values
+            execute_values(
+                cur,
+                """INSERT INTO partner_stats
+                       (partner_id, total_clicks, completed_orders, total_volume, total_earned, total_paid)
+                   VALUES %s
+                   ON CONFLICT (partner_id) DO UPDATE
+                   SET total_clicks = EXCLUDED.total_clicks,
+                       completed_orders = EXCLUDED.completed_orders,
+                       total_volume = EXCLUDED.total_volume,
+                       total_earned = EXCLUDED.total_earned,
+                       total_paid = EXCLUDED.total_paid,
+                       updated_at = CURRENT_TIMESTAMP""",
+                [(item['partner_id'], *(item['actual'][k] for k in fields)) for item in drift]
+            )
+        
+        conn.commit()
+        
+        return success_response({
+            'drifted': len(drift),
+            'fixed': fix,
+            'drift': drift
+        })
+        
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+class ConnectionPool:
+    '''
+    Пул соединений с БД, переживающий вызовы в теплом контейнере.
+    Соединение возвращается в пул без открытой транзакции и без сессионного
+    состояния, поэтому пул совместим с PgBouncer в режиме transaction.
+    '''
+    
+    def __init__(self, dsn: str, max_size: int, idle_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'discarded': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._metrics_logged_at = time.monotonic()
+    
+    def getconn(self, timeout: float = POOL_ACQUIRE_TIMEOUT):
+        started = time.monotonic()
+        
+        while True:
+            conn, idle_for = self._checkout(started, timeout)
+            
+            if conn is None:
+                try:
+                    import psycopg2
+                    with Span('db_connect'):
+                        conn = psycopg2.connect(self.dsn, cursor_factory=timed_cursor_class())
+                except Exception:
+                    self._forget()
+                    raise
+                return conn
+            
+            if idle_for < self.healthcheck_after or self._is_healthy(conn):
+                return conn
+            
+            self._discard(conn)
+    
+    def putconn(self, conn) -> None:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        
+        self._maybe_log_metrics()
+    
+    def _checkout(self, started: float, timeout: float):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self.stats['hits'] += 1
+                    return conn, now - released_at
+                
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.stats['misses'] += 1
+                    return None, 0.0
+                
+                remaining = timeout - (now - started)
+                if remaining <= 0:
+                    raise TimeoutError(f'No free database connection after {timeout}s')
+                
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+                self.stats['wait_time'] += time.monotonic() - now
+    
+    def _evict_idle(self, now: float) -> None:
+        # Самые старые соединения лежат в начале списка
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self.stats['discarded'] += 1
+            conn.close()
+    
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.stats['discarded'] += 1
+        self._forget()
+    
+    def _forget(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    def _maybe_log_metrics(self) -> None:
+        now = time.monotonic()
+        if now - self._metrics_logged_at < POOL_METRICS_INTERVAL:
+            return
+        self._metrics_logged_at = now
+        with self._cond:
+            print(json.dumps({'event': 'db_pool_metrics', 'size': self._size, 'idle': len(self._idle), **self.stats}))
+
+
+_pool = ConnectionPool(DSN, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_HEALTHCHECK_AFTER)
+
+
+def get_connection():
+    '''Берет соединение из пула контейнера'''
+    with Span('db_acquire'):
+        return _pool.getconn()
+
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул, откатывая незавершенную транзакцию'''
+    _pool.putconn(conn)
+
+
+_timed_cursor = None
+
+
+def timed_cursor_class():
+    '''Класс курсора соединений пула: каждый запрос - отдельный участок sql в трассировке вызова'''
+    
+    global _timed_cursor
+    if _timed_cursor is None:
+        import psycopg2.extensions
+        
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                with Span('sql', query):
+                    return super().execute(query, vars)
+            
+            def executemany(self, query, vars_list):
+                with Span('sql', query):
+                    return super().executemany(query, vars_list)
+        
+        _timed_cursor = TimedCursor
+    return _timed_cursor
+
+
+class PartnerCache:
+    '''
+    LRU-кэш метаданных партнеров (id, код, ставка комиссии) с TTL; устаревание
+    ограничено только сроком записи, баланс и прочие изменяемые поля не кэшируются.
+    Неизвестные ключи кэшируются отдельно и на меньший срок, чтобы запросы
+    ботов со случайными кодами отсекались без БД и не вытесняли настоящих партнеров.
+    '''
+    
+    def __init__(self, max_size: int, ttl: float, negative_max_size: int, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_max_size = negative_max_size
+        self.negative_ttl = negative_ttl
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: tuple) -> Tuple[bool, Optional[dict]]:
+        now = time.monotonic()
+        
+        with self._lock:
+            for entries, counter in ((self._entries, 'hits'), (self._negative, 'negative_hits')):
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at <= now:
+                    del entries[key]
+                    continue
+                entries.move_to_end(key)
+                self.stats[counter] += 1
+                return True, value
+            
+            self.stats['misses'] += 1
+            return False, None
+    
+    def put(self, key: tuple, value: Optional[dict]) -> None:
+        if value is None:
+            entries, max_size, ttl = self._negative, self.negative_max_size, self.negative_ttl
+        else:
+            entries, max_size, ttl = self._entries, self.max_size, self.ttl
+        
+        with self._lock:
+            entries[key] = (time.monotonic() + ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > max_size:
+                entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+_partner_cache = PartnerCache(PARTNER_CACHE_SIZE, PARTNER_CACHE_TTL, PARTNER_NEGATIVE_CACHE_SIZE, PARTNER_NEGATIVE_TTL)
+
+
+def find_partner_by_id(cur, partner_id: int) -> Optional[dict]:
+    '''Метаданные партнера по id из кэша контейнера, при промахе - запросом через переданный курсор'''
+    
+    found, partner = _partner_cache.get(('id', partner_id))
+    if found:
+        return partner
+    
+    cur.execute(
+        "SELECT id, partner_code, commission_rate FROM partners WHERE id = %s",
+        (partner_id,)
+    )
+    result = cur.fetchone()
+    
+    partner = None
+    if result:
+        partner = {'id': result[0], 'partner_code': result[1], 'commission_rate': float(result[2])}
+    
+    _partner_cache.put(('id', partner_id), partner)
+    return partner
+
+
+def partner_action(action):
+    '''Действие кабинета от имени партнера из токена: action(partner_id, request)'''
+    
+    def wrapped(request: 'Request') -> dict:
+        source = request.params if request.method == 'GET' else request.body
+        partner_id = authenticate(request, source.get('partner_id'))
+        if not partner_id:
+            return error_response('Unauthorized', 401)
+        return action(partner_id, request)
+    
+    return wrapped
+
+
+def operator_action(action):
+    '''Служебное действие (cron, оператор): action(request) только с X-Operator-Secret'''
+    
+    def wrapped(request: 'Request') -> dict:
+        secret = request.headers.get('x-operator-secret', '')
+        if not OPERATOR_SECRET or not hmac.compare_digest(secret.encode(), OPERATOR_SECRET.encode()):
+            return error_response('Forbidden', 403)
+        return action(request)
+    
+    return wrapped
+
+
+def authenticate(request: 'Request', fallback_partner_id=None) -> Optional[int]:
+    '''
+    id партнера из Bearer-токена partner-auth. Подпись и срок проверяются в
+    памяти, отзыв - по списку, который дочитывается из БД раз в AUTH_REVOCATION_REFRESH.
+    '''
+    
+    token = bearer_token(request.headers)
+    if token is None:
+        if AUTH_ALLOW_PARTNER_ID_PARAM and fallback_partner_id:
+            return int(fallback_partner_id)
+        return None
+    
+    claims = verify_token(token)
+    if claims is None or _revoked_tokens.is_revoked(claims):
+        return None
+    return claims['sub']
+
+
+def verify_token(token: str) -> Optional[dict]:
+    '''Проверяет подпись и срок токена вида v1.kid.payload.sig'''
+    
+    parts = token.split('.')
+    if len(parts) != 4 or parts[0] != 'v1':
+        return None
+    
+    _, kid, payload, signature = parts
+    key = AUTH_TOKEN_KEYS.get(kid)
+    if key is None:
+        return None
+    
+    expected = base64.urlsafe_b64encode(
+        hmac.new(key, f'v1.{kid}.{payload}'.encode(), hashlib.sha256).digest()
+    ).decode().rstrip('=')
+    if not hmac.compare_digest(expected.encode(), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims
+
+
+def bearer_token(headers: dict) -> Optional[str]:
+    value = headers.get('Authorization') or headers.get('authorization') or ''
+    return value[7:].strip() if value.startswith('Bearer ') else None
+
+
+class RevocationList:
+    '''
+    Отозванные jti и границы отзыва по партнерам (все токены партнера, выпущенные
+    раньше issued_before, после смены пароля) в памяти контейнера. Обновление
+    дочитывает записи новее последней увиденной (с запасом на транзакции,
+    закоммиченные с опозданием) и выбрасывает истекшие, поэтому список остается маленьким.
+    '''
+    
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._issued_before = {}
+        self._watermark = 0.0
+        self._refreshed_at = float('-inf')
+        self._lock = threading.Lock()
+    
+    def is_revoked(self, claims: dict) -> bool:
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+        if claims['jti'] in self._revoked:
+            return True
+        cutoff = self._issued_before.get(claims['sub'])
+        return cutoff is not None and claims.get('iat', 0) < cutoff[0]
+    
+    def refresh(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            
+            conn = get_connection()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT jti, partner_id, EXTRACT(EPOCH FROM issued_before),
+                                  EXTRACT(EPOCH FROM expires_at), EXTRACT(EPOCH FROM revoked_at)
+                           FROM revoked_tokens
+                           WHERE revoked_at > TIMESTAMP 'epoch' + make_interval(secs => %s) - INTERVAL '1 minute'
+                             AND expires_at > CURRENT_TIMESTAMP""",
+                        (self._watermark,)
+                    )
+                    rows = cur.fetchall()
+                conn.rollback()
+            finally:
+                release_connection(conn)
+            
+            now = time.time()
+            revoked = {jti: expires for jti, expires in self._revoked.items() if expires > now}
+            issued_before = {
+                partner_id: cutoff for partner_id, cutoff in self._issued_before.items() if cutoff[1] > now
+            }
+            for jti, partner_id, cutoff, expires, revoked_at in rows:
+                if cutoff is None:
+                    revoked[jti] = float(expires)
+                elif float(cutoff) > issued_before.get(partner_id, (0.0, 0.0))[0]:
+                    issued_before[partner_id] = (float(cutoff), float(expires))
+                self._watermark = max(self._watermark, float(revoked_at))
+            
+            self._revoked = revoked
+            self._issued_before = issued_before
+            self._refreshed_at = time.monotonic()
+
+
+_revoked_tokens = RevocationList(AUTH_REVOCATION_REFRESH)
+
+
+# Общий слой запросов и ответов. Функции деплоятся по отдельности, поэтому
+# блок одинаково скопирован в каждую index.py и меняется во всех сразу
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+class Request:
+    '''Событие вызова: заголовки в нижнем регистре, тело разбирается один раз и только по требованию'''
+    
+    __slots__ = ('event', 'method', 'params', 'headers', '_body')
+    
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        self._body = None
+    
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            with Span('json_decode'):
+                self._body = loads(self.event.get('body') or '{}')
+        return self._body
+    
+    @property
+    def action(self) -> Optional[str]:
+        return (self.params if self.method == 'GET' else self.body).get('action')
+
+
+_local = threading.local()
+
+
+class Trace:
+    '''Замеры одного вызова: (участок, мс, подробность) в порядке завершения'''
+    
+    __slots__ = ('action', 'started', 'spans')
+    
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = []
+    
+    def finish(self, status: int) -> float:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        print(json.dumps({
+            'event': 'request_timing',
+            'action': self.action,
+            'status': status,
+            'total_ms': round(total_ms, 2),
+            'spans': [
+                {'name': name, 'ms': round(ms, 2), **({'detail': span_detail(detail)} if detail is not None else {})}
+                for name, ms, detail in self.spans
+            ]
+        }))
+        return total_ms
+    
+    def server_timing(self, total_ms: float) -> str:
+        totals = {}
+        for name, ms, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + ms
+        return ', '.join([f'{name};dur={ms:.1f}' for name, ms in totals.items()] + [f'total;dur={total_ms:.1f}'])
+
+
+class Span:
+    '''Замер участка текущего вызова; вне трассированного вызова стоит одно обращение к thread-local'''
+    
+    __slots__ = ('name', 'detail', 'trace', 'started')
+    
+    def __init__(self, name: str, detail=None):
+        self.name = name
+        self.detail = detail
+        self.trace = getattr(_local, 'trace', None)
+    
+    def __enter__(self):
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.spans.append((self.name, (time.perf_counter() - self.started) * 1000, self.detail))
+
+
+def span_detail(detail) -> str:
+    # Текст SQL сжимается до начала запроса; значения execute_values после VALUES в лог не попадают
+    if isinstance(detail, bytes):
+        detail = detail.decode(errors='replace')
+    return ' '.join(str(detail).split()).split(' VALUES ', 1)[0][:120]
+
+
+def traced(request: 'Request', action: Optional[str], call: Callable[[], dict]) -> dict:
+    '''Выполняет действие, для выборки вызовов (TRACE_SAMPLE_RATE) записывая замеры его участков'''
+    
+    forced = TRACE_SERVER_TIMING and request.headers.get('x-trace') == '1'
+    if not forced and int.from_bytes(os.urandom(2), 'big') >= TRACE_SAMPLE_RATE * 65536:
+        return call()
+    
+    trace = _local.trace = Trace(action or 'default')
+    try:
+        response = call()
+    except Exception:
+        trace.finish(500)
+        raise
+    finally:
+        _local.trace = None
+    
+    total_ms = trace.finish(response['statusCode'])
+    if not TRACE_SERVER_TIMING:
+        return response
+    return {
+        **response,
+        'headers': {**response['headers'], 'Server-Timing': trace.server_timing(total_ms), 'Timing-Allow-Origin': '*'}
+    }
+
+
+def dispatch(event: dict, routes: dict, preflight: dict) -> dict:
+    '''Маршрут по методу и action; исключение действия превращается в ответ 500'''
+    
+    if event.get('httpMethod') == 'OPTIONS':
+        return preflight
+    
+    request = Request(event)
+    actions = routes.get(request.method)
+    if actions is None:
+        return error_response('Method not allowed', 405)
+    
+    try:
+        name = request.action
+        action = actions.get(name)
+        if action is None:
+            return error_response('Invalid action', 400)
+        return traced(request, name, lambda: action(request))
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+def preflight_response(methods: str, headers: str = 'Content-Type') -> dict:
     return {
         'statusCode': 200,
         'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': headers,
+            'Access-Control-Max-Age': '86400'
         },
-        'body': json.dumps({'success': True, **data})
+        'body': ''
     }
 
 
+def json_default(value):
+    # date/datetime и Decimal распознаются по методам, чтобы не импортировать их модули ради isinstance
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'as_integer_ratio'):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(data) -> str:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    loads = orjson.loads
+else:
+    def dumps(data) -> str:
+        return json.dumps(data, default=json_default, ensure_ascii=False)
+    
+    loads = json.loads
+
+
+def encode_body(data: dict) -> str:
+    with Span('json_encode'):
+        return dumps(data)
+
+
+def success_response(data: dict) -> dict:
+    return {'statusCode': 200, 'headers': JSON_HEADERS, 'body': encode_body({'success': True, **data})}
+
+
 def error_response(message: str, status_code: int = 400) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'success': False, 'error': message})
+    return {'statusCode': status_code, 'headers': JSON_HEADERS, 'body': encode_body({'success': False, 'error': message})}
+
+
+PREFLIGHT = preflight_response('GET, POST, OPTIONS', 'Content-Type, Authorization, Idempotency-Key')
+
+ROUTES = {
+    'GET': {
+        'stats': partner_action(lambda partner_id, request: get_partner_stats(partner_id)),
+        'earnings': partner_action(lambda partner_id, request: get_partner_earnings(partner_id, request.params)),
+        'payouts': partner_action(lambda partner_id, request: get_partner_payouts(partner_id, request.params)),
+        'export': partner_action(lambda partner_id, request: export_partner_history(partner_id, request.params)),
+        'timeseries': partner_action(lambda partner_id, request: get_partner_timeseries(partner_id, request.params))
+    },
+    'POST': {
+        'request_payout': partner_action(
+            lambda partner_id, request: request_payout({**request.body, 'partner_id': partner_id}, request.headers)
+        ),
+        'complete_order': operator_action(lambda request: complete_order(request.body)),
+        'complete_orders': operator_action(lambda request: complete_orders(request.body)),
+        'reconcile_stats': operator_action(lambda request: reconcile_stats(request.body))
     }
+}
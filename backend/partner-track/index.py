@@ -1,47 +1,102 @@
+import atexit
+import base64
+import binascii
+import hashlib
+import hmac
 import json
+import math
 import os
-import psycopg2
-from datetime import datetime
+import signal
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Трассировка: доля вызовов, для которых пишутся замеры участков (event request_timing),
+# и заголовок Server-Timing у трассированных ответов (тогда X-Trace: 1 трассирует вызов всегда)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING') == '1'
 
 DSN = os.environ.get('DATABASE_URL')
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE: psycopg2 импортируется лениво при первом соединении
+TRANSACTION_STATUS_IDLE = 0
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_METRICS_INTERVAL = float(os.environ.get('DB_POOL_METRICS_INTERVAL', '60'))
+
+# Кэш держит только id, код и ставку комиссии - их функции не меняют, а кэш у каждого
+# контейнера свой, поэтому сброса нет: правки в БД доходят до контейнеров за PARTNER_CACHE_TTL
+PARTNER_CACHE_SIZE = int(os.environ.get('PARTNER_CACHE_SIZE', '10000'))
+PARTNER_CACHE_TTL = float(os.environ.get('PARTNER_CACHE_TTL', '300'))
+PARTNER_NEGATIVE_CACHE_SIZE = int(os.environ.get('PARTNER_NEGATIVE_CACHE_SIZE', '50000'))
+PARTNER_NEGATIVE_TTL = float(os.environ.get('PARTNER_NEGATIVE_TTL', '60'))
+
+# direct - INSERT на каждый клик; buffered - накопление в памяти и пакетная запись
+CLICK_INGEST_MODE = os.environ.get('CLICK_INGEST_MODE', 'direct')
+CLICK_FLUSH_SIZE = int(os.environ.get('CLICK_FLUSH_SIZE', '200'))
+CLICK_FLUSH_INTERVAL = float(os.environ.get('CLICK_FLUSH_INTERVAL', '5'))
+CLICK_BUFFER_MAX = int(os.environ.get('CLICK_BUFFER_MAX', '10000'))
+CLICK_SPOOL_PATH = os.environ.get('CLICK_SPOOL_PATH', '')
+CLICK_SPOOL_FSYNC = os.environ.get('CLICK_SPOOL_FSYNC') == '1'
+
+# Фильтр кликов до БД: с одного IP на партнера CLICK_RATE_BURST кликов подряд, дальше
+# CLICK_RATE_PER_MINUTE в минуту; повтор (партнер, IP, user agent) в течение
+# CLICK_DEDUP_WINDOW секунд - дубль. Нулевой лимит или окно отключают проверку
+CLICK_RATE_PER_MINUTE = float(os.environ.get('CLICK_RATE_PER_MINUTE', '30'))
+CLICK_RATE_BURST = float(os.environ.get('CLICK_RATE_BURST', '10'))
+CLICK_RATE_MAX_KEYS = int(os.environ.get('CLICK_RATE_MAX_KEYS', '100000'))
+CLICK_DEDUP_WINDOW = float(os.environ.get('CLICK_DEDUP_WINDOW', '1800'))
+CLICK_DEDUP_CAPACITY = int(os.environ.get('CLICK_DEDUP_CAPACITY', '100000'))
+CLICK_DEDUP_ERROR_RATE = float(os.environ.get('CLICK_DEDUP_ERROR_RATE', '0.001'))
+CLICK_FILTER_METRICS_INTERVAL = float(os.environ.get('CLICK_FILTER_METRICS_INTERVAL', '60'))
+
+# Котировки get-rates: текущий и предыдущий ключи подписи (для ротации без отказов)
+QUOTE_SIGNING_KEYS = [
+    key for key in (os.environ.get('QUOTE_SIGNING_KEY', ''), os.environ.get('QUOTE_SIGNING_KEY_PREVIOUS', ''))
+    if key
+]
+QUOTE_REQUIRED = os.environ.get('QUOTE_REQUIRED') == '1'
+
+# Клики пишутся вместе с инкрементами partner_stats и почасового агрегата одним запросом;
+# строки агрегатов обновляются в порядке ключа, чтобы параллельные пачки не ловили взаимоблокировки
+INSERT_CLICKS_SQL = """
+    WITH inserted AS (
+        INSERT INTO partner_clicks (partner_id, ip_address, user_agent, from_currency, to_currency, city, clicked_at)
+        VALUES %s
+        RETURNING id, partner_id, from_currency, to_currency, city, clicked_at
+    ), stats AS (
+        INSERT INTO partner_stats (partner_id, total_clicks)
+        SELECT partner_id, COUNT(*) FROM inserted GROUP BY partner_id ORDER BY partner_id
+        ON CONFLICT (partner_id) DO UPDATE
+        SET total_clicks = partner_stats.total_clicks + EXCLUDED.total_clicks,
+            updated_at = CURRENT_TIMESTAMP
+    ), hourly AS (
+        INSERT INTO partner_clicks_hourly (partner_id, bucket, from_currency, to_currency, city, clicks)
+        SELECT partner_id, date_trunc('hour', clicked_at),
+               COALESCE(from_currency, ''), COALESCE(to_currency, ''), COALESCE(city, ''), COUNT(*)
+        FROM inserted
+        GROUP BY 1, 2, 3, 4, 5
+        ORDER BY 1, 2, 3, 4, 5
+        ON CONFLICT (partner_id, bucket, from_currency, to_currency, city) DO UPDATE
+        SET clicks = partner_clicks_hourly.clicks + EXCLUDED.clicks
+    )
+    SELECT id FROM inserted
+"""
 
 
 def handler(event: dict, context) -> dict:
     '''Отслеживание переходов по партнерским ссылкам и создание заявок'''
-    
-    method = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    if method != 'POST':
-        return error_response('Method not allowed', 405)
-    
-    try:
-        body = json.loads(event.get('body', '{}'))
-        action = body.get('action')
-        
-        if action == 'track_click':
-            return track_click(body, event)
-        elif action == 'create_order':
-            return create_order(body)
-        else:
-            return error_response('Invalid action', 400)
-            
-    except Exception as e:
-        return error_response(str(e), 500)
+    return dispatch(event, ROUTES, PREFLIGHT)
 
 
-def track_click(data: dict, event: dict) -> dict:
+def track_click(data: dict, event: dict, headers: dict) -> dict:
     '''Отслеживание перехода по партнерской ссылке'''
     
     partner_code = data.get('partner_code')
@@ -53,28 +108,55 @@ def track_click(data: dict, event: dict) -> dict:
         return error_response('Partner code is required', 400)
     
     ip_address = event.get('requestContext', {}).get('identity', {}).get('sourceIp', '')
-    user_agent = event.get('headers', {}).get('user-agent', '')
+    user_agent = headers.get('user-agent', '')
+    
+    rate_limited = _click_filter.acquire((partner_code, ip_address)) > 0
+    
+    partner = find_partner_by_code(partner_code)
     
-    conn = psycopg2.connect(DSN)
+    if not partner:
+        return error_response('Partner not found', 404)
+    
+    partner_id = partner['id']
+    
+    # Отсеянный клик не пишется, но отвечает успехом с partner_id: страница по нему
+    # привязывает заявку к партнеру, в том числе за общим IP и при повторных визитах
+    if rate_limited or _click_filter.seen('\0'.join((partner_code, ip_address, user_agent))):
+        return success_response({
+            'click_id': None,
+            'rate_limited' if rate_limited else 'duplicate': True,
+            'partner_id': partner_id,
+            'from_currency': from_currency,
+            'to_currency': to_currency
+        })
+    
+    if CLICK_INGEST_MODE == 'buffered':
+        _click_buffer.add((
+            partner_id, ip_address, user_agent, from_currency, to_currency, city,
+            utc_now_iso()
+        ))
+        
+        return success_response({
+            'click_id': None,
+            'queued': True,
+            'partner_id': partner_id,
+            'from_currency': from_currency,
+            'to_currency': to_currency
+        })
+    
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT id FROM partners WHERE partner_code = %s", (partner_code,))
-        result = cur.fetchone()
-        
-        if not result:
-            return error_response('Partner not found', 404)
+        from psycopg2.extras import execute_values
+        click_id = execute_values(
+            cur,
+            INSERT_CLICKS_SQL,
+            [(partner_id, ip_address, user_agent, from_currency, to_currency, city)],
+            template='(%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)',
+            fetch=True
+        )[0][0]
         
-        partner_id = result[0]
-        
-        cur.execute(
-            """INSERT INTO partner_clicks (partner_id, ip_address, user_agent, from_currency, to_currency, city)
-               VALUES (%s, %s, %s, %s, %s, %s)
-               RETURNING id""",
-            (partner_id, ip_address, user_agent, from_currency, to_currency, city)
-        )
-        
-        click_id = cur.fetchone()[0]
         conn.commit()
         
         return success_response({
@@ -89,7 +171,63 @@ def track_click(data: dict, event: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+
+def verify_quote(token: str) -> Optional[dict]:
+    '''Проверяет подпись и срок котировки get-rates без обращений к БД и сети'''
+    
+    if not QUOTE_SIGNING_KEYS or not isinstance(token, str):
+        return None
+    
+    payload, _, signature = token.partition('.')
+    try:
+        received = base64.urlsafe_b64decode(signature + '=' * (-len(signature) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    
+    if not any(
+        hmac.compare_digest(hmac.new(key.encode(), payload.encode(), hashlib.sha256).digest(), received)
+        for key in QUOTE_SIGNING_KEYS
+    ):
+        return None
+    
+    try:
+        quote = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    
+    if not isinstance(quote, dict) or quote.get('exp', 0) < time.time():
+        return None
+    return quote
+
+
+def find_partner_by_code(partner_code: str) -> Optional[dict]:
+    '''Метаданные партнера по коду из кэша контейнера, при промахе - одним запросом к БД'''
+    
+    found, partner = _partner_cache.get(('code', partner_code))
+    if found:
+        return partner
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(
+            "SELECT id, partner_code, commission_rate FROM partners WHERE partner_code = %s",
+            (partner_code,)
+        )
+        result = cur.fetchone()
+    finally:
+        cur.close()
+        release_connection(conn)
+    
+    partner = None
+    if result:
+        partner = {'id': result[0], 'partner_code': result[1], 'commission_rate': float(result[2])}
+    
+    _partner_cache.put(('code', partner_code), partner)
+    return partner
 
 
 def create_order(data: dict) -> dict:
@@ -107,27 +245,49 @@ def create_order(data: dict) -> dict:
     wallet_address = data.get('wallet_address', '')
     card_number = data.get('card_number', '')
     
+    # Суммы и курс берутся из подписанной котировки, клиентские значения игнорируются;
+    # nonce котировки уникален среди заявок, поэтому по одной котировке создается одна заявка
+    quote_nonce = None
+    quote_token = data.get('quote_token')
+    if quote_token:
+        quote = verify_quote(quote_token)
+        if quote is None or not quote.get('nonce'):
+            return error_response('Invalid or expired quote', 400)
+        quote_nonce = str(quote['nonce'])
+        from_currency, to_currency = quote['from'], quote['to']
+        from_amount, to_amount = quote['from_amount'], quote['to_amount']
+        exchange_rate, margin_profit = quote['rate'], quote['margin_profit']
+    elif QUOTE_REQUIRED:
+        return error_response('Quote token required', 400)
+    
     if not all([from_currency, to_currency, from_amount, to_amount, exchange_rate]):
         return error_response('Missing required fields', 400)
     
-    import secrets
-    order_number = f"EX{secrets.token_hex(6).upper()}"
+    order_number = f"EX{os.urandom(6).hex().upper()}"
     
-    conn = psycopg2.connect(DSN)
+    conn = get_connection()
     cur = conn.cursor()
     
     try:
         cur.execute(
             """INSERT INTO exchange_orders 
                (partner_id, order_number, from_currency, to_currency, from_amount, to_amount, 
-                exchange_rate, margin_profit, customer_email, customer_contact, wallet_address, card_number, status)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+                exchange_rate, margin_profit, customer_email, customer_contact, wallet_address, card_number, status,
+                quote_nonce)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s)
+               ON CONFLICT (quote_nonce) WHERE quote_nonce IS NOT NULL DO NOTHING
                RETURNING id, order_number""",
             (partner_id, order_number, from_currency, to_currency, from_amount, to_amount,
-             exchange_rate, margin_profit, customer_email, customer_contact, wallet_address, card_number)
+             exchange_rate, margin_profit, customer_email, customer_contact, wallet_address, card_number,
+             quote_nonce)
         )
         
-        order_id, order_number = cur.fetchone()
+        result = cur.fetchone()
+        if result is None:
+            conn.rollback()
+            return error_response('Quote already used', 409)
+        
+        order_id, order_number = result
         conn.commit()
         
         return success_response({
@@ -141,26 +301,702 @@ def create_order(data: dict) -> dict:
         raise e
     finally:
         cur.close()
-        conn.close()
+        release_connection(conn)
 
 
-def success_response(data: dict) -> dict:
+class ConnectionPool:
+    '''
+    Пул соединений с БД, переживающий вызовы в теплом контейнере.
+    Соединение возвращается в пул без открытой транзакции и без сессионного
+    состояния, поэтому пул совместим с PgBouncer в режиме transaction.
+    '''
+    
+    def __init__(self, dsn: str, max_size: int, idle_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'discarded': 0}
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._metrics_logged_at = time.monotonic()
+    
+    def getconn(self, timeout: float = POOL_ACQUIRE_TIMEOUT):
+        started = time.monotonic()
+        
+        while True:
+            conn, idle_for = self._checkout(started, timeout)
+            
+            if conn is None:
+                try:
+                    import psycopg2
+                    with Span('db_connect'):
+                        conn = psycopg2.connect(self.dsn, cursor_factory=timed_cursor_class())
+                except Exception:
+                    self._forget()
+                    raise
+                return conn
+            
+            if idle_for < self.healthcheck_after or self._is_healthy(conn):
+                return conn
+            
+            self._discard(conn)
+    
+    def putconn(self, conn) -> None:
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        
+        self._maybe_log_metrics()
+    
+    def _checkout(self, started: float, timeout: float):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evict_idle(now)
+                
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self.stats['hits'] += 1
+                    return conn, now - released_at
+                
+                if self._size < self.max_size:
+                    self._size += 1
+                    self.stats['misses'] += 1
+                    return None, 0.0
+                
+                remaining = timeout - (now - started)
+                if remaining <= 0:
+                    raise TimeoutError(f'No free database connection after {timeout}s')
+                
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+                self.stats['wait_time'] += time.monotonic() - now
+    
+    def _evict_idle(self, now: float) -> None:
+        # Самые старые соединения лежат в начале списка
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self.stats['discarded'] += 1
+            conn.close()
+    
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self.stats['discarded'] += 1
+        self._forget()
+    
+    def _forget(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    def _maybe_log_metrics(self) -> None:
+        now = time.monotonic()
+        if now - self._metrics_logged_at < POOL_METRICS_INTERVAL:
+            return
+        self._metrics_logged_at = now
+        with self._cond:
+            print(json.dumps({'event': 'db_pool_metrics', 'size': self._size, 'idle': len(self._idle), **self.stats}))
+
+
+_pool = ConnectionPool(DSN, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_HEALTHCHECK_AFTER)
+
+
+def get_connection():
+    '''Берет соединение из пула контейнера'''
+    with Span('db_acquire'):
+        return _pool.getconn()
+
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул, откатывая незавершенную транзакцию'''
+    _pool.putconn(conn)
+
+
+_timed_cursor = None
+
+
+def timed_cursor_class():
+    '''Класс курсора соединений пула: каждый запрос - отдельный участок sql в трассировке вызова'''
+    
+    global _timed_cursor
+    if _timed_cursor is None:
+        import psycopg2.extensions
+        
+        class TimedCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                with Span('sql', query):
+                    return super().execute(query, vars)
+            
+            def executemany(self, query, vars_list):
+                with Span('sql', query):
+                    return super().executemany(query, vars_list)
+        
+        _timed_cursor = TimedCursor
+    return _timed_cursor
+
+
+class PartnerCache:
+    '''
+    LRU-кэш метаданных партнеров (id, код, ставка комиссии) с TTL; устаревание
+    ограничено только сроком записи, баланс и прочие изменяемые поля не кэшируются.
+    Неизвестные ключи кэшируются отдельно и на меньший срок, чтобы запросы
+    ботов со случайными кодами отсекались без БД и не вытесняли настоящих партнеров.
+    '''
+    
+    def __init__(self, max_size: int, ttl: float, negative_max_size: int, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_max_size = negative_max_size
+        self.negative_ttl = negative_ttl
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: tuple) -> Tuple[bool, Optional[dict]]:
+        now = time.monotonic()
+        
+        with self._lock:
+            for entries, counter in ((self._entries, 'hits'), (self._negative, 'negative_hits')):
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at <= now:
+                    del entries[key]
+                    continue
+                entries.move_to_end(key)
+                self.stats[counter] += 1
+                return True, value
+            
+            self.stats['misses'] += 1
+            return False, None
+    
+    def put(self, key: tuple, value: Optional[dict]) -> None:
+        if value is None:
+            entries, max_size, ttl = self._negative, self.negative_max_size, self.negative_ttl
+        else:
+            entries, max_size, ttl = self._entries, self.max_size, self.ttl
+        
+        with self._lock:
+            entries[key] = (time.monotonic() + ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > max_size:
+                entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+_partner_cache = PartnerCache(PARTNER_CACHE_SIZE, PARTNER_CACHE_TTL, PARTNER_NEGATIVE_CACHE_SIZE, PARTNER_NEGATIVE_TTL)
+
+
+class ClickFilter:
+    '''
+    Отсев кликов в памяти контейнера до обращения к БД.
+    
+    Лимит - token bucket на ключ (код партнера, IP) в LRU не больше max_keys
+    ключей; вытесненный ключ начинает с полной корзины. Дубли - два фильтра
+    Блума, текущий и предыдущий, которые меняются каждые dedup_window секунд:
+    ключ остается виденным от dedup_window до 2 * dedup_window секунд после
+    последнего появления. Память фиксирована, а за нее платим ложными дублями:
+    доля около error_rate, пока за окно приходит не больше capacity ключей.
+    '''
+    
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int,
+                 dedup_window: float, capacity: int, error_rate: float):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1.0, burst)
+        self.max_keys = max_keys
+        self.dedup_window = dedup_window
+        self.bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.stats = {'accepted': 0, 'duplicates': 0, 'rate_limited': 0, 'bucket_evictions': 0, 'rotations': 0}
+        self._buckets = OrderedDict()
+        self._current = bytearray((self.bits + 7) // 8) if dedup_window > 0 else None
+        self._previous = bytearray(len(self._current)) if dedup_window > 0 else None
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._metrics_logged_at = time.monotonic()
+    
+    def acquire(self, key: tuple) -> float:
+        '''0, если клик укладывается в лимит, иначе через сколько секунд появится токен'''
+        
+        if self.rate <= 0:
+            return 0.0
+        
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.stats['rate_limited'] += 1
+            
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.stats['bucket_evictions'] += 1
+        
+        self._maybe_log_metrics()
+        return wait
+    
+    def seen(self, key: str) -> bool:
+        '''Проверяет ключ на повтор в окне и запоминает его'''
+        
+        if self._current is None:
+            with self._lock:
+                self.stats['accepted'] += 1
+            return False
+        
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        positions = [(first + i * step) % self.bits for i in range(self.hashes)]
+        
+        with self._lock:
+            self._rotate(time.monotonic())
+            current, previous = self._current, self._previous
+            
+            duplicate = all(current[p >> 3] & (1 << (p & 7)) for p in positions)
+            if not duplicate:
+                duplicate = all(previous[p >> 3] & (1 << (p & 7)) for p in positions)
+                # Повтор из предыдущего окна переносим в текущее, чтобы частые повторы не выходили из фильтра
+                for p in positions:
+                    current[p >> 3] |= 1 << (p & 7)
+            
+            self.stats['duplicates' if duplicate else 'accepted'] += 1
+        
+        self._maybe_log_metrics()
+        return duplicate
+    
+    def _rotate(self, now: float) -> None:
+        elapsed = now - self._rotated_at
+        if elapsed < self.dedup_window:
+            return
+        # После простоя дольше двух окон устарели оба фильтра
+        self._previous = self._current if elapsed < 2 * self.dedup_window else bytearray(len(self._current))
+        self._current = bytearray(len(self._previous))
+        self._rotated_at = now
+        self.stats['rotations'] += 1
+    
+    def _maybe_log_metrics(self) -> None:
+        now = time.monotonic()
+        if now - self._metrics_logged_at < CLICK_FILTER_METRICS_INTERVAL:
+            return
+        self._metrics_logged_at = now
+        with self._lock:
+            print(json.dumps({'event': 'click_filter_metrics', 'buckets': len(self._buckets), **self.stats}))
+
+
+_click_filter = ClickFilter(
+    CLICK_RATE_PER_MINUTE, CLICK_RATE_BURST, CLICK_RATE_MAX_KEYS,
+    CLICK_DEDUP_WINDOW, CLICK_DEDUP_CAPACITY, CLICK_DEDUP_ERROR_RATE
+)
+
+
+class ClickBuffer:
+    '''
+    Буфер переходов для пакетной записи в partner_clicks многострочным INSERT.
+    
+    Гарантии сохранности. Без CLICK_SPOOL_PATH принятые, но не записанные клики
+    (не больше CLICK_BUFFER_MAX, обычно не старше CLICK_FLUSH_INTERVAL) теряются
+    при аварийной остановке контейнера; штатная остановка (SIGTERM, выход
+    интерпретатора) сбрасывает буфер в БД. Со спулом каждый клик дописывается
+    в локальный файл до ответа клиенту и переживает перезапуск процесса на том
+    же диске, а с CLICK_SPOOL_FSYNC=1 и сбой ОС. Сбой между COMMIT и очисткой
+    спула приводит к повторной записи пачки: доставка at-least-once.
+    '''
+    
+    def __init__(self, flush_size: int, flush_interval: float, max_size: int, spool_path: str = ''):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.spool_path = spool_path
+        self.stats = {'accepted': 0, 'flushed': 0, 'dropped': 0, 'flushes': 0, 'flush_errors': 0}
+        self._items = []
+        self._oldest_at = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+        
+        if spool_path:
+            self._items = self._read_spool(spool_path + '.flushing') + self._read_spool(spool_path)
+            self._oldest_at = time.monotonic()
+            self._rewrite_spool()
+    
+    def add(self, row: tuple) -> None:
+        with self._lock:
+            if not self._items:
+                self._oldest_at = time.monotonic()
+            self._items.append(row)
+            self.stats['accepted'] += 1
+            if self.spool_path:
+                self._append_spool([row])
+            pending = len(self._items)
+        
+        self._ensure_worker()
+        
+        # Переполненный буфер сбрасываем прямо в запросе, чтобы память оставалась ограниченной
+        if pending >= self.max_size:
+            self.flush()
+        elif pending >= self.flush_size:
+            self._wake.set()
+    
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._items = self._items, []
+                if self.spool_path and os.path.exists(self.spool_path):
+                    os.replace(self.spool_path, self.spool_path + '.flushing')
+            
+            if not batch:
+                return 0
+            
+            try:
+                insert_clicks(batch)
+            except Exception as e:
+                with self._lock:
+                    self.stats['flush_errors'] += 1
+                    self._items = batch + self._items
+                    overflow = len(self._items) - self.max_size
+                    if overflow > 0:
+                        del self._items[:overflow]
+                        self.stats['dropped'] += overflow
+                    if self.spool_path:
+                        self._rewrite_spool()
+                print(json.dumps({'event': 'click_flush_failed', 'pending': len(self._items), 'error': str(e)}))
+                return 0
+            
+            if self.spool_path and os.path.exists(self.spool_path + '.flushing'):
+                os.remove(self.spool_path + '.flushing')
+            
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['flushed'] += len(batch)
+            return len(batch)
+    
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True, name='click-flusher')
+                self._worker.start()
+    
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            with self._lock:
+                due = bool(self._items) and (
+                    len(self._items) >= self.flush_size
+                    or time.monotonic() - self._oldest_at >= self.flush_interval
+                )
+            if due:
+                self.flush()
+    
+    def _append_spool(self, rows: list) -> None:
+        with open(self.spool_path, 'a') as f:
+            f.writelines(json.dumps(row) + '\n' for row in rows)
+            if CLICK_SPOOL_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def _rewrite_spool(self) -> None:
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(json.dumps(row) + '\n' for row in self._items)
+            if CLICK_SPOOL_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.spool_path)
+        if os.path.exists(self.spool_path + '.flushing'):
+            os.remove(self.spool_path + '.flushing')
+    
+    @staticmethod
+    def _read_spool(path: str) -> list:
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [tuple(json.loads(line)) for line in f if line.strip()]
+
+
+def utc_now_iso() -> str:
+    '''Текущее время UTC в ISO 8601 с микросекундами, без импорта datetime'''
+    
+    now = time.time()
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)) + f'.{int(now % 1 * 1000000):06d}+00:00'
+
+
+def insert_clicks(rows: list) -> None:
+    '''Записывает пачку переходов одним многострочным INSERT'''
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    try:
+        from psycopg2.extras import execute_values
+        execute_values(
+            cur,
+            INSERT_CLICKS_SQL,
+            rows,
+            template='(%s, %s, %s, %s, %s, %s, %s::timestamptz)',
+            page_size=1000
+        )
+        conn.commit()
+        
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cur.close()
+        release_connection(conn)
+
+
+def flush_clicks_on_shutdown(*args) -> None:
+    '''Сбрасывает буфер кликов при остановке контейнера'''
+    
+    flushed = _click_buffer.flush()
+    print(json.dumps({'event': 'click_buffer_shutdown', 'flushed_on_shutdown': flushed, **_click_buffer.stats}))
+    
+    if args and callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(*args)
+    elif args:
+        raise SystemExit(0)
+
+
+_click_buffer = ClickBuffer(CLICK_FLUSH_SIZE, CLICK_FLUSH_INTERVAL, CLICK_BUFFER_MAX, CLICK_SPOOL_PATH)
+_previous_sigterm_handler = None
+
+if CLICK_INGEST_MODE == 'buffered':
+    atexit.register(flush_clicks_on_shutdown)
+    try:
+        _previous_sigterm_handler = signal.signal(signal.SIGTERM, flush_clicks_on_shutdown)
+    except ValueError:
+        # Модуль импортирован не из главного потока: остается только atexit
+        pass
+
+
+# Общий слой запросов и ответов. Функции деплоятся по отдельности, поэтому
+# блок одинаково скопирован в каждую index.py и меняется во всех сразу
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+class Request:
+    '''Событие вызова: заголовки в нижнем регистре, тело разбирается один раз и только по требованию'''
+    
+    __slots__ = ('event', 'method', 'params', 'headers', '_body')
+    
+    def __init__(self, event: dict):
+        self.event = event
+        self.method = event.get('httpMethod', 'GET')
+        self.params = event.get('queryStringParameters') or {}
+        self.headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        self._body = None
+    
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            with Span('json_decode'):
+                self._body = loads(self.event.get('body') or '{}')
+        return self._body
+    
+    @property
+    def action(self) -> Optional[str]:
+        return (self.params if self.method == 'GET' else self.body).get('action')
+
+
+_local = threading.local()
+
+
+class Trace:
+    '''Замеры одного вызова: (участок, мс, подробность) в порядке завершения'''
+    
+    __slots__ = ('action', 'started', 'spans')
+    
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.perf_counter()
+        self.spans = []
+    
+    def finish(self, status: int) -> float:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        print(json.dumps({
+            'event': 'request_timing',
+            'action': self.action,
+            'status': status,
+            'total_ms': round(total_ms, 2),
+            'spans': [
+                {'name': name, 'ms': round(ms, 2), **({'detail': span_detail(detail)} if detail is not None else {})}
+                for name, ms, detail in self.spans
+            ]
+        }))
+        return total_ms
+    
+    def server_timing(self, total_ms: float) -> str:
+        totals = {}
+        for name, ms, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + ms
+        return ', '.join([f'{name};dur={ms:.1f}' for name, ms in totals.items()] + [f'total;dur={total_ms:.1f}'])
+
+
+class Span:
+    '''Замер участка текущего вызова; вне трассированного вызова стоит одно обращение к thread-local'''
+    
+    __slots__ = ('name', 'detail', 'trace', 'started')
+    
+    def __init__(self, name: str, detail=None):
+        self.name = name
+        self.detail = detail
+        self.trace = getattr(_local, 'trace', None)
+    
+    def __enter__(self):
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.spans.append((self.name, (time.perf_counter() - self.started) * 1000, self.detail))
+
+
+def span_detail(detail) -> str:
+    # Текст SQL сжимается до начала запроса; значения execute_values после VALUES в лог не попадают
+    if isinstance(detail, bytes):
+        detail = detail.decode(errors='replace')
+    return ' '.join(str(detail).split()).split(' VALUES ', 1)[0][:120]
+
+
+def traced(request: 'Request', action: Optional[str], call: Callable[[], dict]) -> dict:
+    '''Выполняет действие, для выборки вызовов (TRACE_SAMPLE_RATE) записывая замеры его участков'''
+    
+    forced = TRACE_SERVER_TIMING and request.headers.get('x-trace') == '1'
+    if not forced and int.from_bytes(os.urandom(2), 'big') >= TRACE_SAMPLE_RATE * 65536:
+        return call()
+    
+    trace = _local.trace = Trace(action or 'default')
+    try:
+        response = call()
+    except Exception:
+        trace.finish(500)
+        raise
+    finally:
+        _local.trace = None
+    
+    total_ms = trace.finish(response['statusCode'])
+    if not TRACE_SERVER_TIMING:
+        return response
+    return {
+        **response,
+        'headers': {**response['headers'], 'Server-Timing': trace.server_timing(total_ms), 'Timing-Allow-Origin': '*'}
+    }
+
+
+def dispatch(event: dict, routes: dict, preflight: dict) -> dict:
+    '''Маршрут по методу и action; исключение действия превращается в ответ 500'''
+    
+    if event.get('httpMethod') == 'OPTIONS':
+        return preflight
+    
+    request = Request(event)
+    actions = routes.get(request.method)
+    if actions is None:
+        return error_response('Method not allowed', 405)
+    
+    try:
+        name = request.action
+        action = actions.get(name)
+        if action is None:
+            return error_response('Invalid action', 400)
+        return traced(request, name, lambda: action(request))
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+def preflight_response(methods: str, headers: str = 'Content-Type') -> dict:
     return {
         'statusCode': 200,
         'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': headers,
+            'Access-Control-Max-Age': '86400'
         },
-        'body': json.dumps({'success': True, **data})
+        'body': ''
     }
 
 
+def json_default(value):
+    # date/datetime и Decimal распознаются по методам, чтобы не импортировать их модули ради isinstance
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'as_integer_ratio'):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(data) -> str:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    loads = orjson.loads
+else:
+    def dumps(data) -> str:
+        return json.dumps(data, default=json_default, ensure_ascii=False)
+    
+    loads = json.loads
+
+
+def encode_body(data: dict) -> str:
+    with Span('json_encode'):
+        return dumps(data)
+
+
+def success_response(data: dict) -> dict:
+    return {'statusCode': 200, 'headers': JSON_HEADERS, 'body': encode_body({'success': True, **data})}
+
+
 def error_response(message: str, status_code: int = 400) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'success': False, 'error': message})
+    return {'statusCode': status_code, 'headers': JSON_HEADERS, 'body': encode_body({'success': False, 'error': message})}
+
+
+PREFLIGHT = preflight_response('POST, OPTIONS')
+
+ROUTES = {
+    'POST': {
+        'track_click': lambda request: track_click(request.body, request.event, request.headers),
+        'create_order': lambda request: create_order(request.body)
     }
+}
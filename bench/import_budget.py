@@ -0,0 +1,166 @@
+'''
+Профиль холодного старта функций и проверка бюджета времени импорта.
+
+Для каждой backend/<функция>/index.py запускает чистый интерпретатор с
+-X importtime, замеряет время загрузки модуля и первого вызова handler
+(по умолчанию OPTIONS, с --first-request tests - первый не-OPTIONS случай
+из tests.json функции; для него нужны DATABASE_URL и сеть) и печатает самые
+тяжелые импорты верхнего уровня. Код возврата 1, если медиана времени
+импорта какой-либо функции превышает бюджет из bench/import_budget.json.
+Время импорта включает компиляцию index.py: байткод из __pycache__ не используется.
+
+    python bench/import_budget.py
+    python bench/import_budget.py --only get-rates --tree 15
+    python bench/import_budget.py --update    # записать бюджеты: замер x HEADROOM
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_budget.json')
+HEADROOM = 1.5
+START_MARKER = '--- import start'
+END_MARKER = '--- import end'
+
+CHILD = '''
+import importlib.util, json, sys, time
+
+path, first_request = sys.argv[1], sys.argv[2]
+event = json.loads(first_request)
+
+sys.stderr.write(%r + "\\n")
+sys.stderr.flush()
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("index", path)
+module = importlib.util.module_from_spec(spec)
+# index.py компилируется всегда: в свежем контейнере __pycache__ нет, а устаревший
+# кэш (при PYTHONDONTWRITEBYTECODE он не перезаписывается) делал замеры бимодальными
+exec(compile(spec.loader.get_source("index"), path, "exec"), module.__dict__)
+imported = time.perf_counter()
+sys.stderr.write(%r + "\\n")
+sys.stderr.flush()
+
+response = module.handler(event, None)
+finished = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (finished - imported) * 1000,
+    "status": response["statusCode"]
+}))
+''' % (START_MARKER, END_MARKER)
+
+
+def list_functions() -> list:
+    backend = os.path.join(ROOT, 'backend')
+    return sorted(
+        name for name in os.listdir(backend)
+        if os.path.isfile(os.path.join(backend, name, 'index.py'))
+    )
+
+
+def first_request_event(name: str, mode: str) -> dict:
+    if mode == 'options':
+        return {'httpMethod': 'OPTIONS'}
+
+    with open(os.path.join(ROOT, 'backend', name, 'tests.json')) as f:
+        cases = json.load(f)['tests']
+    case = next((c for c in cases if c.get('method') != 'OPTIONS'), None)
+    if case is None:
+        return {'httpMethod': 'OPTIONS'}
+
+    event = {'httpMethod': case.get('method', 'GET'), 'headers': case.get('headers', {})}
+    if 'body' in case:
+        event['body'] = json.dumps(case['body'])
+    if 'query' in case:
+        event['queryStringParameters'] = case['query']
+    return event
+
+
+def parse_importtime(stderr: str) -> list:
+    '''(модуль, накопленное время мс) для импортов верхнего уровня, сделанных самим index.py'''
+
+    lines = stderr.splitlines()
+    try:
+        lines = lines[lines.index(START_MARKER) + 1:lines.index(END_MARKER)]
+    except ValueError:
+        return []
+
+    imports = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|', 2)
+        if not cumulative.strip().isdigit():
+            continue
+        if len(name) - len(name.lstrip()) == 1:
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return imports
+
+
+def profile(name: str, event: dict) -> dict:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD,
+         os.path.join(ROOT, 'backend', name, 'index.py'), json.dumps(event)],
+        capture_output=True, text=True, cwd=os.path.join(ROOT, 'backend', name)
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'{name}: {result.stderr.strip().splitlines()[-1]}')
+
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    measurement['imports'] = parse_importtime(result.stderr)
+    return measurement
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--only', action='append', help='профилировать только эту функцию (можно повторять)')
+    parser.add_argument('--tree', type=int, default=5, help='сколько самых тяжелых импортов показать')
+    parser.add_argument('--first-request', choices=['options', 'tests'], default='options')
+    parser.add_argument('--update', action='store_true', help='перезаписать бюджеты по текущему замеру')
+    args = parser.parse_args()
+
+    budgets = {}
+    if os.path.exists(BUDGET_PATH):
+        with open(BUDGET_PATH) as f:
+            budgets = json.load(f)
+
+    report = {}
+    failed = []
+
+    for name in args.only or list_functions():
+        event = first_request_event(name, args.first_request)
+        runs = [profile(name, event) for _ in range(args.runs)]
+        import_ms = statistics.median(run['import_ms'] for run in runs)
+        slowest = sorted(runs[-1]['imports'], key=lambda item: item[1], reverse=True)[:args.tree]
+
+        report[name] = {
+            'import_ms': round(import_ms, 1),
+            'first_request_ms': round(statistics.median(run['first_request_ms'] for run in runs), 1),
+            'first_request_status': runs[-1]['status'],
+            'budget_ms': budgets.get(name),
+            'heaviest_imports_ms': {module: round(ms, 1) for module, ms in slowest}
+        }
+
+        if args.update:
+            budgets[name] = int(import_ms * HEADROOM) + 1
+        elif name in budgets and import_ms > budgets[name]:
+            failed.append(name)
+
+    if args.update:
+        with open(BUDGET_PATH, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    print(json.dumps({'functions': report, 'over_budget': failed}, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+'''
+Нагрузочный прогон функций по их tests.json.
+
+Каждый не-OPTIONS случай из backend/<функция>/tests.json превращается в
+сценарий: handler вызывается в процессе с синтетическими событиями (уникальные
+email, разные IP и User-Agent) с заданной параллельностью. Функции с psycopg2
+в requirements.txt работают с локальным PostgreSQL из DATABASE_URL (без него
+пропускаются), get-rates ходит в локальную заглушку провайдеров.
+
+Результат - rps и p50/p95/p99 по каждому сценарию - сохраняется в
+bench/results/loadtest-<коммит>.json и сравнивается с последним прогоном
+другого коммита, чтобы регрессии были видны сразу.
+
+    DATABASE_URL=postgresql://postgres@localhost/exchange \
+        python bench/loadtest.py --migrate --requests 2000 --concurrency 32
+    python bench/loadtest.py --only get-rates --upstream-latency-ms 80 --rates-cache-ttl 0
+'''
+
+import argparse
+import copy
+import glob
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from upstream_stub import start_stub, stub_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/124.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0'
+]
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, 'backend', name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Функции, которым БД нужна только в части режимов: get-rates без DATABASE_URL
+# не пишет историю, а в Postgres ходит лишь с хранилищем снимков RATES_SNAPSHOT_STORE=postgres
+OPTIONAL_DATABASE = {
+    'get-rates': lambda: os.environ.get('RATES_SNAPSHOT_STORE') == 'postgres'
+}
+
+
+def needs_database(name: str) -> bool:
+    if name in OPTIONAL_DATABASE:
+        return OPTIONAL_DATABASE[name]()
+    path = os.path.join(ROOT, 'backend', name, 'requirements.txt')
+    return os.path.exists(path) and 'psycopg2' in open(path).read()
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def discover_scenarios(functions: list, include_options: bool) -> list:
+    scenarios = []
+    for name in functions:
+        path = os.path.join(ROOT, 'backend', name, 'tests.json')
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            cases = json.load(f)['tests']
+
+        for case in cases:
+            method = case.get('method', 'GET')
+            if method == 'OPTIONS' and not include_options:
+                continue
+            query = {**dict(parse_qsl(case.get('path', '/').partition('?')[2])), **case.get('query', {})}
+            action = (case.get('body') or {}).get('action') or query.get('action') or case['name']
+            scenarios.append({'function': name, 'name': f'{name} {method} {action}', 'case': case, 'query': query})
+    return scenarios
+
+
+def synthesize_event(scenario: dict, index: int, run_id: str) -> dict:
+    '''Событие вызова по случаю из tests.json; email делаются уникальными, чтобы регистрации не конфликтовали'''
+
+    case = scenario['case']
+    body = copy.deepcopy(case.get('body'))
+    if isinstance(body, dict):
+        for key, value in body.items():
+            if isinstance(value, str) and '@' in value:
+                body[key] = f'load-{run_id}-{index}@example.com'
+
+    event = {
+        'httpMethod': case.get('method', 'GET'),
+        'headers': {**case.get('headers', {}), 'user-agent': random.choice(USER_AGENTS)},
+        'queryStringParameters': dict(scenario['query']),
+        'requestContext': {'identity': {'sourceIp': f'10.{index % 250}.{(index // 250) % 250}.{random.randint(1, 254)}'}}
+    }
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return event
+
+
+def run_scenario(handler, scenario: dict, requests: int, concurrency: int, warmup: int, run_id: str) -> dict:
+    expected = scenario['case'].get('expectedStatus', 200)
+
+    def call(index: int):
+        event = synthesize_event(scenario, index, run_id)
+        started = time.perf_counter()
+        response = handler(event, None)
+        return response['statusCode'], (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(-warmup, 0)))
+
+        started = time.perf_counter()
+        results = list(pool.map(call, range(requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for _, latency in results]
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'unexpected_status': sum(1 for status, _ in results if status != expected),
+        'statuses': statuses
+    }
+
+
+def apply_migrations(dsn: str) -> None:
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            for path in sorted(glob.glob(os.path.join(ROOT, 'db_migrations', 'V*.sql'))):
+                with open(path) as f:
+                    cur.execute(f.read())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=ROOT, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', 'backend'], capture_output=True, text=True, cwd=ROOT).stdout
+        return f'{commit}-dirty' if dirty.strip() else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def latest_baseline(commit: str):
+    candidates = [
+        path for path in glob.glob(os.path.join(RESULTS_DIR, 'loadtest-*.json'))
+        if os.path.basename(path) != f'loadtest-{commit}.json'
+    ]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    '''Изменение rps и p99 относительно базового прогона, в процентах'''
+
+    deltas = {}
+    for name, current in results.items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous or not previous.get('rps') or not previous.get('p99_ms'):
+            continue
+        deltas[name] = {
+            'rps_change_pct': round((current['rps'] / previous['rps'] - 1) * 100, 1),
+            'p99_change_pct': round((current['p99_ms'] / previous['p99_ms'] - 1) * 100, 1)
+        }
+    return deltas
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--only', action='append', help='прогнать только эту функцию (можно повторять)')
+    parser.add_argument('--include-options', action='store_true', help='нагружать и CORS preflight')
+    parser.add_argument('--migrate', action='store_true', help='применить db_migrations перед прогоном')
+    parser.add_argument('--upstream-latency-ms', type=float, default=50)
+    parser.add_argument('--rates-cache-ttl', help='RATES_CACHE_TTL для get-rates (0 - каждый запрос идет в заглушку)')
+    parser.add_argument('--baseline', help='файл результатов для сравнения (по умолчанию последний прогон другого коммита)')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--max-regression-pct', type=float, help='код возврата 1, если p99 вырос больше, чем на столько процентов')
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    stub = start_stub(latency_ms=args.upstream_latency_ms)
+    os.environ.update(stub_env(stub))
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+    os.environ.setdefault('DB_POOL_ACQUIRE_TIMEOUT', '60')
+    if args.rates_cache_ttl is not None:
+        os.environ['RATES_CACHE_TTL'] = args.rates_cache_ttl
+        os.environ.setdefault('RATES_STALE_WHILE_REVALIDATE', '0')
+
+    if args.migrate and dsn:
+        apply_migrations(dsn)
+
+    functions = args.only or sorted(
+        name for name in os.listdir(os.path.join(ROOT, 'backend'))
+        if os.path.isfile(os.path.join(ROOT, 'backend', name, 'index.py'))
+    )
+    skipped = [name for name in functions if needs_database(name) and not dsn]
+    functions = [name for name in functions if name not in skipped]
+
+    run_id = uuid.uuid4().hex[:8]
+    handlers = {name: load_function(name).handler for name in functions}
+    results = {}
+
+    for scenario in discover_scenarios(functions, args.include_options):
+        results[scenario['name']] = run_scenario(
+            handlers[scenario['function']], scenario, args.requests, args.concurrency, args.warmup, run_id
+        )
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'upstream_latency_ms': args.upstream_latency_ms,
+        'upstream_requests': stub.requests,
+        'skipped_without_database': skipped,
+        'scenarios': results
+    }
+
+    baseline_path = args.baseline or latest_baseline(commit)
+    if baseline_path:
+        with open(baseline_path) as f:
+            report['baseline'] = {'file': os.path.relpath(baseline_path, ROOT), 'changes': compare(results, json.load(f))}
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(os.path.join(RESULTS_DIR, f'loadtest-{commit}.json'), 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+
+    stub.shutdown()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.max_regression_pct is not None and 'baseline' in report:
+        regressed = [
+            name for name, change in report['baseline']['changes'].items()
+            if change['p99_change_pct'] > args.max_regression_pct
+        ]
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
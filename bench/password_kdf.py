@@ -0,0 +1,154 @@
+'''
+Замер стоимости проверки пароля в partner-auth при заданных параметрах scrypt.
+
+Без DATABASE_URL меряет verify_password напрямую: холодные проверки (KDF на
+каждый вызов) и повторные (попадание в кэш проверок). С DATABASE_URL создает
+тестового партнера и гоняет action=login через handler функции, включая
+переход со старого sha256-хэша на scrypt при первом входе.
+
+    python bench/password_kdf.py --n 16384 --requests 200 --concurrency 8
+    DATABASE_URL=postgresql://postgres@localhost/exchange \
+        python bench/password_kdf.py --n 32768 --workers 4
+
+Схема БД должна быть создана миграциями из db_migrations.
+'''
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, 'backend', name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure(call, requests: int, concurrency: int) -> dict:
+    def timed(_):
+        started = time.perf_counter()
+        ok = call()
+        return ok, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(requests)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for _, latency in results]
+
+    return {
+        'requests': requests,
+        'failures': sum(1 for ok, _ in results if not ok),
+        'throughput_rps': round(requests / elapsed, 1),
+        'latency_ms': {
+            'p50': round(statistics.median(latencies), 2),
+            'p99': round(percentile(latencies, 0.99), 2)
+        }
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=16384)
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--p', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=2, help='PASSWORD_KDF_WORKERS')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    os.environ['PASSWORD_SCRYPT_N'] = str(args.n)
+    os.environ['PASSWORD_SCRYPT_R'] = str(args.r)
+    os.environ['PASSWORD_SCRYPT_P'] = str(args.p)
+    os.environ['PASSWORD_KDF_WORKERS'] = str(args.workers)
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(min(args.concurrency, 50)))
+    os.environ.setdefault('DB_POOL_ACQUIRE_TIMEOUT', '60')
+    auth = load_function('partner-auth')
+
+    password = secrets.token_hex(8)
+    report = {'scrypt': {'n': args.n, 'r': args.r, 'p': args.p}, 'workers': args.workers, 'concurrency': args.concurrency}
+
+    if not os.environ.get('DATABASE_URL'):
+        stored = auth.hash_password(password)
+        cache_size = auth._verified.max_size
+
+        auth._verified.max_size = 0
+        report['verify_cold'] = measure(lambda: auth.verify_password(password, stored)[0], args.requests, args.concurrency)
+
+        auth._verified.max_size = cache_size
+        auth.verify_password(password, stored)
+        report['verify_cached'] = measure(lambda: auth.verify_password(password, stored)[0], args.requests, args.concurrency)
+
+        print(json.dumps(report, indent=2))
+        return 0
+
+    email = f'bench-{secrets.token_hex(4)}@example.com'
+    conn = auth.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """INSERT INTO partners (email, password_hash, partner_code)
+           VALUES (%s, %s, %s) RETURNING id""",
+        (email, hashlib.sha256(password.encode()).hexdigest(), 'BENCH' + secrets.token_hex(4).upper())
+    )
+    partner_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    auth.release_connection(conn)
+
+    def login(secret: str = password) -> bool:
+        response = auth.handler({
+            'httpMethod': 'POST',
+            'body': json.dumps({'action': 'login', 'email': email, 'password': secret})
+        }, None)
+        return response['statusCode'] == 200
+
+    try:
+        started = time.perf_counter()
+        migrated = login()
+        report['first_login_with_rehash_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        conn = auth.get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT password_hash FROM partners WHERE id = %s", (partner_id,))
+        report['rehashed'] = migrated and cur.fetchone()[0].startswith('scrypt$')
+        cur.close()
+        auth.release_connection(conn)
+
+        cache_size = auth._verified.max_size
+        auth._verified.max_size = 0
+        auth._verified._entries.clear()
+        report['login_cold'] = measure(login, args.requests, args.concurrency)
+
+        auth._verified.max_size = cache_size
+        login()
+        report['login_cached'] = measure(login, args.requests, args.concurrency)
+        report['login_wrong_password'] = measure(lambda: not login('wrong-password'), args.requests, args.concurrency)
+    finally:
+        conn = auth.get_connection()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM partners WHERE id = %s", (partner_id,))
+        conn.commit()
+        cur.close()
+        auth.release_connection(conn)
+
+    print(json.dumps(report, indent=2))
+    return 0 if report['rehashed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
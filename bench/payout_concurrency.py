@@ -0,0 +1,167 @@
+'''
+Нагрузочная проверка request_payout на локальном PostgreSQL.
+
+Создает тестового партнера с балансом, запускает сотни параллельных заявок
+на выплату (часть - повторы с тем же ключом идемпотентности) через handler
+функции partner-dashboard, затем повторяет каждый ключ после исчерпания баланса,
+и проверяет инварианты: баланс не ушел в минус, сумма созданных выплат равна
+списанию, на каждый ключ создана одна выплата, а все ответы по ключу с выплатой -
+200 с ее payout_id.
+
+    DATABASE_URL=postgresql://postgres@localhost/exchange \
+        python bench/payout_concurrency.py --requests 500 --concurrency 100
+
+Схема БД должна быть создана миграциями из db_migrations.
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, 'backend', name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--amount', type=float, default=1000)
+    parser.add_argument('--balance', type=float, default=150000)
+    parser.add_argument('--duplicates', type=float, default=0.3, help='доля запросов, повторяющих чужой ключ')
+    args = parser.parse_args()
+    
+    if not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is required', file=sys.stderr)
+        return 2
+    
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(min(args.concurrency, 50)))
+    os.environ.setdefault('DB_POOL_ACQUIRE_TIMEOUT', '60')
+    # Токен партнера подписывает partner-auth тем же ключом, который проверяет кабинет
+    os.environ.setdefault('AUTH_TOKEN_KEYS', f'bench:{secrets.token_hex(32)}')
+    dashboard = load_function('partner-dashboard')
+    auth = load_function('partner-auth')
+    
+    conn = dashboard.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """INSERT INTO partners (email, password_hash, partner_code, balance)
+           VALUES (%s, 'bench', %s, %s) RETURNING id""",
+        (f'bench-{secrets.token_hex(4)}@example.com', 'BENCH' + secrets.token_hex(4).upper(), args.balance)
+    )
+    partner_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    dashboard.release_connection(conn)
+    token, _ = auth.generate_token(partner_id)
+    
+    unique_keys = max(1, int(args.requests * (1 - args.duplicates)))
+    keys = [f'key-{i % unique_keys}' for i in range(args.requests)]
+    
+    def request(key: str):
+        started = time.perf_counter()
+        response = dashboard.handler({
+            'httpMethod': 'POST',
+            'headers': {'idempotency-key': key, 'authorization': f'Bearer {token}'},
+            'body': json.dumps({
+                'action': 'request_payout',
+                'amount': args.amount,
+                'payment_method': 'RUB-SBP',
+                'payment_details': 'bench'
+            })
+        }, None)
+        return response['statusCode'], json.loads(response['body']), time.perf_counter() - started
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(request, keys))
+    elapsed = time.perf_counter() - started
+    
+    # Повтор каждого ключа после того, как баланс исчерпан: должен вернуть исходную заявку
+    retries = [request(key) for key in keys[:unique_keys]]
+    
+    conn = dashboard.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT balance FROM partners WHERE id = %s", (partner_id,))
+    final_balance = float(cur.fetchone()[0])
+    cur.execute(
+        """SELECT COUNT(*), COALESCE(SUM(amount), 0), COUNT(DISTINCT idempotency_key)
+           FROM partner_payouts WHERE partner_id = %s""",
+        (partner_id,)
+    )
+    payouts, paid, distinct_keys = cur.fetchone()
+    
+    cur.execute("DELETE FROM partner_payouts WHERE partner_id = %s", (partner_id,))
+    cur.execute("DELETE FROM partner_stats WHERE partner_id = %s", (partner_id,))
+    cur.execute("DELETE FROM partners WHERE id = %s", (partner_id,))
+    conn.commit()
+    cur.close()
+    dashboard.release_connection(conn)
+    
+    statuses = {}
+    for status, body, _ in results:
+        label = f"{status}{' duplicate' if body.get('duplicate') else ''}"
+        statuses[label] = statuses.get(label, 0) + 1
+    latencies = [latency * 1000 for _, _, latency in results]
+    
+    # Ответы по каждому ключу: все 200 с одним payout_id, если выплата по ключу создана
+    responses = {}
+    for key, (status, body, _) in zip(keys + keys[:unique_keys], results + retries):
+        responses.setdefault(key, []).append((status, body.get('payout_id')))
+    paid_keys = {
+        key: answers[0][1] for key, answers in responses.items()
+        if any(status == 200 for status, _ in answers)
+    }
+    
+    checks = {
+        'authorized': all(status != 401 for status, _, _ in results + retries),
+        'payouts_created': payouts > 0,
+        'balance_not_negative': final_balance >= 0,
+        'debits_match_payouts': abs(args.balance - final_balance - float(paid)) < 0.005,
+        'debits_match_responses': abs(args.balance - final_balance - len(paid_keys) * args.amount) < 0.005,
+        'one_payout_per_key': payouts == distinct_keys == len(paid_keys),
+        'retries_return_original_payout': all(
+            answers == [(200, answers[0][1])] * len(answers) and answers[0][1] is not None
+            for key, answers in responses.items() if key in paid_keys
+        ),
+        'no_overdraft': float(paid) <= args.balance
+    }
+    
+    print(json.dumps({
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(args.requests / elapsed, 1),
+        'latency_ms': {
+            'p50': round(statistics.median(latencies), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2)
+        },
+        'statuses': statuses,
+        'payouts': payouts,
+        'final_balance': final_balance,
+        'checks': checks
+    }, indent=2, ensure_ascii=False))
+    
+    return 0 if all(checks.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+'''
+Накладные расходы общего слоя запросов/ответов на вызов, без БД.
+
+Сравнивает прежнюю схему обработчиков (заголовки собираются на каждый ответ,
+json.loads тела, цепочка if по action, ручные float()/isoformat() для строк
+истории и json.dumps) с handler функции partner-dashboard: dispatch по таблице
+маршрутов, готовые заголовки и dumps с быстрым путем через orjson.
+
+    python bench/runtime_overhead.py --rows 100 --number 2000
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_function(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, 'backend', name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_error_response(message: str, status_code: int = 400) -> dict:
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'success': False, 'error': message})
+    }
+
+
+def legacy_success_response(data: dict) -> dict:
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({'success': True, **data})
+    }
+
+
+def legacy_handler(event: dict) -> dict:
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, Idempotency-Key',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+    
+    try:
+        body = json.loads(event.get('body', '{}'))
+        action = body.get('action')
+        
+        if action == 'request_payout':
+            return legacy_success_response({})
+        elif action == 'complete_order':
+            return legacy_success_response({})
+        else:
+            return legacy_error_response('Invalid action', 400)
+    except Exception as e:
+        return legacy_error_response(str(e), 500)
+
+
+def legacy_earning_row(row: tuple) -> dict:
+    return {
+        'id': row[0],
+        'amount': float(row[1]),
+        'commission_rate': float(row[2]),
+        'order_amount': float(row[3]),
+        'order_direction': row[4],
+        'earned_at': row[5].isoformat() if row[5] else None,
+        'order_number': row[6]
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100, help='строк в странице истории')
+    parser.add_argument('--number', type=int, default=2000, help='повторов на замер')
+    args = parser.parse_args()
+    
+    dashboard = load_function('partner-dashboard')
+    
+    started = datetime(2024, 1, 1)
+    rows = [
+        (i, Decimal('123.45'), Decimal('2.00'), Decimal('61725.00'), 'USDT-TRC20 → RUB-SBP',
+         started + timedelta(minutes=i), f'EX{i:012X}')
+        for i in range(args.rows)
+    ]
+    preflight = {'httpMethod': 'OPTIONS'}
+    invalid = {'httpMethod': 'POST', 'body': json.dumps({'action': 'unknown', 'order_id': 1})}
+    
+    cases = {
+        'preflight': (
+            lambda: legacy_handler(preflight),
+            lambda: dashboard.handler(preflight, None)
+        ),
+        'invalid_action': (
+            lambda: legacy_handler(invalid),
+            lambda: dashboard.handler(invalid, None)
+        ),
+        f'history_page_{args.rows}_rows': (
+            lambda: legacy_success_response({'earnings': [legacy_earning_row(row) for row in rows], 'next_cursor': None}),
+            lambda: dashboard.success_response({'earnings': [dashboard.earning_row(row) for row in rows], 'next_cursor': None})
+        )
+    }
+    
+    report = {'orjson': dashboard.orjson is not None, 'cases': {}}
+    for name, (before, after) in cases.items():
+        before_us = min(timeit.repeat(before, number=args.number, repeat=5)) / args.number * 1e6
+        after_us = min(timeit.repeat(after, number=args.number, repeat=5)) / args.number * 1e6
+        report['cases'][name] = {
+            'before_us': round(before_us, 2),
+            'after_us': round(after_us, 2),
+            'speedup': round(before_us / after_us, 2)
+        }
+    
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
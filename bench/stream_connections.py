@@ -0,0 +1,171 @@
+'''
+Сколько SSE-клиентов держит один процесс stream_server.py на ядро.
+
+Запускает backend/get-rates/stream_server.py отдельным процессом против
+локальной заглушки провайдеров (снимок меняется каждые --broadcast-interval
+секунд), подключает N клиентов EventSource-протоколом и в течение --duration
+секунд снимает с процесса сервера CPU и RSS из /proc, а с клиентов - время
+получения каждой версии. Разброс получения одной версии между клиентами -
+время рассылки снимка всем подключенным.
+
+connections_per_core - линейная оценка: N / доля ядра, которую сервер тратил
+при этой частоте обновлений.
+
+    python bench/stream_connections.py --connections 1000,5000,10000 --duration 20
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from upstream_stub import start_stub, stub_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, 'backend', 'get-rates', 'stream_server.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def process_usage(pid: int) -> tuple:
+    '''(CPU-секунды, RSS в МБ) процесса'''
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    with open(f'/proc/{pid}/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    return cpu, rss_kb / 1024
+
+
+def raise_file_limit() -> None:
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def client(host: str, port: int, received: dict, connected: list, target: int, ready: asyncio.Event) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'GET /stream HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n')
+    await reader.readuntil(b'\r\n\r\n')
+    connected.append(writer)
+    if len(connected) == target:
+        ready.set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b'id: '):
+                received.setdefault(line[4:].strip().decode(), []).append(time.perf_counter())
+    except (ConnectionError, asyncio.CancelledError):
+        return
+
+
+async def run_level(host: str, port: int, pid: int, connections: int, duration: float) -> dict:
+    received = {}
+    connected = []
+    ready = asyncio.Event()
+
+    _, rss_idle = process_usage(pid)
+    started = time.perf_counter()
+    tasks = []
+    for offset in range(0, connections, 500):
+        tasks.extend(
+            asyncio.create_task(client(host, port, received, connected, connections, ready))
+            for _ in range(offset, min(connections, offset + 500))
+        )
+        await asyncio.sleep(0.05)
+    await asyncio.wait_for(ready.wait(), 120)
+    connect_seconds = time.perf_counter() - started
+
+    received.clear()
+    cpu_start, rss_connected = process_usage(pid)
+    await asyncio.sleep(duration)
+    cpu_end, rss_end = process_usage(pid)
+
+    for writer in connected:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Версии, которые за окно замера дошли до всех клиентов
+    complete = [times for times in received.values() if len(times) >= connections]
+    spreads = [(max(times) - min(times)) * 1000 for times in complete]
+    cpu_share = (cpu_end - cpu_start) / duration
+
+    return {
+        'connections': connections,
+        'connect_seconds': round(connect_seconds, 2),
+        'rss_mb': round(rss_end, 1),
+        'rss_per_connection_kb': round((rss_connected - rss_idle) * 1024 / connections, 2),
+        'server_cpu_share': round(cpu_share, 3),
+        'broadcasts_delivered': len(complete),
+        'fanout_spread_ms': {
+            'p50': round(statistics.median(spreads), 1) if spreads else None,
+            'max': round(max(spreads), 1) if spreads else None
+        },
+        'connections_per_core': int(connections / cpu_share) if cpu_share > 0 else None
+    }
+
+
+async def run(args, host: str, port: int, pid: int) -> list:
+    results = []
+    for connections in args.connections:
+        results.append(await run_level(host, port, pid, connections, args.duration))
+        await asyncio.sleep(1)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=lambda value: [int(n) for n in value.split(',')], default=[1000, 5000])
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--broadcast-interval', type=float, default=1, help='как часто меняется снимок, секунд')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    stub = start_stub()
+    env = {
+        **os.environ,
+        **stub_env(stub),
+        'RATES_CACHE_TTL': str(args.broadcast_interval),
+        'RATES_STALE_WHILE_REVALIDATE': '0',
+        'TRACE_SAMPLE_RATE': '0',
+        'STREAM_POLL': str(min(0.2, args.broadcast_interval / 2)),
+        'STREAM_MAX_CLIENTS': str(max(args.connections) + 100)
+    }
+    server = subprocess.Popen(
+        [sys.executable, SERVER, '--host', '127.0.0.1', '--port', '0'],
+        env=env, stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(SERVER)
+    )
+
+    try:
+        started = json.loads(server.stdout.readline())
+        host, port = started['address'][0], int(started['address'][1])
+        # Дальнейшие логи сервера вычитываются, чтобы он не встал на заполненном канале
+        threading.Thread(target=server.stdout.read, daemon=True).start()
+        time.sleep(max(1.0, args.broadcast_interval * 2))
+
+        results = asyncio.run(run(args, host, port, server.pid))
+    finally:
+        server.terminate()
+        server.wait(10)
+        stub.shutdown()
+
+    print(json.dumps({
+        'cpus': os.cpu_count(),
+        'broadcast_interval': args.broadcast_interval,
+        'upstream_requests': stub.requests,
+        'levels': results
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+'''
+Локальная заглушка провайдеров курсов для нагрузочных тестов get-rates.
+
+Отвечает в форматах CoinGecko, CryptoCompare, exchangerate-api и ЦБ РФ
+курсами из backend/get-rates/fixtures/rates.json с небольшим шумом и
+заданной задержкой. Адреса для функции дает stub_env().
+
+    python bench/upstream_stub.py --port 8089 --latency-ms 80
+'''
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_PATH = os.path.join(ROOT, 'backend', 'get-rates', 'fixtures', 'rates.json')
+
+COINGECKO_IDS = {
+    'BTC': 'bitcoin',
+    'ETH': 'ethereum',
+    'USDT': 'tether',
+    'TRX': 'tron',
+    'XRP': 'ripple',
+    'TON': 'the-open-network',
+    'USDC': 'usd-coin'
+}
+
+
+def load_rates() -> dict:
+    with open(FIXTURE_PATH) as f:
+        return json.load(f)
+
+
+def render(path: str, rates: dict, jitter: float) -> dict:
+    def noisy(value: float) -> float:
+        return value * (1 + random.uniform(-jitter, jitter))
+
+    if path == '/coingecko':
+        return {COINGECKO_IDS[symbol]: {'rub': noisy(rate)} for symbol, rate in rates['crypto'].items()}
+    if path == '/cryptocompare':
+        return {symbol: {'RUB': noisy(rate)} for symbol, rate in rates['crypto'].items()}
+    if path == '/exchangerate':
+        return {'base': 'RUB', 'rates': {currency: 1 / noisy(rate) for currency, rate in rates['fiat'].items()}}
+    if path == '/cbr':
+        return {'Valute': {currency: {'Nominal': 1, 'Value': noisy(rate)} for currency, rate in rates['fiat'].items()}}
+    return None
+
+
+def start_stub(port: int = 0, latency_ms: float = 0, jitter: float = 0.001) -> ThreadingHTTPServer:
+    '''Запускает заглушку в фоновом потоке; адрес - server.server_address'''
+
+    rates = load_rates()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+
+            payload = render(self.path.split('?', 1)[0], rates, jitter)
+            body = json.dumps(payload if payload is not None else {'error': 'not found'}).encode()
+
+            self.send_response(200 if payload is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.server.requests += 1
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stub_env(server: ThreadingHTTPServer) -> dict:
+    '''Переменные окружения get-rates, направляющие всех провайдеров на заглушку'''
+
+    host, port = server.server_address
+    base = f'http://{host}:{port}'
+    return {
+        'RATES_COINGECKO_URL': f'{base}/coingecko',
+        'RATES_CRYPTOCOMPARE_URL': f'{base}/cryptocompare',
+        'RATES_EXCHANGERATE_URL': f'{base}/exchangerate',
+        'RATES_CBR_URL': f'{base}/cbr'
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    server = start_stub(args.port, args.latency_ms)
+    for name, value in stub_env(server).items():
+        print(f'export {name}={value}')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
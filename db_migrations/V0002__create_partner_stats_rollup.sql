@@ -0,0 +1,65 @@
+-- Накопленная статистика партнера, обновляется инкрементально при записи кликов, заказов и выплат
+CREATE TABLE IF NOT EXISTS partner_stats (
+    partner_id INTEGER PRIMARY KEY REFERENCES partners(id),
+    total_clicks BIGINT NOT NULL DEFAULT 0,
+    completed_orders INTEGER NOT NULL DEFAULT 0,
+    total_volume DECIMAL(24, 8) NOT NULL DEFAULT 0,
+    total_earned DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    total_paid DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выплаты завершаются вне функций, поэтому total_paid ведет триггер на смену статуса
+CREATE OR REPLACE FUNCTION partner_stats_track_payout() RETURNS trigger AS $$
+DECLARE
+    delta DECIMAL(15, 2) := 0;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status = 'completed' THEN
+        delta := delta - OLD.amount;
+    END IF;
+    IF NEW.status = 'completed' THEN
+        delta := delta + NEW.amount;
+    END IF;
+
+    IF delta <> 0 THEN
+        INSERT INTO partner_stats (partner_id, total_paid)
+        VALUES (NEW.partner_id, delta)
+        ON CONFLICT (partner_id) DO UPDATE
+        SET total_paid = partner_stats.total_paid + EXCLUDED.total_paid,
+            updated_at = CURRENT_TIMESTAMP;
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_partner_stats_payout ON partner_payouts;
+CREATE TRIGGER trg_partner_stats_payout
+    AFTER INSERT OR UPDATE OF status, amount ON partner_payouts
+    FOR EACH ROW EXECUTE FUNCTION partner_stats_track_payout();
+
+-- Начальное заполнение из исходных таблиц
+INSERT INTO partner_stats (partner_id, total_clicks, completed_orders, total_volume, total_earned, total_paid)
+SELECT
+    p.id,
+    COALESCE(c.total_clicks, 0),
+    COALESCE(o.completed_orders, 0),
+    COALESCE(o.total_volume, 0),
+    COALESCE(e.total_earned, 0),
+    COALESCE(pp.total_paid, 0)
+FROM partners p
+LEFT JOIN (
+    SELECT partner_id, COUNT(*) AS total_clicks FROM partner_clicks GROUP BY partner_id
+) c ON c.partner_id = p.id
+LEFT JOIN (
+    SELECT partner_id, COUNT(*) AS completed_orders, SUM(to_amount) AS total_volume
+    FROM exchange_orders WHERE status = 'completed' GROUP BY partner_id
+) o ON o.partner_id = p.id
+LEFT JOIN (
+    SELECT partner_id, SUM(amount) AS total_earned FROM partner_earnings GROUP BY partner_id
+) e ON e.partner_id = p.id
+LEFT JOIN (
+    SELECT partner_id, SUM(amount) AS total_paid
+    FROM partner_payouts WHERE status = 'completed' GROUP BY partner_id
+) pp ON pp.partner_id = p.id
+ON CONFLICT (partner_id) DO NOTHING;
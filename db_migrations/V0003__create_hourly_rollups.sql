@@ -0,0 +1,40 @@
+-- Почасовые агрегаты кликов партнера по направлению обмена и городу
+CREATE TABLE IF NOT EXISTS partner_clicks_hourly (
+    partner_id INTEGER NOT NULL REFERENCES partners(id),
+    bucket TIMESTAMP NOT NULL,
+    from_currency VARCHAR(20) NOT NULL DEFAULT '',
+    to_currency VARCHAR(20) NOT NULL DEFAULT '',
+    city VARCHAR(100) NOT NULL DEFAULT '',
+    clicks BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (partner_id, bucket, from_currency, to_currency, city)
+);
+
+-- Почасовые агрегаты завершенных заказов партнера по направлению обмена
+CREATE TABLE IF NOT EXISTS partner_orders_hourly (
+    partner_id INTEGER NOT NULL REFERENCES partners(id),
+    bucket TIMESTAMP NOT NULL,
+    from_currency VARCHAR(20) NOT NULL,
+    to_currency VARCHAR(20) NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    volume DECIMAL(24, 8) NOT NULL DEFAULT 0,
+    earnings DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (partner_id, bucket, from_currency, to_currency)
+);
+
+-- Начальное заполнение из исходных таблиц
+INSERT INTO partner_clicks_hourly (partner_id, bucket, from_currency, to_currency, city, clicks)
+SELECT partner_id, date_trunc('hour', clicked_at),
+       COALESCE(from_currency, ''), COALESCE(to_currency, ''), COALESCE(city, ''), COUNT(*)
+FROM partner_clicks
+WHERE partner_id IS NOT NULL AND clicked_at IS NOT NULL
+GROUP BY 1, 2, 3, 4, 5
+ON CONFLICT DO NOTHING;
+
+INSERT INTO partner_orders_hourly (partner_id, bucket, from_currency, to_currency, orders, volume, earnings)
+SELECT eo.partner_id, date_trunc('hour', eo.completed_at), eo.from_currency, eo.to_currency,
+       COUNT(*), SUM(eo.to_amount), COALESCE(SUM(pe.amount), 0)
+FROM exchange_orders eo
+LEFT JOIN partner_earnings pe ON pe.order_id = eo.id
+WHERE eo.status = 'completed' AND eo.partner_id IS NOT NULL AND eo.completed_at IS NOT NULL
+GROUP BY 1, 2, 3, 4
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,3 @@
+-- Составные индексы под keyset-пагинацию начислений и выплат по (время, id)
+CREATE INDEX IF NOT EXISTS idx_earnings_partner_earned ON partner_earnings(partner_id, earned_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_payouts_partner_created ON partner_payouts(partner_id, created_at DESC, id DESC);
@@ -0,0 +1,6 @@
+-- Ключ идемпотентности заявки на выплату: повтор запроса клиентом не создает вторую выплату
+ALTER TABLE partner_payouts ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(100);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payouts_idempotency
+    ON partner_payouts(partner_id, idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
@@ -0,0 +1,10 @@
+-- Отозванные токены партнеров (выход из кабинета). Функции держат список в памяти
+-- и дочитывают новые записи по revoked_at, поэтому проверка токена не ходит в БД
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    jti VARCHAR(32) PRIMARY KEY,
+    partner_id INTEGER NOT NULL REFERENCES partners(id),
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at);
@@ -0,0 +1,29 @@
+-- История курсов get-rates. Снимок хранится одной строкой: курсы всех инструментов
+-- массивом в порядке кодов набора инструментов, к которому он относится
+CREATE TABLE IF NOT EXISTS rate_instrument_sets (
+    version VARCHAR(12) PRIMARY KEY,
+    codes TEXT[] NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS rate_snapshots (
+    fetched_at TIMESTAMPTZ PRIMARY KEY,
+    instruments_version VARCHAR(12) NOT NULL REFERENCES rate_instrument_sets(version),
+    rates DOUBLE PRECISION[] NOT NULL
+);
+
+-- Свечи по уровням детализации (1m, 1h, 1d), дополняемые при каждой записи снимков.
+-- open_at/close_at позволяют нескольким контейнерам дописывать одну свечу в любом порядке
+CREATE TABLE IF NOT EXISTS rate_candles (
+    instrument VARCHAR(20) NOT NULL,
+    tier VARCHAR(2) NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    open DOUBLE PRECISION NOT NULL,
+    high DOUBLE PRECISION NOT NULL,
+    low DOUBLE PRECISION NOT NULL,
+    close DOUBLE PRECISION NOT NULL,
+    open_at TIMESTAMPTZ NOT NULL,
+    close_at TIMESTAMPTZ NOT NULL,
+    samples INTEGER NOT NULL,
+    PRIMARY KEY (instrument, tier, bucket)
+);
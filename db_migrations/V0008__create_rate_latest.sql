@@ -0,0 +1,8 @@
+-- Последний снимок курсов, опубликованный обновлятелем get-rates (RATES_SNAPSHOT_STORE=postgres).
+-- Одна строка: функции читают ее не чаще раза в RATES_STORE_POLL секунд
+CREATE TABLE IF NOT EXISTS rate_latest (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    fetched_at TIMESTAMPTZ NOT NULL,
+    snapshot JSONB NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
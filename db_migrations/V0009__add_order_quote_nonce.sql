@@ -0,0 +1,7 @@
+-- Одноразовость котировок get-rates: заявка запоминает nonce котировки, по которой создана,
+-- и повторная заявка по той же котировке отклоняется
+ALTER TABLE exchange_orders ADD COLUMN IF NOT EXISTS quote_nonce VARCHAR(32);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_quote_nonce
+    ON exchange_orders(quote_nonce)
+    WHERE quote_nonce IS NOT NULL;
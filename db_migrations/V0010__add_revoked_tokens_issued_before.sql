@@ -0,0 +1,3 @@
+-- Отзыв всех токенов партнера разом (смена пароля): запись с issued_before отзывает
+-- каждый его токен, выпущенный раньше этого момента, а не один jti
+ALTER TABLE revoked_tokens ADD COLUMN IF NOT EXISTS issued_before TIMESTAMP;
@@ -4,6 +4,16 @@ import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Label } from '@/components/ui/label';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
+import {
+  AlertDialog,
+  AlertDialogAction,
+  AlertDialogCancel,
+  AlertDialogContent,
+  AlertDialogDescription,
+  AlertDialogFooter,
+  AlertDialogHeader,
+  AlertDialogTitle,
+} from '@/components/ui/alert-dialog';
 import Icon from '@/components/ui/icon';
 import { useNavigate } from 'react-router-dom';
 
@@ -72,6 +82,14 @@ const FIAT_CURRENCIES = {
 const API_URL = 'https://functions.poehali.dev/2de422c9-d36c-4533-bb21-d13c2c8700dd';
 const TRACK_API = 'https://functions.poehali.dev/8ec5e4f3-1975-4ec1-85bd-52373bacc02a';
 
+type Quote = {
+  token: string;
+  from_amount: number;
+  to_amount: number;
+  rate: number;
+  expiresAt: number;
+};
+
 const Index = () => {
   const navigate = useNavigate();
   const [activeSection, setActiveSection] = useState('exchange');
@@ -91,6 +109,10 @@ const Index = () => {
   const [rates, setRates] = useState<{ [key: string]: number }>({});
   const [ratesLoading, setRatesLoading] = useState(true);
   const [partnerId, setPartnerId] = useState<number | null>(null);
+  const [quote, setQuote] = useState<Quote | null>(null);
+  const [quoteOpen, setQuoteOpen] = useState(false);
+  const [quoteLoading, setQuoteLoading] = useState(false);
+  const [now, setNow] = useState(Date.now());
 
   useEffect(() => {
     fetchRates();
@@ -202,8 +224,72 @@ const Index = () => {
     calculateExchange(value, true);
   };
 
+  const fetchQuote = async (): Promise<Quote | undefined> => {
+    try {
+      const params = new URLSearchParams({
+        mode: 'quote',
+        from: fromCurrency,
+        to: toCurrency,
+        amount: fromAmount
+      });
+      const response = await fetch(`${API_URL}?${params}`);
+      const data = await response.json();
+      if (!data.success) {
+        return undefined;
+      }
+      // Срок считаем по локальным часам от момента получения, чтобы не зависеть от их расхождения с сервером
+      const { token, from_amount, to_amount, rate, iat, exp } = data.quote;
+      return { token, from_amount, to_amount, rate, expiresAt: Date.now() + (exp - iat) * 1000 };
+    } catch (error) {
+      console.error('Failed to fetch quote:', error);
+      return undefined;
+    }
+  };
+
+  const formatToAmount = (value: number) =>
+    exchangeMode === 'crypto-to-fiat' ? value.toFixed(2) : value.toFixed(8);
+
+  const refreshQuote = async () => {
+    setQuoteLoading(true);
+    const fresh = await fetchQuote();
+    setQuoteLoading(false);
+    setQuote(fresh || null);
+    setNow(Date.now());
+    return fresh;
+  };
+
+  const quoteExpired = !quote || now >= quote.expiresAt;
+  const quoteSecondsLeft = quote ? Math.max(0, Math.ceil((quote.expiresAt - now) / 1000)) : 0;
+
+  useEffect(() => {
+    if (!quoteOpen) {
+      return;
+    }
+    const timer = setInterval(() => setNow(Date.now()), 1000);
+    return () => clearInterval(timer);
+  }, [quoteOpen]);
+
+  useEffect(() => {
+    // Истекшую котировку перезапрашиваем, пока открыто подтверждение
+    if (quoteOpen && quote && quoteExpired && !quoteLoading) {
+      refreshQuote();
+    }
+  }, [quoteOpen, quoteExpired]);
+
   const handleSubmit = async () => {
+    const fresh = await refreshQuote();
+    if (fresh) {
+      setQuoteOpen(true);
+    } else {
+      // Котировка недоступна: заявка создается по курсу на странице, как раньше
+      await createOrder();
+    }
+  };
+
+  const createOrder = async (confirmed?: Quote) => {
     const orderId = Math.floor(100000 + Math.random() * 900000).toString();
+    // Заявка с котировкой создается по ее сумме, поэтому ее же и показываем
+    const bookedToAmount = confirmed ? formatToAmount(confirmed.to_amount) : toAmount;
     
     const orderData = {
       action: 'create_order',
@@ -211,13 +297,14 @@ const Index = () => {
       from_currency: fromCurrency,
       to_currency: toCurrency,
       from_amount: parseFloat(fromAmount),
-      to_amount: parseFloat(toAmount),
-      exchange_rate: rates[fromCurrency] || 0,
-      margin_profit: parseFloat(toAmount) * 0.02,
+      to_amount: parseFloat(bookedToAmount),
+      exchange_rate: confirmed ? confirmed.rate : rates[fromCurrency] || 0,
+      margin_profit: parseFloat(bookedToAmount) * 0.02,
       customer_email: email,
       customer_contact: phone || telegram,
       wallet_address: exchangeMode === 'fiat-to-crypto' ? '' : '',
-      card_number: cardNumber
+      card_number: cardNumber,
+      quote_token: confirmed?.token
     };
     
     try {
@@ -236,7 +323,7 @@ const Index = () => {
         type: exchangeMode,
         fromAmount,
         fromCurrency,
-        toAmount,
+        toAmount: bookedToAmount,
         toCurrency,
         phone,
         fullName,
@@ -558,12 +645,54 @@ const Index = () => {
 
               <Button
                 onClick={handleSubmit}
-                disabled={!fromAmount || !toAmount || !email || !telegram}
+                disabled={!fromAmount || !toAmount || !email || !telegram || quoteLoading}
                 className="w-full h-14 text-lg font-bold gradient-primary hover:opacity-90"
               >
                 <Icon name="CheckCircle" size={22} />
                 <span className="ml-2">Создать заявку на обмен</span>
               </Button>
+
+              <AlertDialog open={quoteOpen} onOpenChange={setQuoteOpen}>
+                <AlertDialogContent>
+                  <AlertDialogHeader>
+                    <AlertDialogTitle>Подтвердите обмен</AlertDialogTitle>
+                    <AlertDialogDescription>
+                      Заявка будет создана по зафиксированному курсу, пока он действует.
+                    </AlertDialogDescription>
+                  </AlertDialogHeader>
+                  <div className="space-y-2 text-sm">
+                    <div className="flex justify-between">
+                      <span className="text-muted-foreground">Отдаете</span>
+                      <span className="font-semibold">{fromAmount} {fromCurrency}</span>
+                    </div>
+                    <div className="flex justify-between">
+                      <span className="text-muted-foreground">Получаете</span>
+                      <span className="font-semibold">
+                        {quote ? `${formatToAmount(quote.to_amount)} ${toCurrency}` : '—'}
+                      </span>
+                    </div>
+                    <div className="flex justify-between">
+                      <span className="text-muted-foreground">Курс действует</span>
+                      <span>
+                        {quoteLoading
+                          ? 'Обновляем курс...'
+                          : quote
+                            ? `${quoteSecondsLeft} сек`
+                            : 'Не удалось получить курс'}
+                      </span>
+                    </div>
+                  </div>
+                  <AlertDialogFooter>
+                    <AlertDialogCancel>Отмена</AlertDialogCancel>
+                    <AlertDialogAction
+                      disabled={quoteExpired || quoteLoading}
+                      onClick={() => quote && createOrder(quote)}
+                    >
+                      Подтвердить
+                    </AlertDialogAction>
+                  </AlertDialogFooter>
+                </AlertDialogContent>
+              </AlertDialog>
             </Card>
 
             <Card className="glass-effect p-6 border-primary/30">
@@ -10,6 +10,12 @@ import { useNavigate } from 'react-router-dom';
 const DASHBOARD_API = 'https://functions.poehali.dev/3f5e4441-9d48-4e84-ad94-358398ecd78a';
 const AUTH_API = 'https://functions.poehali.dev/9b14cf78-8c7c-447f-9f9e-fc0f5a8be268';
 
+const authHeaders = (): Record<string, string> => {
+  const partnerData = localStorage.getItem('partner_data');
+  const token = partnerData ? JSON.parse(partnerData).token : '';
+  return { Authorization: `Bearer ${token}` };
+};
+
 interface PartnerStats {
   partner_code: string;
   balance: number;
@@ -69,15 +75,32 @@ export default function PartnerDashboard() {
     }
 
     const data = JSON.parse(partnerData);
+    if (!data.token) {
+      localStorage.removeItem('partner_data');
+      navigate('/partner-register');
+      return;
+    }
+
     setPartnerId(data.partner_id);
     loadStats(data.partner_id);
     loadEarnings(data.partner_id);
     loadPayouts(data.partner_id);
   }, [navigate]);
 
+  // 401 - токен истек или отозван (выход, смена пароля в другой сессии): заново на вход
+  const sessionExpired = (response: Response): boolean => {
+    if (response.status !== 401) return false;
+    localStorage.removeItem('partner_data');
+    navigate('/partner-register');
+    return true;
+  };
+
   const loadStats = async (id: number) => {
     try {
-      const response = await fetch(`${DASHBOARD_API}?action=stats&partner_id=${id}`);
+      const response = await fetch(`${DASHBOARD_API}?action=stats&partner_id=${id}`, {
+        headers: authHeaders()
+      });
+      if (sessionExpired(response)) return;
       const data = await response.json();
       if (data.success) {
         setStats(data);
@@ -91,7 +114,10 @@ export default function PartnerDashboard() {
 
   const loadEarnings = async (id: number) => {
     try {
-      const response = await fetch(`${DASHBOARD_API}?action=earnings&partner_id=${id}`);
+      const response = await fetch(`${DASHBOARD_API}?action=earnings&partner_id=${id}`, {
+        headers: authHeaders()
+      });
+      if (sessionExpired(response)) return;
       const data = await response.json();
       if (data.success) {
         setEarnings(data.earnings);
@@ -103,7 +129,10 @@ export default function PartnerDashboard() {
 
   const loadPayouts = async (id: number) => {
     try {
-      const response = await fetch(`${DASHBOARD_API}?action=payouts&partner_id=${id}`);
+      const response = await fetch(`${DASHBOARD_API}?action=payouts&partner_id=${id}`, {
+        headers: authHeaders()
+      });
+      if (sessionExpired(response)) return;
       const data = await response.json();
       if (data.success) {
         setPayouts(data.payouts);
@@ -121,13 +150,14 @@ export default function PartnerDashboard() {
     try {
       const response = await fetch(DASHBOARD_API, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({
           action: 'request_payout',
           partner_id: partnerId,
           ...payoutForm
         })
       });
+      if (sessionExpired(response)) return;
 
       const data = await response.json();
       if (data.success) {
@@ -156,7 +186,7 @@ export default function PartnerDashboard() {
     try {
       const response = await fetch(AUTH_API, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
         body: JSON.stringify({
           action: 'change_password',
           partner_id: partnerId,
@@ -164,9 +194,17 @@ export default function PartnerDashboard() {
           new_password: passwordForm.new_password
         })
       });
+      if (sessionExpired(response)) return;
 
       const data = await response.json();
       if (data.success) {
+        // Прочие сессии отозваны, текущая продолжает с новым токеном
+        const partnerData = JSON.parse(localStorage.getItem('partner_data') || '{}');
+        localStorage.setItem('partner_data', JSON.stringify({
+          ...partnerData,
+          token: data.token,
+          token_expires_at: data.token_expires_at
+        }));
         alert('Пароль успешно изменен');
         setPasswordForm({ old_password: '', new_password: '', confirm_password: '' });
       } else {
@@ -177,7 +215,16 @@ export default function PartnerDashboard() {
     }
   };
 
-  const handleLogout = () => {
+  const handleLogout = async () => {
+    try {
+      await fetch(AUTH_API, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', ...authHeaders() },
+        body: JSON.stringify({ action: 'logout' })
+      });
+    } catch (error) {
+      console.error('Failed to logout:', error);
+    }
     localStorage.removeItem('partner_data');
     navigate('/partner-register');
   };